@@ -1,18 +1,29 @@
 import re
+import warnings
 import numpy as np
+import pandas as pd
+
+from typing import Iterable, Optional, Sequence, Tuple
 
 
 def parse_replay(replay: str) -> dict:
     """
     Parses a Pokemon Showdown replay log in order to extract information,
     such as which pokemon appeared. Returns parsed data as a dictionary.
+    The "team" entry lists the pokemon each player showed in team preview,
+    including those that never switched in. Moves are attributed to the
+    pokemon's nickname, as shown in the log, and to its species. Each
+    entry of "pokemon" records the turn it switched in on, 0 for leads, and
+    whether it was revealed by a |replace| (Illusion) rather than a switch.
     For details about the replay log format, see:
         https://github.com/smogon/pokemon-showdown/blob/master/sim/SIM-PROTOCOL.md
     """
     lines = replay.splitlines()
     pokemon = []
     moves = []
+    team = []
     players = {}
+    species = {}
     switch_stmt = re.compile(r'\|(switch|drag)\|(?P<pokemon>[^|]+)\|(?P<details>[^|]+)\|[^|]+')
     replace_stmt = re.compile(r'\|replace\|(?P<pokemon>[^|]+)\|(?P<details>[^|]+)\|[^|]+')
     win_stmt = re.compile(r'\|win\|(?P<user>[^|]+)')
@@ -20,10 +31,14 @@ def parse_replay(replay: str) -> dict:
     player_stmt = re.compile(r'\|player\|p(?P<num>\d)\|(?P<name>[^|]+)\|[^|]+\|[^|]*$')
     pokemon_substmt = re.compile(r'p(\d)(\w): (?P<name>.*)')
     move_stmt = re.compile(r'\|move\|(?P<pokemon>[^|]+)\|(?P<move>[^|]+)\|[^|]+')
+    poke_stmt = re.compile(r'\|poke\|p(?P<num>\d)\|(?P<details>[^|]+)')
+    turn_stmt = re.compile(r'\|turn\|(?P<turn>\d+)')
     winner = None
     tie = False
+    turn = 0
     for line in lines:
         mo = switch_stmt.match(line)
+        replace = mo is None
         mo = mo or replace_stmt.match(line)
         if mo:
             poke_mo = pokemon_substmt.match(mo.group('pokemon'))
@@ -32,7 +47,15 @@ def parse_replay(replay: str) -> dict:
                 "player": int(poke_mo.group(1)),
                 "position": poke_mo.group(2),
                 "name": details[0],
+                "turn": turn,
+                "replace": replace,
             })
+            species[(int(poke_mo.group(1)), poke_mo.group('name'))] = details[0]
+            continue
+        
+        mo = turn_stmt.match(line)
+        if mo:
+            turn = int(mo.group('turn'))
             continue
         
         mo = player_stmt.match(line)
@@ -40,6 +63,14 @@ def parse_replay(replay: str) -> dict:
             players.update({int(mo.group('num')): mo.group('name')})
             continue
         
+        mo = poke_stmt.match(line)
+        if mo:
+            team.append({
+                "player": int(mo.group('num')),
+                "name": mo.group('details').split(',')[0],
+            })
+            continue
+        
         mo = win_stmt.match(line)
         if mo:
             winner = mo.group('user')
@@ -58,6 +89,7 @@ def parse_replay(replay: str) -> dict:
                 "player": int(poke_mo.group(1)),
                 "position": poke_mo.group(2),
                 "pokemon": poke_mo.group('name'),
+                "species": species.get((int(poke_mo.group(1)), poke_mo.group('name')), poke_mo.group('name')),
                 "move": mo.group('move'),
                 "order": order,
             })
@@ -71,9 +103,378 @@ def parse_replay(replay: str) -> dict:
         key = move['player']
         move['player'] = players[key]
     
+    for p in team:
+        key = p['player']
+        p['player'] = players[key]
+    
     return {
         'pokemon': pokemon,
         'winner': winner,
         'tie': tie,
         'moves': moves,
-    }
\ No newline at end of file
+        'team': team,
+    }
+
+
+
+APPEARANCE_DTYPES = {
+    "player": "category",
+    "pokemon": "category",
+    "won": np.int8,
+    "appearance_order": np.int16,
+}
+
+MOVE_DTYPES = {
+    "player": "category",
+    "pokemon": "category",
+    "move": "category",
+    "order": np.int32,
+}
+
+
+def parse_replays(replays: Iterable[Tuple[str, str]]) -> dict:
+    """
+    Parses a batch of (id, log) pairs with parse_replay and returns the
+    results as columns rather than nested dictionaries: a dictionary with
+    the DataFrames "appearances" (id, player, pokemon, won,
+    appearance_order) and "moves" (id, player, pokemon, move, order), with
+    the compact dtypes of APPEARANCE_DTYPES and MOVE_DTYPES, and the list
+    "errors" of the ids whose logs couldn't be parsed.
+    
+    Rows are kept for both players. appearance_order is the index of the
+    switch-in within the battle, and won is 1 for the winner's rows
+    (comparing names case-insensitively).
+    """
+    appearances = {"id": [], "player": [], "pokemon": [], "appearance_order": []}
+    moves = {"id": [], "player": [], "pokemon": [], "move": [], "order": []}
+    winners = {}
+    errors = []
+    for replay_id, log in replays:
+        try:
+            parsed_replay = parse_replay(log)
+        except KeyError:
+            errors.append(replay_id)
+            continue
+        winners[replay_id] = (parsed_replay['winner'] or '').lower()
+        pokemon = parsed_replay['pokemon']
+        appearances["id"].extend([replay_id] * len(pokemon))
+        appearances["player"].extend(p['player'] for p in pokemon)
+        appearances["pokemon"].extend(p['name'] for p in pokemon)
+        appearances["appearance_order"].extend(range(len(pokemon)))
+        replay_moves = parsed_replay['moves']
+        moves["id"].extend([replay_id] * len(replay_moves))
+        for name in ("player", "pokemon", "move", "order"):
+            moves[name].extend(move[name] for move in replay_moves)
+    
+    appearances_df = pd.DataFrame(appearances, dtype=object)
+    appearances_df["won"] = (
+        appearances_df.player.str.lower() == appearances_df.id.map(winners)
+    ).astype(np.int8)
+    appearances_df = appearances_df.loc[:, ["id", "player", "pokemon", "won", "appearance_order"]]
+    moves_df = pd.DataFrame(moves, dtype=object)
+    return {
+        "appearances": appearances_df.astype(APPEARANCE_DTYPES),
+        "moves": moves_df.astype(MOVE_DTYPES),
+        "errors": errors,
+    }
+
+INDEXED_EVENTS = ('move', 'switch', 'drag', 'replace', 'faint', '-terastallize', '-fieldstart', '-sidestart', '-weather')
+
+
+def parse_events(replay: str) -> list:
+    """
+    Parses a Pokemon Showdown replay log into a list of notable events,
+    for building an event index. Each event is a dictionary with the keys
+    "event" (the protocol message type without its leading "-", such as
+    "move", "switch", "faint", "terastallize" or "fieldstart"), "subject",
+    "player" and "turn" (0 before the first turn starts).
+    
+    The subject is the move name for moves, the effect name for field,
+    side and weather effects (e.g. "Trick Room", "Tailwind", "RainDance")
+    and the species otherwise. The player is empty for effects that can't
+    be attributed to one.
+    """
+    lines = replay.splitlines()
+    players = {}
+    species = {}
+    events = []
+    turn = 0
+    player_stmt = re.compile(r'\|player\|p(?P<num>\d)\|(?P<name>[^|]+)\|')
+    turn_stmt = re.compile(r'\|turn\|(?P<turn>\d+)')
+    pokemon_substmt = re.compile(r'p(?P<num>\d)\w?: (?P<name>.*)')
+    for line in lines:
+        mo = player_stmt.match(line)
+        if mo:
+            players[int(mo.group('num'))] = mo.group('name')
+            continue
+        mo = turn_stmt.match(line)
+        if mo:
+            turn = int(mo.group('turn'))
+            continue
+        parts = line.split('|')
+        if len(parts) < 3 or parts[1] not in INDEXED_EVENTS:
+            continue
+        event = parts[1]
+        args = [a for a in parts[2:] if not a.startswith('[')]
+        if event in ('-weather', '-fieldstart'):
+            if not args or args[0] == 'none' or '[upkeep]' in parts:
+                continue
+            subject = args[0].replace('move: ', '')
+            # Field effects are attributed to the pokemon in the [of] tag, if any
+            of = [a[len('[of] '):] for a in parts if a.startswith('[of] ')]
+            poke_mo = pokemon_substmt.match(of[0]) if of else None
+            player = players.get(int(poke_mo.group('num')), '') if poke_mo else ''
+        else:
+            poke_mo = pokemon_substmt.match(args[0]) if args else None
+            if not poke_mo:
+                continue
+            num = int(poke_mo.group('num'))
+            player = players.get(num, '')
+            key = (num, poke_mo.group('name'))
+            if event in ('switch', 'drag', 'replace'):
+                species[key] = args[1].split(',')[0]
+                subject = species[key]
+            elif event == '-sidestart':
+                subject = args[1].replace('move: ', '') if len(args) > 1 else ''
+            elif event == 'move':
+                subject = args[1] if len(args) > 1 else ''
+            else:
+                subject = species.get(key, poke_mo.group('name'))
+        events.append({
+            "event": event.lstrip('-'),
+            "subject": subject,
+            "player": player,
+            "turn": turn,
+        })
+    return events
+
+
+def get_pair_win_rate_intervals(
+    appearances_df: pd.DataFrame,
+    num_resamples: int = 1000,
+    confidence: float = 0.95,
+    memory_budget: int = 256 * 2**20,
+    seed: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Computes bootstrap confidence intervals for the marginal win rate of
+    every pair of pokemon at once. appearances_df has the columns id,
+    player, pokemon and won, as in the appearances table (e.g. read with
+    pd.read_sql, or parquet.read_appearances).
+    
+    Uses the Poisson bootstrap: each resample gives every game a weight
+    drawn from Poisson(1), which approximates resampling games with
+    replacement, and both teams of a game share its weight. Pairs are
+    processed in blocks, and a batch of resamples is evaluated with two
+    bincounts over the pair rows of a block. Half of memory_budget bytes
+    holds the resampled win rates of a block (4 bytes per pair per
+    resample) and the other half the working arrays of a batch. Results
+    are reproducible for a given seed and memory_budget.
+    
+    Returns a DataFrame with columns p1, p2, appearances, wins, win_rate,
+    ci_low and ci_high, ordered by appearances.
+    """
+    df = appearances_df.loc[:, ["id", "player", "pokemon", "won"]].drop_duplicates(["id", "player", "pokemon"])
+    pairs = df.merge(df, on=["id", "player"], suffixes=("1", "2"))
+    pairs = pairs[pairs.pokemon1 < pairs.pokemon2]
+    grouped = pairs.groupby(by=["pokemon1", "pokemon2"])
+    pair_codes = grouped.ngroup().to_numpy()
+    result = grouped.agg(
+        appearances=("won1", "size"),
+        wins=("won1", "sum"),
+    ).reset_index().rename(columns={"pokemon1": "p1", "pokemon2": "p2"})
+    result["win_rate"] = result.wins / result.appearances
+    replay_codes = pd.factorize(pairs.id)[0]
+    won = pairs.won1.to_numpy(dtype=np.float64)
+    num_pairs = len(result)
+    
+    # Sort the rows by pair, so each block of pairs is a contiguous run of rows
+    order = np.argsort(pair_codes, kind="stable")
+    pair_codes, replay_codes, won = pair_codes[order], replay_codes[order], won[order]
+    row_starts = np.searchsorted(pair_codes, np.arange(num_pairs + 1))
+    pairs_per_block = int(max(1, (memory_budget // 2) // (4 * num_resamples)))
+    alpha = (1 - confidence) / 2
+    percentiles = [100 * alpha, 100 * (1 - alpha)]
+    rng = np.random.default_rng(seed)
+    ci = np.empty((2, num_pairs), dtype=np.float64)
+    for first in range(0, num_pairs, pairs_per_block):
+        last = min(first + pairs_per_block, num_pairs)
+        rows = slice(row_starts[first], row_starts[last])
+        block_replay_codes = np.unique(replay_codes[rows], return_inverse=True)[1].ravel()
+        rates = _resample_pair_win_rates(
+            pair_codes[rows] - first, block_replay_codes, won[rows],
+            last - first, num_resamples, memory_budget // 2, rng)
+        with warnings.catch_warnings():
+            # A pair can be absent from every resample if it appeared in very few games
+            warnings.simplefilter("ignore", RuntimeWarning)
+            ci[:, first:last] = np.nanpercentile(rates, percentiles, axis=0)
+    result["ci_low"] = ci[0]
+    result["ci_high"] = ci[1]
+    return result.sort_values(by="appearances", ascending=False, ignore_index=True)
+
+
+def _resample_pair_win_rates(
+    pair_codes: np.ndarray,
+    replay_codes: np.ndarray,
+    won: np.ndarray,
+    num_pairs: int,
+    num_resamples: int,
+    memory_budget: int,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """
+    Returns the Poisson bootstrap win rates of get_pair_win_rate_intervals
+    for the pair rows given by their pair and replay codes, as a
+    num_resamples x num_pairs array.
+    """
+    num_rows, num_replays = len(pair_codes), int(replay_codes.max(initial=-1)) + 1
+    # Per resample: replay weights, then row weights, weighted wins and bin
+    # indices per row, then appearances and wins per pair, 8 bytes each
+    bytes_per_resample = 8 * (num_replays + 3 * num_rows + 2 * num_pairs) or 1
+    batch_size = int(max(1, min(num_resamples, memory_budget // bytes_per_resample)))
+    offsets = np.arange(batch_size, dtype=np.int64)[:, None] * num_pairs
+    bins = (offsets + pair_codes).ravel()
+    rates = np.empty((num_resamples, num_pairs), dtype=np.float32)
+    for start in range(0, num_resamples, batch_size):
+        size = min(batch_size, num_resamples - start)
+        weights = rng.poisson(1.0, size=(size, num_replays)).astype(np.float64)
+        row_weights = weights[:, replay_codes]
+        appearances = np.bincount(
+            bins[:size * num_rows], weights=row_weights.ravel(), minlength=size * num_pairs)
+        wins = np.bincount(
+            bins[:size * num_rows], weights=(row_weights * won).ravel(), minlength=size * num_pairs)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rates[start:start + size] = (wins / appearances).reshape(size, num_pairs)
+    return rates
+
+
+def get_rolling_pair_win_rates(
+    appearances_df: pd.DataFrame,
+    window: int,
+    stride: int,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    half_life: Optional[float] = None,
+    min_appearances: float = 1,
+) -> pd.DataFrame:
+    """
+    Computes marginal pair win rates over sliding time windows of window
+    seconds, one every stride seconds, e.g. window=7 * 24 * 60 * 60 and
+    stride=24 * 60 * 60 for weekly windows updated daily. appearances_df
+    has the columns id, player, pokemon, won and uploadtime, e.g.:
+    
+        SELECT a.id, a.player, a.pokemon, a.won, r.uploadtime
+        FROM appearances AS a JOIN replays AS r ON r.id = a.id
+    
+    Windows are half-open, [window_start, window_end), with the first one
+    starting at start (default: the earliest uploadtime) and the last one
+    starting before end (default: just after the latest uploadtime).
+    
+    Running counts per pair are kept as the window slides: rows entering
+    the window are added and rows leaving it are subtracted, so each row
+    is visited twice whatever the window and stride. If half_life is given
+    (in seconds), each game is weighted by 0.5 ** (age / half_life), where
+    age is the time from the game to window_end, so the weighted
+    appearances and wins are no longer whole numbers.
+    
+    Returns a DataFrame with columns window_start, window_end, p1, p2,
+    appearances, wins and win_rate, with one row per window for each pair
+    having at least min_appearances (weighted) appearances in it.
+    """
+    df = appearances_df.loc[:, ["id", "player", "pokemon", "won", "uploadtime"]].drop_duplicates(["id", "player", "pokemon"])
+    pairs = df.merge(df.loc[:, ["id", "player", "pokemon"]], on=["id", "player"], suffixes=("1", "2"))
+    pairs = pairs[pairs.pokemon1 < pairs.pokemon2].sort_values(by="uploadtime", kind="stable")
+    grouped = pairs.groupby(by=["pokemon1", "pokemon2"], sort=True)
+    pair_codes = grouped.ngroup().to_numpy()
+    pair_names = grouped.size().index
+    times = pairs.uploadtime.to_numpy(dtype=np.int64)
+    won = pairs.won.to_numpy(dtype=np.float64)
+    num_pairs = len(pair_names)
+    if not len(times):
+        return pd.DataFrame(columns=["window_start", "window_end", "p1", "p2", "appearances", "wins", "win_rate"])
+    start = int(times[0]) if start is None else start
+    end = int(times[-1]) + 1 if end is None else end
+    
+    appearances = np.zeros(num_pairs, dtype=np.float64)
+    wins = np.zeros(num_pairs, dtype=np.float64)
+    
+    def update(lo, hi, sign, window_end):
+        if lo >= hi:
+            return
+        weights = np.full(hi - lo, sign, dtype=np.float64)
+        if half_life is not None:
+            weights *= 0.5 ** ((window_end - times[lo:hi]) / half_life)
+        appearances[:] += np.bincount(pair_codes[lo:hi], weights=weights, minlength=num_pairs)
+        wins[:] += np.bincount(pair_codes[lo:hi], weights=weights * won[lo:hi], minlength=num_pairs)
+    
+    frames = []
+    lo = hi = 0
+    for window_start in range(start, end, stride):
+        window_end = window_start + window
+        new_lo, new_hi = np.searchsorted(times, [window_start, window_end], side="left")
+        if half_life is not None and hi > lo:
+            # Age the running counts to the new window end before updating them
+            decay = 0.5 ** (stride / half_life)
+            appearances *= decay
+            wins *= decay
+        if new_lo >= hi:
+            appearances[:] = 0
+            wins[:] = 0
+            update(new_lo, new_hi, 1, window_end)
+        else:
+            update(lo, new_lo, -1, window_end)
+            update(hi, new_hi, 1, window_end)
+        lo, hi = new_lo, new_hi
+        selected = np.flatnonzero(appearances >= max(min_appearances, 1e-9))
+        frames.append(pd.DataFrame({
+            "window_start": window_start,
+            "window_end": window_end,
+            "p1": pair_names.get_level_values(0)[selected],
+            "p2": pair_names.get_level_values(1)[selected],
+            "appearances": appearances[selected],
+            "wins": wins[selected],
+        }))
+    result = pd.concat(frames, ignore_index=True)
+    if half_life is None:
+        # Without decay the counts are exact integers, up to rounding from the subtractions
+        result["appearances"] = result.appearances.round().astype(np.int64)
+        result["wins"] = result.wins.round().astype(np.int64)
+    result["win_rate"] = result.wins / result.appearances
+    return result
+
+
+def get_species_matrices(appearances_df: pd.DataFrame, replay_ids: Sequence[str]) -> tuple:
+    """
+    Returns (species, matrices) where species is the sorted list of pokemon
+    in appearances_df and matrices maps "seen", "won" and "lost" to boolean
+    arrays of shape (len(replay_ids), len(species)). matrices["seen"][i, j]
+    tells whether species[j] appeared in replay_ids[i], and "won" and
+    "lost" whether it appeared on a winning or losing side. Build them once,
+    then filter replays with match_species.
+    """
+    species = sorted(appearances_df.pokemon.unique())
+    replay_idx = pd.Index(replay_ids).get_indexer(appearances_df.id)
+    species_idx = pd.Index(species).get_indexer(appearances_df.pokemon)
+    known = replay_idx >= 0
+    replay_idx, species_idx = replay_idx[known], species_idx[known]
+    won = appearances_df.won.to_numpy()[known].astype(bool)
+    matrices = {}
+    for name, rows in (("seen", slice(None)), ("won", won), ("lost", ~won)):
+        matrix = np.zeros((len(replay_ids), len(species)), dtype=bool)
+        matrix[replay_idx[rows], species_idx[rows]] = True
+        matrices[name] = matrix
+    return species, matrices
+
+
+def match_species(matrix: np.ndarray, species: Sequence[str], selected: Sequence[str], mode: str = "all") -> np.ndarray:
+    """
+    Returns a boolean mask over the rows of a matrix from
+    get_species_matrices, selecting the replays in which all (mode="all")
+    or any (mode="any") of the selected species are set.
+    """
+    columns = pd.Index(species).get_indexer(list(selected))
+    columns = columns[columns >= 0]
+    if len(columns) < len(selected) and mode == "all":
+        return np.zeros(matrix.shape[0], dtype=bool)
+    selected_matrix = matrix[:, columns]
+    return selected_matrix.all(axis=1) if mode == "all" else selected_matrix.any(axis=1)
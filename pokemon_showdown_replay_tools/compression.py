@@ -0,0 +1,188 @@
+"""
+Functions to store replay logs compressed with zstandard.
+
+Replay logs are highly repetitive, so they compress well with a zstd
+dictionary trained on a sample of them. Dictionaries are stored in the
+database, in a table defined by the following SQLite statement:
+
+    CREATE TABLE log_dictionaries (
+        dict_id INTEGER PRIMARY KEY,
+        dictionary BLOB NOT NULL,
+        created INTEGER NOT NULL)
+
+A compressed log is stored in the log column of the replays table as a
+BLOB holding a zstd frame, in place of the TEXT log. Each frame records
+the id of the dictionary it was compressed with (0 if none), so logs
+compressed with different dictionaries can coexist and are decompressed
+transparently by LogDecompressor.
+
+Requires the zstandard package, e.g. via the "compression" extra.
+"""
+import random
+import sqlite3
+import time
+
+from typing import Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DICTIONARY_TABLE_NAME = "log_dictionaries"
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError(
+            "Compressed replay logs require the zstandard package. "
+            "Install it with: pip install zstandard"
+        )
+
+
+def create_dictionary_table(database_con: sqlite3.Connection):
+    cur = database_con.cursor()
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DICTIONARY_TABLE_NAME} (
+        dict_id INTEGER PRIMARY KEY,
+        dictionary BLOB NOT NULL,
+        created INTEGER NOT NULL)
+    """)
+    database_con.commit()
+
+
+def train_log_dictionary(
+    database_con: sqlite3.Connection,
+    sample_size: int = 2000,
+    dict_size: int = 112_640,
+    replay_table_name: str = "replays",
+) -> int:
+    """
+    Trains a zstd dictionary on a random sample of replay logs, stores it
+    in the log_dictionaries table and returns its id. Later calls to
+    get_log_compressor use the most recently trained dictionary.
+    """
+    _require_zstandard()
+    create_dictionary_table(database_con)
+    cur = database_con.cursor()
+    decompressor = LogDecompressor(database_con)
+    rowids = [row[0] for row in cur.execute(f"SELECT rowid FROM {replay_table_name}")]
+    rowids = random.sample(rowids, min(sample_size, len(rowids)))
+    samples = []
+    for rowid in rowids:
+        (log,) = cur.execute(f"SELECT log FROM {replay_table_name} WHERE rowid = ?", (rowid,)).fetchone()
+        samples.append(decompressor.decompress(log).encode())
+    dictionary = zstandard.train_dictionary(dict_size, samples)
+    cur.execute(
+        f"INSERT OR REPLACE INTO {DICTIONARY_TABLE_NAME} VALUES(?, ?, ?)",
+        (dictionary.dict_id(), dictionary.as_bytes(), int(time.time())),
+    )
+    database_con.commit()
+    return dictionary.dict_id()
+
+
+def get_log_compressor(
+    database_con: sqlite3.Connection,
+    level: int = 3,
+    train_if_missing: bool = True,
+    min_samples: int = 1000,
+    replay_table_name: str = "replays",
+):
+    """
+    Returns a zstandard compressor using the latest stored dictionary.
+    If there is none and train_if_missing is set, a dictionary is trained
+    once the replays table holds at least min_samples logs. Until then,
+    logs are compressed without a dictionary.
+    """
+    _require_zstandard()
+    create_dictionary_table(database_con)
+    cur = database_con.cursor()
+    row = cur.execute(
+        f"SELECT dictionary FROM {DICTIONARY_TABLE_NAME} ORDER BY created DESC, rowid DESC LIMIT 1"
+    ).fetchone()
+    if row is None and train_if_missing:
+        (num_replays,) = cur.execute(f"SELECT COUNT(*) FROM {replay_table_name}").fetchone()
+        if num_replays >= min_samples:
+            train_log_dictionary(database_con, replay_table_name=replay_table_name)
+            return get_log_compressor(database_con, level, train_if_missing=False)
+    if row is None:
+        return zstandard.ZstdCompressor(level=level)
+    dictionary = zstandard.ZstdCompressionDict(row[0])
+    return zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+
+
+def compress_log(compressor, log: str) -> bytes:
+    return compressor.compress(log.encode())
+
+
+class LogDecompressor:
+    """
+    Decompresses logs read from the replays table, loading the dictionary
+    each one was compressed with on first use. Uncompressed (TEXT) logs are
+    returned unchanged, so readers work on any mix of the two formats.
+    """
+
+    def __init__(self, database_con: sqlite3.Connection):
+        self.database_con = database_con
+        self._decompressors = {}
+
+    def decompress(self, log: Union[str, bytes]) -> str:
+        if isinstance(log, str):
+            return log
+        return self._get_decompressor(log).decompress(log).decode()
+
+    def _get_decompressor(self, log: bytes):
+        _require_zstandard()
+        dict_id = zstandard.get_frame_parameters(log).dict_id
+        if dict_id not in self._decompressors:
+            self._decompressors[dict_id] = self._load_decompressor(dict_id)
+        return self._decompressors[dict_id]
+
+    def _load_decompressor(self, dict_id: int):
+        if dict_id == 0:
+            return zstandard.ZstdDecompressor()
+        cur = self.database_con.cursor()
+        row = cur.execute(
+            f"SELECT dictionary FROM {DICTIONARY_TABLE_NAME} WHERE dict_id = ?",
+            (dict_id,),
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"Missing zstd dictionary {dict_id} in {DICTIONARY_TABLE_NAME}")
+        return zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(row[0]))
+
+
+def compress_replay_logs(
+    database_con: sqlite3.Connection,
+    level: int = 3,
+    batch_size: int = 1000,
+    replay_table_name: str = "replays",
+    compressor=None,
+) -> int:
+    """
+    Converts the uncompressed logs in the replays table to compressed
+    BLOBs in place, training a dictionary first if there is none.
+    Work is committed per batch, so the conversion can be interrupted and
+    resumed. Returns the number of logs converted. Run VACUUM afterwards
+    to return the freed pages to the file system.
+    """
+    compressor = compressor or get_log_compressor(database_con, level, replay_table_name=replay_table_name)
+    cur = database_con.cursor()
+    num_converted = 0
+    last_rowid = -1
+    while True:
+        batch = cur.execute(
+            f"SELECT rowid, log FROM {replay_table_name} "
+            f"WHERE rowid > ? AND typeof(log) = 'text' ORDER BY rowid LIMIT ?",
+            (last_rowid, batch_size),
+        ).fetchall()
+        if not batch:
+            break
+        last_rowid = batch[-1][0]
+        cur.executemany(
+            f"UPDATE {replay_table_name} SET log = ? WHERE rowid = ?",
+            [(compress_log(compressor, log), rowid) for (rowid, log) in batch],
+        )
+        database_con.commit()
+        num_converted += len(batch)
+    return num_converted
@@ -1,10 +1,17 @@
 import json
+import logging
 import requests
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from requests import Session
+from requests.adapters import HTTPAdapter
 from time import localtime, mktime
-from typing import Optional
+from typing import Callable, Iterable, Optional
+from urllib3.util import Retry
+
+
+logger = logging.getLogger(__name__)
 
 
 def search(
@@ -57,4 +64,63 @@ def get_replay(replay_id: str, session: Optional[Session] = None):
         result = json.loads(resp.content)
     except json.decoder.JSONDecodeError as e:
         raise Exception(f"Error with {url}") from e
-    return result
\ No newline at end of file
+    return result
+
+
+def create_session(
+    pool_size: int = 10,
+    retries: int = 3,
+    backoff_factor: float = 0.1,
+) -> Session:
+    """
+    Returns a Session that retries failed requests and keeps up to
+    pool_size connections open, so it can be shared by that many threads.
+    """
+    session = Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=retries, backoff_factor=backoff_factor),
+    )
+    session.mount('https://', adapter)
+    return session
+
+
+def get_replays(
+    replay_ids: Iterable[str],
+    session: Optional[Session] = None,
+    max_workers: int = 10,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+) -> list:
+    """
+    Downloads replays concurrently, with at most max_workers requests in
+    flight over one pooled session (see create_session). Returns the
+    replays in the order of replay_ids, with None for the ones that failed
+    to download, and logs a warning for each of those. If given,
+    progress_callback(completed, total) is called after each download,
+    always from the calling thread, so it may update UI elements that
+    aren't thread-safe.
+    """
+    replay_ids = list(replay_ids)
+    results = [None] * len(replay_ids)
+    if not replay_ids:
+        return results
+    owns_session = session is None
+    session = session or create_session(pool_size=max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                pool.submit(get_replay, replay_id, session): i
+                for i, replay_id in enumerate(replay_ids)
+            }
+            for completed, future in enumerate(as_completed(futures), start=1):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    logger.warning("Failed to download %s: %s", replay_ids[futures[future]], e)
+                if progress_callback is not None:
+                    progress_callback(completed, len(replay_ids))
+    finally:
+        if owns_session:
+            session.close()
+    return results
@@ -0,0 +1,498 @@
+"""
+Functions to export a replays database to a columnar Parquet dataset,
+and to query that dataset.
+
+The dataset is a directory with three Hive-partitioned tables, each
+partitioned by format and week:
+
+    replays/format=.../week=.../*.parquet
+        id, players, uploadtime, rating
+    appearances/format=.../week=.../*.parquet
+        id, player, pokemon, won, appearance_order, uploadtime, rating
+    moves/format=.../week=.../*.parquet
+        id, player, pokemon, move, order, won, uploadtime, rating
+
+week is the number of whole weeks since the Unix epoch, uploadtime // WEEK.
+Appearances and moves carry the replay's uploadtime and rating, so that
+filters on them can be evaluated without a join. As in the SQLite moves
+table, the pokemon of a move is its species rather than its nickname.
+
+update_weekly_pair_win_rates maintains a separate, much smaller dataset
+of pair win rates per week, see its documentation.
+
+Requires the pyarrow package, e.g. via the "parquet" extra.
+"""
+import json
+import os
+import shutil
+import sqlite3
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from typing import Optional, Sequence
+
+from pokemon_showdown_replay_tools.analysis import parse_replay
+from pokemon_showdown_replay_tools.compression import LogDecompressor
+from pokemon_showdown_replay_tools.sqlite import (
+    ReplayFilter,
+    create_replay_indexes,
+    get_pair_marginal_win_rates_conditional,
+    to_rating,
+)
+
+
+WEEK = 60 * 60 * 24 * 7
+
+PARTITIONING = ds.partitioning(
+    pa.schema([("format", pa.string()), ("week", pa.int32())]),
+    flavor="hive",
+)
+
+SCHEMAS = {
+    "replays": pa.schema([
+        ("id", pa.string()),
+        ("players", pa.string()),
+        ("uploadtime", pa.int64()),
+        ("rating", pa.int32()),
+    ]),
+    "appearances": pa.schema([
+        ("id", pa.string()),
+        ("player", pa.string()),
+        ("pokemon", pa.string()),
+        ("won", pa.int8()),
+        ("appearance_order", pa.int16()),
+        ("uploadtime", pa.int64()),
+        ("rating", pa.int32()),
+    ]),
+    "moves": pa.schema([
+        ("id", pa.string()),
+        ("player", pa.string()),
+        ("pokemon", pa.string()),
+        ("move", pa.string()),
+        ("order", pa.int32()),
+        ("won", pa.int8()),
+        ("uploadtime", pa.int64()),
+        ("rating", pa.int32()),
+    ]),
+}
+
+
+class _PartitionedWriter:
+    """
+    Keeps one ParquetWriter open per partition of a table, so that each
+    batch of rows is appended to its partition's file as a row group.
+    """
+
+    def __init__(self, root: str, table_name: str, basename: str):
+        self.root = root
+        self.table_name = table_name
+        self.basename = basename
+        self.schema = SCHEMAS[table_name]
+        self._writers = {}
+
+    def write(self, rows: dict):
+        """
+        Writes rows given as a dict of column lists, including the
+        partition columns format and week.
+        """
+        if not rows["id"]:
+            return
+        df = pd.DataFrame(rows)
+        for (format, week), group_df in df.groupby(by=["format", "week"], sort=False):
+            table = pa.Table.from_pandas(group_df, schema=self.schema, preserve_index=False)
+            self._get_writer(format, week).write_table(table)
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def _get_writer(self, format: str, week: int):
+        key = (format, week)
+        if key not in self._writers:
+            directory = os.path.join(self.root, self.table_name, f"format={format}", f"week={week}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{self.basename}.parquet")
+            self._writers[key] = pq.ParquetWriter(path, self.schema)
+        return self._writers[key]
+
+
+def export_parquet_dataset(
+    database_con: sqlite3.Connection,
+    root: str,
+    replay_filter: Optional[ReplayFilter] = None,
+    replay_table_name: str = "replays",
+    appearances_table_name: str = "appearances",
+    batch_size: int = 10_000,
+    overwrite: bool = False,
+):
+    """
+    Exports the replays table to a Parquet dataset in the root directory,
+    parsing each log once to derive the appearances and moves tables.
+    An optional ReplayFilter selects the replays to export. Replays are
+    read in (format, uploadtime) order through the index that
+    create_replay_indexes adds, so the logs are never sorted.
+
+    Replays are read from SQLite batch_size at a time and each batch is
+    written out as row groups, so memory use doesn't grow with the size of
+    the database. If the dataset already exists, pass overwrite=True to
+    replace it; otherwise the export is refused.
+    """
+    if os.path.exists(root) and os.listdir(root):
+        if not overwrite:
+            raise FileExistsError(f"{root} is not empty, pass overwrite=True to replace it")
+        shutil.rmtree(root)
+    os.makedirs(root, exist_ok=True)
+    basename = f"part-{uuid.uuid4().hex}"
+    writers = {
+        table_name: _PartitionedWriter(root, table_name, basename)
+        for table_name in SCHEMAS
+    }
+    where, params = replay_filter.compile(appearances_table_name) if replay_filter else ("", [])
+    create_replay_indexes(database_con, replay_table_name, appearances_table_name)
+    decompressor = LogDecompressor(database_con)
+    cur = database_con.cursor()
+    cur.execute(f"""
+        SELECT id, format, players, uploadtime, rating, log FROM {replay_table_name} {where}
+        ORDER BY format, uploadtime
+    """, params)
+    try:
+        batch = cur.fetchmany(batch_size)
+        while batch:
+            rows = {table_name: {name: [] for name in schema.names + ["format", "week"]}
+                    for table_name, schema in SCHEMAS.items()}
+            for replay_id, format, players, uploadtime, rating, log in batch:
+                rating = to_rating(rating)
+                week = uploadtime // WEEK
+                _append_row(rows["replays"], id=replay_id, players=players,
+                            uploadtime=uploadtime, rating=rating, format=format, week=week)
+                try:
+                    parsed_replay = parse_replay(decompressor.decompress(log))
+                except KeyError:
+                    # Logs that failed to download can't be parsed
+                    continue
+                seen = set()
+                for appearance_order, pokemon_appearance in enumerate(parsed_replay['pokemon']):
+                    key = (pokemon_appearance['player'], pokemon_appearance['name'])
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    _append_row(
+                        rows["appearances"],
+                        id=replay_id,
+                        player=pokemon_appearance['player'],
+                        pokemon=pokemon_appearance['name'],
+                        won=1 if pokemon_appearance['player'] == parsed_replay['winner'] else 0,
+                        appearance_order=appearance_order,
+                        uploadtime=uploadtime, rating=rating, format=format, week=week,
+                    )
+                for move in parsed_replay['moves']:
+                    _append_row(
+                        rows["moves"],
+                        id=replay_id,
+                        player=move['player'],
+                        pokemon=move['species'],
+                        move=move['move'],
+                        order=move['order'],
+                        won=1 if move['player'] == parsed_replay['winner'] else 0,
+                        uploadtime=uploadtime, rating=rating, format=format, week=week,
+                    )
+            for table_name, writer in writers.items():
+                writer.write(rows[table_name])
+            batch = cur.fetchmany(batch_size)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def _append_row(columns: dict, **values):
+    for name, value in values.items():
+        columns[name].append(value)
+
+
+def open_dataset(root: str, table_name: str = "appearances") -> ds.Dataset:
+    return ds.dataset(
+        os.path.join(root, table_name),
+        format="parquet",
+        partitioning=PARTITIONING,
+    )
+
+
+def _filter_expression(replay_filter: ReplayFilter):
+    """
+    Translates the format, time and rating parts of a ReplayFilter into a
+    pyarrow expression. Bounds on uploadtime are also applied to the week
+    partition column, so that partitions outside the range are pruned.
+    """
+    expression = ds.scalar(True)
+    if replay_filter.formats:
+        expression &= ds.field("format").isin(list(replay_filter.formats))
+    if replay_filter.uploadtime_start is not None:
+        expression &= ds.field("week") >= replay_filter.uploadtime_start // WEEK
+        expression &= ds.field("uploadtime") >= replay_filter.uploadtime_start
+    if replay_filter.uploadtime_end is not None:
+        expression &= ds.field("week") <= replay_filter.uploadtime_end // WEEK
+        expression &= ds.field("uploadtime") < replay_filter.uploadtime_end
+    if replay_filter.rating_min is not None:
+        expression &= ds.field("rating") >= replay_filter.rating_min
+    if replay_filter.rating_max is not None:
+        expression &= ds.field("rating") < replay_filter.rating_max
+    return expression
+
+
+def read_appearances(
+    root: str,
+    replay_filter: ReplayFilter = ReplayFilter(),
+    columns: tuple = ("id", "player", "pokemon", "won"),
+) -> pd.DataFrame:
+    """
+    Reads the appearances matching replay_filter from the dataset.
+    Format, time and rating conditions are pushed down to the Parquet
+    scan; player and species conditions are applied afterwards, with
+    players matched case-insensitively as in ReplayFilter.compile.
+    """
+    dataset = open_dataset(root, "appearances")
+    columns = list(columns)
+    extra_columns = [c for c in ("id", "player", "pokemon") if c not in columns]
+    df = dataset.to_table(
+        columns=columns + extra_columns,
+        filter=_filter_expression(replay_filter),
+    ).to_pandas()
+    if replay_filter.player is not None:
+        ids = df.id[df.player.str.lower() == replay_filter.player.lower()].unique()
+        df = df[df.id.isin(ids)]
+    for species in replay_filter.species:
+        ids = df.id[df.pokemon == species].unique()
+        df = df[df.id.isin(ids)]
+    return df.loc[:, columns]
+
+
+def get_pair_win_rates(
+    root: str,
+    replay_filter: ReplayFilter = ReplayFilter(),
+) -> pd.DataFrame:
+    """
+    Computes the same marginal pair win rates as
+    sqlite.get_pair_marginal_win_rates_conditional, over the dataset.
+    Returns a DataFrame with columns p1, p2, players, appearances, wins
+    and win_rate, ordered by appearances.
+    """
+    df = read_appearances(root, replay_filter)
+    pairs = df.merge(df, on=["id", "player"], suffixes=("1", "2"))
+    pairs = pairs[pairs.pokemon1 < pairs.pokemon2]
+    result = pairs.groupby(by=["pokemon1", "pokemon2"]).agg(
+        players=("player", "nunique"),
+        appearances=("won1", "size"),
+        wins=("won1", "sum"),
+    ).reset_index().rename(columns={"pokemon1": "p1", "pokemon2": "p2"})
+    result["win_rate"] = result.wins / result.appearances
+    return result.sort_values(by="appearances", ascending=False, ignore_index=True)
+
+
+def get_usage(
+    root: str,
+    replay_filter: ReplayFilter = ReplayFilter(),
+) -> pd.DataFrame:
+    """
+    Computes how often each pokemon appeared in the dataset. Returns a
+    DataFrame with columns pokemon, appearances, wins, win_rate and usage,
+    the fraction of teams on which the pokemon appeared.
+    """
+    df = read_appearances(root, replay_filter)
+    num_teams = df.loc[:, ["id", "player"]].drop_duplicates().shape[0]
+    result = df.groupby(by="pokemon").agg(
+        appearances=("won", "size"),
+        wins=("won", "sum"),
+    ).reset_index()
+    result["win_rate"] = result.wins / result.appearances
+    result["usage"] = result.appearances / num_teams if num_teams else 0.0
+    return result.sort_values(by="appearances", ascending=False, ignore_index=True)
+
+
+WEEKLY_PAIR_WIN_RATES_SCHEMA = pa.schema([
+    ("p1", pa.string()),
+    ("p2", pa.string()),
+    ("pair", pa.string()),
+    ("players", pa.int64()),
+    ("appearances", pa.int64()),
+    ("wins", pa.int64()),
+    ("win_rate", pa.float64()),
+])
+
+WEEK_PARTITIONING = ds.partitioning(pa.schema([("week", pa.int32())]), flavor="hive")
+
+
+def update_weekly_pair_win_rates(
+    database_con: sqlite3.Connection,
+    root: str,
+    formats: Sequence[str] = (),
+    rating_min: Optional[int] = None,
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+) -> list:
+    """
+    Brings the weekly pair win rate dataset in the root directory up to
+    date, and returns the weeks that were written. The dataset holds the
+    marginal pair win rates (see get_pair_marginal_win_rates_conditional)
+    of each week, for replays in formats rated at least rating_min:
+
+        settings.json
+            the formats and rating_min the dataset was built with
+        coverage.json
+            the number of replays with appearances each week was computed from
+        weeks/week=.../part-0.parquet
+            p1, p2, pair, players, appearances, wins, win_rate
+        summary.parquet
+            per-pair statistics, see get_pair_summary
+
+    week is uploadtime // WEEK, as in the replays dataset. Only weeks that
+    are complete, i.e. the database holds replays uploaded before their
+    start and after their end, are written. A week already in the dataset
+    is only recomputed if the number of replays with appearances it
+    matches has changed since, e.g. after older replays were backfilled or
+    create_appearances_table caught up, so rerunning this after new
+    replays are downloaded only queries the new weeks. The summary is
+    rebuilt from the weekly rows whenever weeks are written.
+    """
+    settings = {"formats": sorted(formats), "rating_min": rating_min}
+    settings_path = os.path.join(root, "settings.json")
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            existing_settings = json.load(f)
+        if existing_settings != settings:
+            raise ValueError(f"{root} was built with {existing_settings}, not {settings}")
+    else:
+        os.makedirs(root, exist_ok=True)
+        with open(settings_path, "w") as f:
+            json.dump(settings, f)
+
+    replay_filter = ReplayFilter(formats=formats)
+    where, params = replay_filter.compile(appearances_table_name)
+    first_uploadtime, last_uploadtime = database_con.execute(
+        f"SELECT MIN(uploadtime), MAX(uploadtime) FROM {replay_table_name} {where}",
+        params,
+    ).fetchone()
+    if first_uploadtime is None:
+        return []
+    where, params = ReplayFilter(formats=formats, rating_min=rating_min).compile(appearances_table_name)
+    # Replays without appearances yet don't count, so their weeks are recomputed once they have them
+    parsed = f"id IN (SELECT id FROM {appearances_table_name})"
+    where = f"{where} AND {parsed}" if where else f"WHERE {parsed}"
+    coverage = {
+        week: num_replays for week, num_replays in database_con.execute(
+            f"SELECT uploadtime / {WEEK}, COUNT(*) FROM {replay_table_name} {where} GROUP BY 1",
+            params,
+        )
+    }
+    coverage_path = os.path.join(root, "coverage.json")
+    existing_coverage = {}
+    if os.path.exists(coverage_path):
+        with open(coverage_path) as f:
+            existing_coverage = {int(week): num_replays for week, num_replays in json.load(f).items()}
+    weeks_root = os.path.join(root, "weeks")
+    added_weeks = []
+    for week in range(int(first_uploadtime) // WEEK + 1, int(last_uploadtime) // WEEK):
+        if existing_coverage.get(week) == coverage.get(week, 0):
+            continue
+        week_filter = ReplayFilter(
+            formats=formats,
+            uploadtime_start=week * WEEK,
+            uploadtime_end=(week + 1) * WEEK,
+            rating_min=rating_min,
+        )
+        df = pd.DataFrame(
+            data=get_pair_marginal_win_rates_conditional(
+                database_con,
+                week_filter,
+                appearances_table_name=appearances_table_name,
+                replay_table_name=replay_table_name,
+            ),
+            columns=["p1", "p2", "players", "appearances", "wins", "win_rate"],
+        )
+        df["pair"] = df.p1 + ", " + df.p2
+        directory = os.path.join(weeks_root, f"week={week}")
+        os.makedirs(directory, exist_ok=True)
+        # Write then rename, so an interrupted update never leaves a partial week
+        # (dataset scans skip files starting with ".")
+        temporary_path = os.path.join(directory, ".part-0.parquet.tmp")
+        pq.write_table(
+            pa.Table.from_pandas(df, schema=WEEKLY_PAIR_WIN_RATES_SCHEMA, preserve_index=False),
+            temporary_path,
+        )
+        os.replace(temporary_path, os.path.join(directory, "part-0.parquet"))
+        added_weeks.append(week)
+        existing_coverage[week] = coverage.get(week, 0)
+    if added_weeks:
+        with open(coverage_path + ".tmp", "w") as f:
+            json.dump({str(week): num_replays for week, num_replays in sorted(existing_coverage.items())}, f)
+        os.replace(coverage_path + ".tmp", coverage_path)
+
+    summary_path = os.path.join(root, "summary.parquet")
+    if added_weeks or not os.path.exists(summary_path):
+        summary_df = get_pair_summary(read_weekly_pair_win_rates(root))
+        summary_df.to_parquet(summary_path + ".tmp")
+        os.replace(summary_path + ".tmp", summary_path)
+    return added_weeks
+
+
+def read_weekly_pair_win_rates(root: str) -> pd.DataFrame:
+    """
+    Reads the weekly pair win rate dataset written by
+    update_weekly_pair_win_rates, with the columns p1, p2, pair, players,
+    appearances, wins, win_rate and week. Weeks are numbered from 1 for the
+    first week in the dataset, and week_start holds the Unix timestamp at
+    which each week starts.
+    """
+    weeks_root = os.path.join(root, "weeks")
+    if not os.path.isdir(weeks_root):
+        return WEEKLY_PAIR_WIN_RATES_SCHEMA.empty_table().to_pandas().assign(week=0, week_start=0)
+    df = ds.dataset(
+        weeks_root,
+        format="parquet",
+        partitioning=WEEK_PARTITIONING,
+    ).to_table().to_pandas()
+    week = df.pop("week").astype("int64")
+    df["week_start"] = week * WEEK
+    df["week"] = week - week.min() + 1
+    return df
+
+
+def get_pair_summary(weekly_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summarizes the weekly win rates of each pair, indexed by pair, with
+    the columns:
+
+        weeks           the number of weeks the pair appeared in
+        appearances     total appearances
+        players         the sum of the weekly numbers of players
+        win_rate        the mean of the weekly win rates
+        sq_error_mean   the mean squared deviation of the weekly win rates
+                        from their mean, low for consistent pairs
+        sq_error_std    the standard deviation of those squared deviations
+        usage_quantile  the fraction of pairs with at most as many
+                        appearances
+
+    weekly_df has the columns of read_weekly_pair_win_rates.
+    """
+    mean_win_rate = weekly_df.groupby(by="pair").win_rate.transform("mean")
+    sq_error = (weekly_df.win_rate - mean_win_rate) ** 2
+    summary_df = weekly_df.assign(sq_error=sq_error).groupby(by="pair").agg(
+        weeks=("week", "count"),
+        appearances=("appearances", "sum"),
+        players=("players", "sum"),
+        win_rate=("win_rate", "mean"),
+        sq_error_mean=("sq_error", "mean"),
+        sq_error_std=("sq_error", "std"),
+    )
+    summary_df["usage_quantile"] = summary_df.appearances.rank(method="max", pct=True)
+    return summary_df
+
+
+def read_pair_summary(root: str) -> pd.DataFrame:
+    """
+    Reads the per-pair summary written by update_weekly_pair_win_rates.
+    """
+    return pd.read_parquet(os.path.join(root, "summary.parquet"))
@@ -0,0 +1,394 @@
+"""
+Loading and analytics shared by the pages of the report card app.
+
+Data is loaded by a ReportLoadJob, which refreshes the user's store (see
+user_store) on a background thread. Each page calls poll_report_load at
+the start of a run to pick up whatever has been stored so far, and reruns
+itself while the job is running, so reports fill in as replays arrive.
+
+The pages read one ReportCardAnalytics object per session, through
+get_report_card_analytics, instead of each building its own database or
+re-aggregating its frames on every rerun. The object is only rebuilt when
+the loaded data or the selection of replays changes.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+from typing import Callable, MutableMapping, Optional
+
+from pokemon_showdown_replay_tools import user_store
+from pokemon_showdown_replay_tools.analysis import get_species_matrices
+from pokemon_showdown_replay_tools.sqlite import ReplayFilter, get_pair_marginal_win_rates_conditional
+
+
+# Session state keys holding the loaded data
+SESSION_DATA_KEYS = (
+    'search_df',
+    'replays_df',
+    'appearances_df',
+    'moves_df',
+    'species_matrices',
+    'selection_mask',
+    'report_card_analytics',
+    'report_load_state',
+)
+
+
+class ReportLoadJob:
+    """
+    Refreshes a user's store for replays uploaded between start and end on
+    a background thread. The thread only writes to the store and to this
+    object's counters, never to the session, which it can't safely touch;
+    poll_report_load reads the store from the script thread instead.
+    The rating and include_unrated settings are applied when loading.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        username: str,
+        start: int,
+        end: int,
+        rating_min: int,
+        rating_max: int,
+        include_unrated: bool,
+    ):
+        self.directory = directory
+        self.username = username
+        self.start = start
+        self.end = end
+        self.rating_min = rating_min
+        self.rating_max = rating_max
+        self.include_unrated = include_unrated
+        self.downloaded = 0
+        self.total = 0
+        self.stored = 0
+        self.error: Optional[Exception] = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def start_thread(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Asks the thread to stop before its next chunk of downloads, and
+        waits until it has.
+        """
+        self._stop_event.set()
+        if self._thread.ident is not None:
+            self._thread.join()
+
+    def _on_progress(self, completed: int, total: int):
+        self.downloaded, self.total = completed, total
+
+    def _on_stored(self, stored: int):
+        self.stored = stored
+
+    def _run(self):
+        con = user_store.open_user_store(self.directory, self.username)
+        try:
+            user_store.refresh_user_store(
+                con,
+                self.username,
+                self.start,
+                self.end,
+                progress_callback=self._on_progress,
+                stored_callback=self._on_stored,
+                should_stop=self._stop_event.is_set,
+            )
+        except Exception as e:
+            self.error = e
+        finally:
+            con.close()
+
+
+def load_report_data(session_state: MutableMapping, job: ReportLoadJob, pending: bool = False) -> bool:
+    """
+    Loads the replays of job's user and range from the store into
+    session_state, as the frames the pages read: search_df, replays_df,
+    appearances_df, moves_df and species_matrices. If pending is set,
+    replays that haven't been downloaded yet are left out rather than
+    reported as errors. The selection of replays that were already loaded
+    is kept, and new replays are selected. Returns False if there is no
+    data to load.
+    """
+    con = user_store.open_user_store(job.directory, job.username)
+    try:
+        search_df = user_store.load_user_replays(con, job.start, job.end)
+        appearances_df = user_store.load_user_appearances(con, job.username, job.start, job.end)
+        moves_df = user_store.load_user_moves(con, job.username, job.start, job.end)
+    finally:
+        con.close()
+    
+    ratings = pd.to_numeric(search_df.rating)
+    rated_mask = ratings.notna()
+    rating_mask = (job.rating_min <= ratings) & (ratings <= job.rating_max)
+    search_df = search_df[(job.include_unrated & ~rated_mask) | (rated_mask & rating_mask)]
+    if pending:
+        search_df = search_df[search_df.downloaded.astype(bool)]
+    search_df = search_df.drop(columns='downloaded')
+    if search_df.empty:
+        return False
+    
+    replays_df = search_df[search_df.parsed.astype(bool)].drop(columns='parsed')
+    replays_df.index = pd.Index(replays_df.id.values, name='id')
+    session_state['replays_df'] = replays_df
+    session_state['appearances_df'] = appearances_df[appearances_df.id.isin(search_df.id)]
+    session_state['moves_df'] = moves_df[moves_df.id.isin(search_df.id)]
+    
+    search_df = search_df.copy()
+    search_df['parse error'] = ~search_df.pop('parsed').astype(bool)
+    search_df['players'] = search_df['players'].str.split(',')
+    search_df['uploadtime'] = search_df['uploadtime'].apply(datetime.fromtimestamp)
+    search_df['replay_link'] = search_df.id.apply(lambda x: f"https://replay.pokemonshowdown.com/{x}")
+    search_df = search_df.reset_index(drop=True)
+    previous_df = session_state.get('search_df')
+    if previous_df is not None and 'selection_mask' in session_state:
+        selected = dict(zip(previous_df.id, np.asarray(session_state['selection_mask'], dtype=bool)))
+        session_state['selection_mask'] = search_df.id.map(selected).fillna(True).astype(bool).to_numpy()
+    else:
+        session_state['selection_mask'] = np.ones(search_df.shape[0], dtype='bool')
+    session_state['search_df'] = search_df
+    session_state['data_version'] = time.time()
+    # Built once per load, so the pokemon filters are cheap on every rerun
+    session_state['species_matrices'] = get_species_matrices(appearances_df, search_df.id)
+    return True
+
+
+def start_report_load(session_state: MutableMapping, job: ReportLoadJob):
+    """
+    Stops the session's previous ReportLoadJob, if any, so that two jobs
+    never write to a store at once, then clears the loaded data from
+    session_state and starts job.
+    """
+    previous_job = session_state.get('report_load_job')
+    if previous_job is not None:
+        previous_job.stop()
+    for key in SESSION_DATA_KEYS:
+        if key in session_state:
+            del session_state[key]
+    session_state['report_load_job'] = job
+    job.start_thread()
+
+
+def poll_report_load(session_state: MutableMapping) -> bool:
+    """
+    Loads whatever the session's ReportLoadJob has stored since the last
+    poll into session_state. Returns True while the job is running, in
+    which case the caller should rerun shortly to pick up more data.
+    """
+    job = session_state.get('report_load_job')
+    if job is None:
+        return False
+    # Read before loading, so the final poll always sees the finished store
+    running = job.running
+    state = (job.stored, running)
+    if session_state.get('report_load_state') != state:
+        load_report_data(session_state, job, pending=running)
+        session_state['report_load_state'] = state
+    return running
+
+
+def wait_for_report_data(session_state: MutableMapping) -> bool:
+    """
+    Starts a page of the app that needs loaded data: polls the session's
+    ReportLoadJob (see poll_report_load) and, if nothing has been loaded
+    yet, stops the page, rerunning it shortly while the job is running.
+    Returns whether the job is running, for rerun_while_loading.
+    """
+    # Imported here so the rest of this module can be used without streamlit
+    import streamlit as st
+    loading = poll_report_load(session_state)
+    if session_state.get('search_df') is None:
+        if loading:
+            st.info("Loading data...")
+            time.sleep(1)
+            st.rerun()
+        st.warning("Load some data first")
+        st.stop()
+    return loading
+
+
+def rerun_while_loading(loading: bool):
+    """
+    Ends a page of the app: if the session's ReportLoadJob is running,
+    reruns the page shortly to pick up the replays stored in the meantime.
+    """
+    import streamlit as st
+    if loading:
+        time.sleep(1)
+        st.rerun()
+
+
+class ReportCardAnalytics:
+    """
+    Pair win rates and move usage over the selected replays of a report
+    card. Each statistic is computed on first access and memoized, and the
+    in-memory database behind them is built once, so reruns that only
+    change a plot don't recompute anything. Methods may be called from any
+    thread.
+
+    replays_df holds the selected replays (id, format, players, uploadtime,
+    rating) and appearances_df the user's appearances (id, player, pokemon,
+    won, appearance_order), as stored in the session by Load_Data.
+    moves_df holds the user's moves (id, pokemon, move, order).
+    """
+
+    def __init__(
+        self,
+        replays_df: pd.DataFrame,
+        appearances_df: pd.DataFrame,
+        fingerprint: tuple = (),
+        moves_df: Optional[pd.DataFrame] = None,
+    ):
+        self.replays_df = replays_df
+        self.appearances_df = appearances_df
+        self.moves_df = moves_df
+        self.fingerprint = fingerprint
+        self._con = None
+        self._results = {}
+        self._lock = threading.RLock()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._con is None:
+            con = sqlite3.connect(':memory:', check_same_thread=False)
+            self.replays_df.loc[:, ['format', 'players', 'uploadtime', 'rating']].to_sql('replays', con)
+            appearances_df = self.appearances_df.loc[:, ['id', 'player', 'pokemon', 'won']]
+            appearances_df.drop_duplicates().to_sql('appearances', con)
+            # Leads are the first two pokemon the user sent out, whichever side they played
+            first_appearances = self.appearances_df.groupby(by=['id', 'player'], observed=True).appearance_order
+            lead_mask = first_appearances.rank(method='first') <= 2
+            appearances_df[lead_mask].to_sql('lead_appearances', con)
+            for table_name in ('appearances', 'lead_appearances'):
+                con.execute(f"""
+                    CREATE INDEX IF NOT EXISTS {table_name}_marginal_idx ON {table_name}(id, player, pokemon)
+                """)
+            con.commit()
+            self._con = con
+        return self._con
+
+    def _memoize(self, key: tuple, compute: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        with self._lock:
+            if key not in self._results:
+                self._results[key] = compute()
+            return self._results[key]
+
+    def get_pair_win_rates(self, leads: bool = False) -> pd.DataFrame:
+        """
+        Returns the marginal win rate of every pair the user brought (or
+        led with, if leads is set), with the columns pokemon1, pokemon2,
+        appearances, win and Win %.
+        """
+        def compute():
+            table_name = 'lead_appearances' if leads else 'appearances'
+            win_rates_df = pd.DataFrame(
+                data=get_pair_marginal_win_rates_conditional(
+                    self._get_connection(), appearances_table_name=table_name),
+                columns=['pokemon1', 'pokemon2', 'players', 'appearances', 'win', 'Win %'],
+            )
+            del win_rates_df['players']
+            win_rates_df['Win %'] *= 100
+            return win_rates_df
+
+        return self._memoize(('pair_win_rates', leads), compute)
+
+    def get_daily_pair_win_rates(self, leads: bool = False) -> pd.DataFrame:
+        """
+        Returns the marginal win rates of pairs per day and format, with the
+        columns p1, p2, players, appearances, wins, Win %, pair, day and
+        format.
+        """
+        columns = ["p1", "p2", "players", "appearances", "wins", "Win %", "pair", "day", "format"]
+
+        def compute():
+            replays_df = self.replays_df
+            if replays_df.empty:
+                # e.g. every replay is deselected, or none has been parsed yet
+                return pd.DataFrame(columns=columns)
+            con = self._get_connection()
+            table_name = 'lead_appearances' if leads else 'appearances'
+            ymd = replays_df.uploadtime.apply(datetime.fromtimestamp).dt.strftime("%Y/%m/%d")
+            dfs = []
+            for label, group_df in replays_df.groupby(by=[ymd, "format"]):
+                format = label[1]
+                day_start, day_end = group_df.uploadtime.min(), group_df.uploadtime.max()
+                where = ReplayFilter(formats=(format,), uploadtime_start=day_start, uploadtime_end=day_end + 1)
+                marginal_df = pd.DataFrame(
+                    data=get_pair_marginal_win_rates_conditional(con, where, appearances_table_name=table_name),
+                    columns=["p1", "p2", "players", "appearances", "wins", "Win %"],
+                )
+                marginal_df["Win %"] *= 100
+                marginal_df['pair'] = marginal_df.p1 + ", " + marginal_df.p2
+                marginal_df['day'] = datetime.fromtimestamp(day_start)
+                marginal_df['format'] = format
+                dfs.append(marginal_df)
+            return pd.concat(dfs, ignore_index=True)
+
+        return self._memoize(('daily_pair_win_rates', leads), compute)
+
+    def get_move_usage(self, by: str = "pokemon") -> pd.DataFrame:
+        """
+        Returns how often the user used each move. With by="pokemon", there
+        is a row per pokemon and move, with the columns pokemon, move,
+        times used, games used and percent used (the share of the pokemon's
+        move uses), ordered by pokemon and percent used. With by="move",
+        the rows are indexed by move, with the columns times used, games
+        used and pokemon used, ordered by times used.
+        """
+        def compute():
+            moves_df = self.moves_df[self.moves_df.id.isin(self.replays_df.id)]
+            if by == "pokemon":
+                df = moves_df.groupby(by=['pokemon', 'move'], observed=True).agg(**{
+                    'times used': ('id', 'size'),
+                    'games used': ('id', 'nunique'),
+                })
+                pokemon_uses = df.groupby(level='pokemon', observed=True)['times used'].transform('sum')
+                df['percent used'] = df['times used'] / pokemon_uses * 100
+                return df.reset_index().sort_values(by=['pokemon', 'percent used'], ascending=(True, False))
+            if by == "move":
+                df = moves_df.groupby(by='move', observed=True).agg(**{
+                    'times used': ('id', 'size'),
+                    'games used': ('id', 'nunique'),
+                    'pokemon used': ('pokemon', 'nunique'),
+                })
+                return df.sort_values(by='times used', ascending=False)
+            raise ValueError(f"Unknown grouping {by!r}, expected 'pokemon' or 'move'")
+
+        return self._memoize(('move_usage', by), compute)
+
+
+def get_report_card_analytics(session_state: MutableMapping) -> ReportCardAnalytics:
+    """
+    Returns the session's ReportCardAnalytics for the loaded data and the
+    current selection_mask, reusing the one stored in session_state if
+    neither has changed since it was built. Load_Data sets data_version
+    whenever it loads data.
+    """
+    search_df = session_state['search_df']
+    selection_mask = session_state['selection_mask']
+    fingerprint = (
+        session_state.get('data_version'),
+        hashlib.sha1(np.asarray(selection_mask, dtype=bool).tobytes()).hexdigest(),
+    )
+    analytics = session_state.get('report_card_analytics')
+    if analytics is None or analytics.fingerprint != fingerprint:
+        replays_df = session_state['replays_df']
+        replays_df = replays_df[replays_df.id.isin(search_df[selection_mask].id)]
+        analytics = ReportCardAnalytics(
+            replays_df,
+            session_state['appearances_df'],
+            fingerprint,
+            session_state.get('moves_df'),
+        )
+        session_state['report_card_analytics'] = analytics
+    return analytics
@@ -0,0 +1,264 @@
+"""
+Functions to split replays across several SQLite databases (shards),
+one per format and month, and to query them in parallel.
+
+A shard directory holds the shards as {format}/{YYYY-MM}.db, each with
+its own replays and appearances tables (as in sqlite.py), plus a
+catalog.db describing them:
+
+    CREATE TABLE shards (
+        path TEXT PRIMARY KEY,
+        format TEXT NOT NULL,
+        month TEXT NOT NULL,
+        min_uploadtime INTEGER,
+        max_uploadtime INTEGER,
+        min_rating INTEGER,
+        max_rating INTEGER,
+        num_replays INTEGER NOT NULL)
+
+Shards can be written independently, and queries only open the shards
+whose catalog entry can match the filter.
+"""
+import os
+import sqlite3
+import time
+import urllib.parse
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Optional
+
+from pokemon_showdown_replay_tools.compression import DICTIONARY_TABLE_NAME, LogDecompressor, create_dictionary_table
+from pokemon_showdown_replay_tools.sqlite import (
+    RATING_SQL,
+    ReplayFilter,
+    create_replay_indexes,
+    get_pair_marginal_win_rates_conditional,
+    index_replay_appearances,
+)
+
+
+CATALOG_NAME = "catalog.db"
+
+
+def _connect_catalog(directory: str) -> sqlite3.Connection:
+    con = sqlite3.connect(os.path.join(directory, CATALOG_NAME))
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS shards (
+        path TEXT PRIMARY KEY,
+        format TEXT NOT NULL,
+        month TEXT NOT NULL,
+        min_uploadtime INTEGER,
+        max_uploadtime INTEGER,
+        min_rating INTEGER,
+        max_rating INTEGER,
+        num_replays INTEGER NOT NULL)
+    """)
+    return con
+
+
+def _connect_shard(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    con = sqlite3.connect(path)
+    con.execute("""CREATE TABLE IF NOT EXISTS replays (
+                   id TEXT PRIMARY KEY ON CONFLICT IGNORE,
+                   format TEXT NOT NULL,
+                   players TEXT NOT NULL,
+                   log TEXT NOT NULL,
+                   uploadtime INTEGER NOT NULL,
+                   rating INTEGER)""")
+    return con
+
+
+def get_shard_path(directory: str, format: str, uploadtime: int) -> str:
+    month = time.strftime("%Y-%m", time.gmtime(uploadtime))
+    return os.path.join(directory, format, f"{month}.db")
+
+
+def _insert_into_shards(directory: str, rows: Iterable[tuple], dictionaries: list = ()) -> set:
+    by_shard = {}
+    for row in rows:
+        path = get_shard_path(directory, row[1], row[4])
+        by_shard.setdefault(path, []).append(row)
+    for path, shard_rows in by_shard.items():
+        con = _connect_shard(path)
+        try:
+            if dictionaries:
+                # Compressed logs can only be read with the dictionaries they were compressed with
+                create_dictionary_table(con)
+                con.executemany(f"INSERT OR IGNORE INTO {DICTIONARY_TABLE_NAME} VALUES(?, ?, ?)", dictionaries)
+            # Only replays that weren't already in the shard need their appearances parsed
+            new_rows = [row for row in shard_rows
+                        if con.execute("INSERT INTO replays VALUES(?, ?, ?, ?, ?, ?)", row).rowcount]
+            decompressor = LogDecompressor(con)
+            index_replay_appearances(con, [(row[0], decompressor.decompress(row[3])) for row in new_rows])
+        finally:
+            con.close()
+    return set(by_shard)
+
+
+def write_replays_to_shards(directory: str, rows: Iterable[tuple], dictionaries: list = ()) -> set:
+    """
+    Writes replays, given as (id, format, players, log, uploadtime, rating)
+    tuples, to their shards and updates the catalog. The appearances of the
+    new replays are added to their shards. Returns the paths of those shards.
+    If logs are compressed, pass the rows of the log_dictionaries table
+    they were compressed with as dictionaries.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = _insert_into_shards(directory, rows, dictionaries)
+    update_catalog(directory, paths)
+    return paths
+
+
+def update_catalog(directory: str, paths: Iterable[str]):
+    """
+    Refreshes the catalog entries of the given shards and creates the
+    indexes that ReplayFilter queries use on them if necessary.
+    """
+    catalog_con = _connect_catalog(directory)
+    try:
+        for path in paths:
+            con = sqlite3.connect(path)
+            try:
+                create_replay_indexes(con)
+                format, month = os.path.basename(os.path.dirname(path)), os.path.basename(path)[:-len(".db")]
+                stats = con.execute(f"""
+                    SELECT MIN(uploadtime), MAX(uploadtime), MIN({RATING_SQL}), MAX({RATING_SQL}), COUNT(*)
+                    FROM replays
+                """).fetchone()
+            finally:
+                con.close()
+            catalog_con.execute(
+                "INSERT OR REPLACE INTO shards VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                (os.path.relpath(path, directory), format, month) + stats,
+            )
+        catalog_con.commit()
+    finally:
+        catalog_con.close()
+
+
+def create_shards(
+    database_con: sqlite3.Connection,
+    directory: str,
+    replay_table_name: str = "replays",
+    batch_size: int = 10_000,
+):
+    """
+    Copies the replays of a single database into shards in directory.
+    Replays that are already in a shard are skipped.
+    """
+    os.makedirs(directory, exist_ok=True)
+    cur = database_con.cursor()
+    try:
+        dictionaries = cur.execute(f"SELECT * FROM {DICTIONARY_TABLE_NAME}").fetchall()
+    except sqlite3.OperationalError:
+        dictionaries = []
+    cur.execute(f"SELECT id, format, players, log, uploadtime, rating FROM {replay_table_name}")
+    touched = set()
+    batch = cur.fetchmany(batch_size)
+    while batch:
+        touched.update(_insert_into_shards(directory, batch, dictionaries))
+        batch = cur.fetchmany(batch_size)
+    update_catalog(directory, touched)
+
+
+def get_shards(directory: str, replay_filter: Optional[ReplayFilter] = None) -> list:
+    """
+    Returns the paths of the shards that may contain replays matching
+    replay_filter, using only the catalog. Shards whose format, time range
+    or rating range can't match are pruned without being opened.
+    """
+    where = []
+    params = []
+    if replay_filter is not None:
+        if replay_filter.formats:
+            where.append(f"format IN ({', '.join('?' for _ in replay_filter.formats)})")
+            params.extend(replay_filter.formats)
+        if replay_filter.uploadtime_start is not None:
+            where.append("max_uploadtime >= ?")
+            params.append(replay_filter.uploadtime_start)
+        if replay_filter.uploadtime_end is not None:
+            where.append("min_uploadtime < ?")
+            params.append(replay_filter.uploadtime_end)
+        if replay_filter.rating_min is not None:
+            where.append("max_rating >= ?")
+            params.append(replay_filter.rating_min)
+        if replay_filter.rating_max is not None:
+            where.append("min_rating < ?")
+            params.append(replay_filter.rating_max)
+    where = ("WHERE " + " AND ".join(where)) if where else ""
+    con = _connect_catalog(directory)
+    try:
+        rows = con.execute(f"SELECT path FROM shards {where} ORDER BY path", params).fetchall()
+    finally:
+        con.close()
+    return [os.path.join(directory, path) for (path,) in rows]
+
+
+def _get_shard_pair_win_rates(path: str, replay_filter: ReplayFilter):
+    con = sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro", uri=True)
+    try:
+        return get_pair_marginal_win_rates_conditional(con, replay_filter)
+    finally:
+        con.close()
+
+
+def get_pair_marginal_win_rates_sharded(
+    directory: str,
+    replay_filter: ReplayFilter = ReplayFilter(),
+    max_workers: Optional[int] = None,
+):
+    """
+    Computes get_pair_marginal_win_rates_conditional over all the shards
+    that may match replay_filter, one shard per worker process, and merges
+    the partial results. Rows have the same shape as the unsharded query.
+
+    Appearances and wins add up exactly across shards. The players column
+    is summed too, so a player who used a pair in several shards (e.g. in
+    two different months) is counted once per shard.
+    """
+    paths = get_shards(directory, replay_filter)
+    if len(paths) <= 1:
+        partials = [_get_shard_pair_win_rates(path, replay_filter) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            partials = list(pool.map(_get_shard_pair_win_rates, paths, [replay_filter] * len(paths)))
+    merged = {}
+    for partial in partials:
+        for p1, p2, players, appearances, wins, _ in partial:
+            totals = merged.setdefault((p1, p2), [0, 0, 0])
+            totals[0] += players
+            totals[1] += appearances
+            totals[2] += wins
+    results = [
+        (p1, p2, players, appearances, wins, 1.0 * wins / appearances)
+        for (p1, p2), (players, appearances, wins) in merged.items()
+    ]
+    results.sort(key=lambda r: r[3], reverse=True)
+    return results
+
+
+def attach_shards(
+    database_con: sqlite3.Connection,
+    directory: str,
+    replay_filter: Optional[ReplayFilter] = None,
+):
+    """
+    Attaches the shards matching replay_filter to database_con and creates
+    the temporary views all_replays and all_appearances over them, for
+    ad-hoc queries across shards. SQLite limits the number of attached
+    databases (10 by default), so prune with a filter where possible.
+    Returns the names of the attached schemas.
+    """
+    paths = get_shards(directory, replay_filter)
+    schemas = []
+    for i, path in enumerate(paths):
+        schema = f"shard_{i}"
+        database_con.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+        schemas.append(schema)
+    for view, table in (("all_replays", "replays"), ("all_appearances", "appearances")):
+        database_con.execute(f"DROP VIEW IF EXISTS temp.{view}")
+        if schemas:
+            union = " UNION ALL ".join(f"SELECT * FROM {schema}.{table}" for schema in schemas)
+            database_con.execute(f"CREATE TEMP VIEW {view} AS {union}")
+    return schemas
@@ -0,0 +1,178 @@
+"""
+Functions to snapshot the appearances table into integer-encoded NumPy
+arrays, which load instantly with memory mapping.
+
+A snapshot is a directory holding one .npy file per column plus a
+vocabulary sidecar:
+
+    replay_idx.npy   int32, index into replay_ids.npy
+    player_idx.npy   int32, index into vocab.json "players"
+    species_idx.npy  int16, index into vocab.json "species"
+    won.npy          int8
+    uploadtime.npy   int64
+    rating.npy       int16, -1 for unrated replays
+    format_idx.npy   int16, index into vocab.json "formats"
+    replay_ids.npy   bytes, replay ids ordered by uploadtime
+    vocab.json
+
+Rows are ordered by uploadtime, so replay_idx increases with time.
+Because the arrays are memory-mapped read-only, concurrent processes
+that load the same snapshot share the operating system's page cache.
+"""
+import json
+import os
+import shutil
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from typing import Optional
+
+
+COLUMN_DTYPES = {
+    "replay_idx": np.int32,
+    "player_idx": np.int32,
+    "species_idx": np.int16,
+    "won": np.int8,
+    "uploadtime": np.int64,
+    "rating": np.int16,
+    "format_idx": np.int16,
+}
+
+
+def write_appearances_snapshot(
+    database_con: sqlite3.Connection,
+    directory: str,
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+    batch_size: int = 100_000,
+):
+    """
+    Writes a snapshot of the appearances table, joined with the replay
+    metadata, to directory (replacing any previous snapshot there).
+    Rows are streamed from SQLite into memory-mapped output files, so
+    memory use is bounded by the vocabularies rather than the table.
+    """
+    cur = database_con.cursor()
+    replay_ids = [row[0] for row in cur.execute(f"""
+        SELECT id FROM {replay_table_name}
+        WHERE id IN (SELECT id FROM {appearances_table_name})
+        ORDER BY uploadtime, id
+    """)]
+    players = [row[0] for row in cur.execute(
+        f"SELECT DISTINCT player FROM {appearances_table_name} ORDER BY player")]
+    species = [row[0] for row in cur.execute(
+        f"SELECT DISTINCT pokemon FROM {appearances_table_name} ORDER BY pokemon")]
+    formats = [row[0] for row in cur.execute(
+        f"SELECT DISTINCT format FROM {replay_table_name} ORDER BY format")]
+    (num_rows,) = cur.execute(f"""
+        SELECT COUNT(*) FROM {appearances_table_name} AS a
+        JOIN {replay_table_name} AS r ON r.id = a.id
+    """).fetchone()
+
+    # Write to a sibling directory first, so readers never see a partial snapshot
+    tmp_directory = f"{directory.rstrip(os.sep)}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    ids = np.array(replay_ids, dtype=bytes) if replay_ids else np.zeros(0, dtype="S1")
+    np.save(os.path.join(tmp_directory, "replay_ids.npy"), ids)
+    with open(os.path.join(tmp_directory, "vocab.json"), "w") as f:
+        json.dump({
+            "num_rows": num_rows,
+            "players": players,
+            "species": species,
+            "formats": formats,
+        }, f)
+
+    columns = {
+        name: np.lib.format.open_memmap(
+            os.path.join(tmp_directory, f"{name}.npy"),
+            mode="w+",
+            dtype=dtype,
+            shape=(num_rows,),
+        )
+        for name, dtype in COLUMN_DTYPES.items()
+    }
+    replay_lookup = {replay_id: i for i, replay_id in enumerate(replay_ids)}
+    player_lookup = {name: i for i, name in enumerate(players)}
+    species_lookup = {name: i for i, name in enumerate(species)}
+    format_lookup = {name: i for i, name in enumerate(formats)}
+
+    cur.execute(f"""
+        SELECT a.id, a.player, a.pokemon, a.won, r.uploadtime, r.rating, r.format
+        FROM {appearances_table_name} AS a
+        JOIN {replay_table_name} AS r ON r.id = a.id
+        ORDER BY r.uploadtime, a.id
+    """)
+    offset = 0
+    batch = cur.fetchmany(batch_size)
+    while batch:
+        end = offset + len(batch)
+        replay_col, player_col, species_col, won_col, time_col, rating_col, format_col = zip(*batch)
+        columns["replay_idx"][offset:end] = [replay_lookup[x] for x in replay_col]
+        columns["player_idx"][offset:end] = [player_lookup[x] for x in player_col]
+        columns["species_idx"][offset:end] = [species_lookup[x] for x in species_col]
+        columns["won"][offset:end] = won_col
+        columns["uploadtime"][offset:end] = time_col
+        columns["rating"][offset:end] = [r if isinstance(r, int) else -1 for r in rating_col]
+        columns["format_idx"][offset:end] = [format_lookup[x] for x in format_col]
+        offset = end
+        batch = cur.fetchmany(batch_size)
+    for column in columns.values():
+        column.flush()
+    del columns
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+
+class AppearancesSnapshot:
+    """
+    A loaded snapshot. Each column is available as a read-only
+    memory-mapped array attribute (e.g. snapshot.species_idx), and the
+    vocabularies as lists (snapshot.players, snapshot.species,
+    snapshot.formats) plus the replay_ids array.
+    """
+
+    def __init__(self, directory: str, mmap_mode: Optional[str] = "r"):
+        self.directory = directory
+        with open(os.path.join(directory, "vocab.json")) as f:
+            vocab = json.load(f)
+        self.num_rows = vocab["num_rows"]
+        self.players = vocab["players"]
+        self.species = vocab["species"]
+        self.formats = vocab["formats"]
+        self.replay_ids = np.load(os.path.join(directory, "replay_ids.npy"), mmap_mode=mmap_mode)
+        for name in COLUMN_DTYPES:
+            setattr(self, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode))
+
+    def __len__(self):
+        return self.num_rows
+
+    def to_dataframe(self, mask: Optional[np.ndarray] = None) -> pd.DataFrame:
+        """
+        Returns the snapshot (or the rows selected by a boolean mask) as a
+        DataFrame. Players, species and formats become categoricals that
+        share the snapshot's vocabularies, so no strings are materialized.
+        """
+        def column(name):
+            values = getattr(self, name)
+            return values[mask] if mask is not None else np.asarray(values)
+
+        return pd.DataFrame({
+            "replay_idx": column("replay_idx"),
+            "player": pd.Categorical.from_codes(column("player_idx"), self.players),
+            "pokemon": pd.Categorical.from_codes(column("species_idx"), self.species),
+            "won": column("won"),
+            "uploadtime": column("uploadtime"),
+            "rating": column("rating"),
+            "format": pd.Categorical.from_codes(column("format_idx"), self.formats),
+        })
+
+
+def load_appearances_snapshot(directory: str, mmap_mode: Optional[str] = "r") -> AppearancesSnapshot:
+    """
+    Opens a snapshot written by write_appearances_snapshot. With the default
+    mmap_mode nothing is read until the arrays are used.
+    """
+    return AppearancesSnapshot(directory, mmap_mode)
@@ -18,13 +18,30 @@ The replays table definition:
         uploadtime INTEGER NOT NULL,
         rating INTEGER)
 
+The log column may also hold zstd-compressed BLOBs, see compression.py.
+Functions here that read logs decompress them transparently.
+
 """
+import bisect
+import hashlib
+import itertools
+import math
+import os
+import pickle
+import re
 import sqlite3
+import threading
+import urllib.parse
+import numpy as np
 import pandas as pd
 
-from typing import Optional
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import Callable, Optional, Sequence, Tuple, Union
 
-from pokemon_showdown_replay_tools.analysis import parse_replay
+from pokemon_showdown_replay_tools.analysis import parse_events, parse_replay
+from pokemon_showdown_replay_tools.compression import LogDecompressor
 
 
 def create_appearances_table(
@@ -42,6 +59,9 @@ def create_appearances_table(
     back. Thus, if a lead pair wins then the other two pokemon on that
     side will be unknown.
     
+    If the table already exists, only the replays that have no rows in it
+    yet are parsed, so it can be rerun after new replays are downloaded.
+    
     The table is defined by the following SQLite statement:
     
         CREATE TABLE appearances (
@@ -53,9 +73,20 @@ def create_appearances_table(
         CONSTRAINT one_poke_per_player_per_game UNIQUE(id, player, pokemon) ON CONFLICT IGNORE)
     
     """
+    _create_appearances_table(database_con, appearances_table_name, replay_table_name)
+    where = f"WHERE id NOT IN (SELECT id FROM {appearances_table_name})"
+    for batch in iter_replay_logs(database_con, replay_table_name, where=where):
+        index_replay_appearances(database_con, batch, appearances_table_name, replay_table_name)
+
+
+def _create_appearances_table(
+    database_con: sqlite3.Connection,
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+):
     cur = database_con.cursor()
     cur.execute(f"""
-        CREATE TABLE {appearances_table_name} (
+        CREATE TABLE IF NOT EXISTS {appearances_table_name} (
         id TEXT NOT NULL,
         player TEXT NOT NULL,
         pokemon TEXT NOT NULL,
@@ -63,41 +94,333 @@ def create_appearances_table(
         FOREIGN KEY(id) REFERENCES {replay_table_name}(id)
         CONSTRAINT one_poke_per_player_per_game UNIQUE(id, player, pokemon) ON CONFLICT IGNORE)
     """)
+
+
+def index_replay_appearances(
+    database_con: sqlite3.Connection,
+    replays: Sequence[Tuple[str, str]],
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+):
+    """
+    Adds the pokemon appearances of the given (id, log) pairs, with
+    uncompressed logs, to the appearances table, creating it if necessary.
+    """
+    _create_appearances_table(database_con, appearances_table_name, replay_table_name)
+    data = []
+    for replay_id, log in replays:
+        # parsed_replay is a nested dictionary of info about the replay
+        # For details see parse_replay in analysis.py
+        parsed_replay = parse_replay(log)
+        for pokemon_appearance in parsed_replay['pokemon']:
+            data.append([
+                replay_id,
+                pokemon_appearance['player'],
+                pokemon_appearance['name'],
+                1 if pokemon_appearance['player'] == parsed_replay['winner'] else 0,
+            ])
+    if data:
+        database_con.executemany(f"INSERT INTO {appearances_table_name} VALUES(?, ?, ?, ?)", data)
+    database_con.commit()
+
+
+def iter_replay_logs(
+    database_con: sqlite3.Connection,
+    replay_table_name: str = "replays",
+    batch_size: int = 10_000,
+    where: str = '',
+    params: Sequence = (),
+):
+    """
+    Yields batches of (id, log) tuples from the replays table, optionally
+    filtered by a WHERE clause. Compressed logs are decompressed.
+    """
+    decompressor = LogDecompressor(database_con)
     batch_cur = database_con.cursor()
-    batch_cur.execute("SELECT id, log FROM replays")
-    BATCH_SIZE = 10_000
-    batch = batch_cur.fetchmany(BATCH_SIZE)
+    batch_cur.execute(f"SELECT id, log FROM {replay_table_name} {where}", params)
+    batch = batch_cur.fetchmany(batch_size)
     while batch:
-        parsed_replays = [parse_replay(replay) for (replay_id, replay) in batch]
-        ids = [replay_id for (replay_id, replay) in batch]
-        data = []
-        for replay_id, parsed_replay in zip(ids, parsed_replays):
-            # parsed_replay is a nested dictionary of info about the replay
-            # For details see parse_replay in analysis.py
-            for pokemon_appearance in parsed_replay['pokemon']:
-                data.append([
-                    replay_id,
-                    pokemon_appearance['player'],
-                    pokemon_appearance['name'],
-                    1 if pokemon_appearance['player'] == parsed_replay['winner'] else 0,
-                ])
-        if data:
-            cur.executemany(f"INSERT INTO {appearances_table_name} VALUES(?, ?, ?, ?)", data)
-        batch = batch_cur.fetchmany(BATCH_SIZE)
+        yield [(replay_id, decompressor.decompress(log)) for (replay_id, log) in batch]
+        batch = batch_cur.fetchmany(batch_size)
+
+
+# Some populate scripts stored missing ratings as the string "null", which
+# SQLite orders after every number, so only integer ratings are ratings.
+RATING_SQL = "CASE WHEN typeof(rating) = 'integer' THEN rating END"
+
+
+def to_rating(rating) -> Optional[int]:
+    """
+    Returns a rating read from the replays table, or None if it is missing.
+    """
+    return rating if isinstance(rating, int) else None
+
+
+@dataclass(frozen=True)
+class ReplayFilter:
+    """
+    A structured filter on the replays table. Unlike a raw WHERE string,
+    it compiles into parameterized SQL, so values are never spliced into
+    the query text and the compiled statement can be reused.
+    
+    Time and rating ranges are half-open: a replay matches if
+    uploadtime_start <= uploadtime < uploadtime_end and
+    rating_min <= rating < rating_max. Any bound left as None is not
+    applied, and replays without a rating never match a rating bound. A
+    replay matches the species filter if every listed species appeared in
+    it (on either side).
+    """
+    formats: Tuple[str, ...] = ()
+    uploadtime_start: Optional[int] = None
+    uploadtime_end: Optional[int] = None
+    rating_min: Optional[int] = None
+    rating_max: Optional[int] = None
+    player: Optional[str] = None
+    species: Tuple[str, ...] = ()
+
+    def __post_init__(self):
+        # Accept any sequence, but store tuples so that filters are hashable
+        object.__setattr__(self, 'formats', tuple(self.formats))
+        object.__setattr__(self, 'species', tuple(self.species))
+
+    def compile(
+        self,
+        appearances_table_name: str = "appearances",
+    ) -> Tuple[str, list]:
+        """
+        Returns a WHERE clause on the replays table (or an empty string if
+        the filter matches everything) and the list of its parameters.
+        """
+        clauses = []
+        params = []
+        if self.formats:
+            placeholders = ", ".join("?" for _ in self.formats)
+            clauses.append(f"format IN ({placeholders})")
+            params.extend(self.formats)
+        if self.uploadtime_start is not None:
+            clauses.append("uploadtime >= ?")
+            params.append(int(self.uploadtime_start))
+        if self.uploadtime_end is not None:
+            clauses.append("uploadtime < ?")
+            params.append(int(self.uploadtime_end))
+        if self.rating_min is not None or self.rating_max is not None:
+            clauses.append("typeof(rating) = 'integer'")
+        if self.rating_min is not None:
+            clauses.append("rating >= ?")
+            params.append(int(self.rating_min))
+        if self.rating_max is not None:
+            clauses.append("rating < ?")
+            params.append(int(self.rating_max))
+        if self.player is not None:
+            # players is a comma-joined list, so match a whole element of it
+            escaped = self.player.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            clauses.append("(',' || players || ',') LIKE ? ESCAPE '\\'")
+            params.append(f"%,{escaped},%")
+        for species in self.species:
+            clauses.append(f"id IN (SELECT id FROM {appearances_table_name} WHERE pokemon = ?)")
+            params.append(species)
+        if not clauses:
+            return "", params
+        return "WHERE " + " AND ".join(clauses), params
+
+
+def create_replay_indexes(
+    database_con: sqlite3.Connection,
+    replay_table_name: str = "replays",
+    appearances_table_name: str = "appearances",
+):
+    """
+    Creates the indexes on the replays table that ReplayFilter queries rely on,
+    and the one on the appearances table (if it exists) that species filters use.
+    This is a no-op if they already exist.
+    """
+    cur = database_con.cursor()
+    has_appearances = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (appearances_table_name,),
+    ).fetchone()
+    if has_appearances:
+        cur.execute(f"""
+            CREATE INDEX IF NOT EXISTS {appearances_table_name}_pokemon_idx
+            ON {appearances_table_name}(pokemon, id)
+        """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS {replay_table_name}_format_uploadtime_rating_idx
+        ON {replay_table_name}(format, uploadtime, rating)
+    """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS {replay_table_name}_uploadtime_rating_idx
+        ON {replay_table_name}(uploadtime, rating)
+    """)
+    database_con.commit()
+
+
+def create_filtered_replays_table(
+    database_con: sqlite3.Connection,
+    replay_filter: ReplayFilter,
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+    refresh: bool = False,
+    max_tables: int = 16,
+) -> str:
+    """
+    Materializes the ids of the replays matching replay_filter into an
+    indexed temporary table and returns its name. The table is named after
+    the compiled filter, so repeated calls with an equal filter on the same
+    connection reuse it instead of rescanning the replays table. At most
+    max_tables such tables are kept per connection; creating another drops
+    the least recently used one.
+    
+    The table is rebuilt automatically when get_data_version reports that
+    the replays or appearances tables have changed. Pass refresh=True to
+    force a rebuild, e.g. after rows were updated in place. Creating a
+    table commits any open transaction, but reusing one does not.
+    """
+    where, params = replay_filter.compile(appearances_table_name)
+    key = repr((replay_table_name, where, params)).encode()
+    table_name = f"filtered_replays_{hashlib.sha1(key).hexdigest()[:16]}"
+    version = repr(get_data_version(database_con, (replay_table_name, appearances_table_name)))
+    in_transaction = database_con.in_transaction
+    cur = database_con.cursor()
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS filtered_replays_versions (
+        name TEXT PRIMARY KEY,
+        version TEXT NOT NULL,
+        last_used INTEGER NOT NULL)
+    """)
+    last_used = cur.execute(
+        "SELECT COALESCE(MAX(last_used), 0) + 1 FROM temp.filtered_replays_versions"
+    ).fetchone()[0]
+    existing_version = cur.execute(
+        "SELECT version FROM temp.filtered_replays_versions WHERE name = ?",
+        (table_name,),
+    ).fetchone()
+    if existing_version == (version,) and not refresh:
+        cur.execute(
+            "UPDATE temp.filtered_replays_versions SET last_used = ? WHERE name = ?",
+            (last_used, table_name),
+        )
+        # Only the temp table was written, so leave the caller's transaction be
+        if not in_transaction:
+            database_con.commit()
+        return table_name
+    try:
+        create_replay_indexes(database_con, replay_table_name, appearances_table_name)
+    except sqlite3.OperationalError:
+        # The database is read-only, so make do with the indexes it has
+        pass
+    cur.execute(f"DROP TABLE IF EXISTS temp.{table_name}")
+    cur.execute(f"CREATE TEMP TABLE {table_name} (id TEXT PRIMARY KEY) WITHOUT ROWID")
+    cur.execute(f"INSERT INTO temp.{table_name} SELECT id FROM {replay_table_name} {where}", params)
+    cur.execute(
+        "INSERT OR REPLACE INTO temp.filtered_replays_versions VALUES(?, ?, ?)",
+        (table_name, version, last_used),
+    )
+    evicted = cur.execute("""
+        SELECT name FROM temp.filtered_replays_versions
+        ORDER BY last_used DESC LIMIT -1 OFFSET ?
+    """, (max_tables,)).fetchall()
+    for (name,) in evicted:
+        cur.execute(f"DROP TABLE IF EXISTS temp.{name}")
+    cur.executemany("DELETE FROM temp.filtered_replays_versions WHERE name = ?", evicted)
     database_con.commit()
+    return table_name
+
+
+def _get_replay_ids_sql(
+    database_con: sqlite3.Connection,
+    where: Union[str, ReplayFilter] = '',
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+) -> Tuple[str, list]:
+    """
+    Returns a SELECT statement for the ids of the replays matching where,
+    which is either a ReplayFilter or a raw WHERE clause string, and the
+    list of its parameters.
+    
+    A ReplayFilter is materialized with create_filtered_replays_table,
+    except on query_only connections (see ReadOnlyConnectionPool), which
+    can't write even temporary tables; there the compiled filter is used
+    as a subquery instead.
+    """
+    if isinstance(where, ReplayFilter):
+        if database_con.execute("PRAGMA query_only").fetchone()[0]:
+            where, params = where.compile(appearances_table_name)
+            return f"SELECT id FROM {replay_table_name} {where}", params
+        filtered_table_name = create_filtered_replays_table(
+            database_con,
+            where,
+            appearances_table_name,
+            replay_table_name,
+        )
+        return f"SELECT id FROM temp.{filtered_table_name}", []
+    return f"SELECT id FROM {replay_table_name} {where}", []
+
+
+def _get_replay_keys_sql(
+    where: Union[str, ReplayFilter] = '',
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+) -> Tuple[str, list]:
+    """
+    The normalized-schema counterpart of _get_replay_ids_sql: returns a
+    SELECT statement for the replay_key of the replays matching where, or
+    an empty string if where matches everything, and its parameters.
+    
+    A ReplayFilter is compiled against replay_facts, so it uses that
+    table's (format, uploadtime, rating) indexes, and its player and
+    species filters go through replay_players and team_appearances. A raw
+    WHERE clause string refers to the replays table, so the ids it selects
+    are mapped to replay keys.
+    """
+    if isinstance(where, ReplayFilter):
+        clause, params = replace(where, player=None, species=()).compile(appearances_table_name)
+        clauses = [clause[len("WHERE "):]] if clause else []
+        if where.player is not None:
+            # Matches case-insensitively, like the LIKE of ReplayFilter.compile
+            clauses.append("""replay_key IN (
+                SELECT rp.replay_key FROM replay_players AS rp
+                JOIN players AS p ON p.player_key = rp.player_key
+                WHERE p.name = ? COLLATE NOCASE)""")
+            params.append(where.player)
+        for species in where.species:
+            clauses.append("""replay_key IN (
+                SELECT t.replay_key FROM team_appearances AS t
+                JOIN species AS s ON s.species_key = t.species_key
+                WHERE s.name = ?)""")
+            params.append(species)
+        if not clauses:
+            return "", params
+        return "SELECT replay_key FROM replay_facts WHERE " + " AND ".join(clauses), params
+    if where:
+        return f"""SELECT replay_key FROM replay_facts
+            WHERE id IN (SELECT id FROM {replay_table_name} {where})""", []
+    return "", []
 
 
 def get_pair_marginal_win_rates(
     database_con: sqlite3.Connection,
     appearances_table_name: str = "appearances",
     explain: bool = False,
+    cache: Optional["QueryCache"] = None,
 ):
     """
     Computes the marginal probability of pairs of pokemon winning.
     A pair is considered to have won if it appeared at least once in a battle
     (although not necessarily with both pokemon on the board at the same time)
     and their team ended up winning.
+    If a QueryCache is given, results are reused until the database changes.
     """
+    if cache is not None:
+        return cache.get_or_compute(
+            database_con,
+            get_pair_marginal_win_rates,
+            table_names=(appearances_table_name, "replay_facts"),
+            appearances_table_name=appearances_table_name,
+            explain=explain,
+        )
+    if has_normalized_schema(database_con, appearances_table_name):
+        return _get_pair_marginal_win_rates_normalized(database_con, explain=explain)
     cur = database_con.cursor()
     explain = "EXPLAIN QUERY PLAN" if explain else ""
     cur.execute(f"""
@@ -105,7 +428,7 @@ def get_pair_marginal_win_rates(
         WITH pairs AS (
             WITH player_appearances AS (
                 SELECT a1.pokemon as p1, a2.pokemon as p2, a1.player, a1.won as won
-                FROM appearances as a1, appearances as a2
+                FROM {appearances_table_name} as a1, {appearances_table_name} as a2
                 WHERE a1.id = a2.id AND a1.player = a2.player AND p1 < p2
             ) SELECT p1, p2, player, COUNT(*) as appearances, SUM(won) as won
               FROM player_appearances
@@ -121,15 +444,52 @@ def get_pair_marginal_win_rates(
 
 def get_pair_marginal_win_rates_conditional(
     database_con: sqlite3.Connection,
-    where: str = '',
+    where: Union[str, ReplayFilter] = '',
     appearances_table_name: str = "appearances",
     replay_table_name: str = "replays",
     explain: bool = False,
+    cache: Optional["QueryCache"] = None,
+    pairs_table_name: Optional[str] = None,
 ):
     """
     Computes marginal win rate, but you can optionally you can specify
-    a WHERE clause on the replays table to filter the replays considered.
+    a filter on the replays table to filter the replays considered.
+    The filter is either a ReplayFilter or a raw WHERE clause string.
+    A ReplayFilter is preferred: the matching ids are materialized once
+    per connection (see create_filtered_replays_table) and reused.
+    If a QueryCache is given, results are reused until the database changes.
+    
+    Pairs are formed from the rows of pairs_table_name, any table or view
+    with the id, player, pokemon and won columns of the appearances table,
+    which it defaults to; see get_lead_pair_win_rates. The filter is still
+    evaluated against the appearances table.
     """
+    if cache is not None:
+        table_names = (replay_table_name, appearances_table_name, "replay_facts")
+        return cache.get_or_compute(
+            database_con,
+            get_pair_marginal_win_rates_conditional,
+            table_names=table_names + ((pairs_table_name,) if pairs_table_name else ()),
+            where=where,
+            appearances_table_name=appearances_table_name,
+            replay_table_name=replay_table_name,
+            explain=explain,
+            pairs_table_name=pairs_table_name,
+        )
+    if pairs_table_name is None and has_normalized_schema(database_con, appearances_table_name, replay_table_name):
+        replay_keys_sql, params = _get_replay_keys_sql(where, appearances_table_name, replay_table_name)
+        return _get_pair_marginal_win_rates_normalized(
+            database_con,
+            replay_keys_sql,
+            params,
+            explain=explain,
+        )
+    replay_ids_sql, params = _get_replay_ids_sql(
+        database_con,
+        where,
+        appearances_table_name,
+        replay_table_name,
+    )
     cur = database_con.cursor()
     explain = "EXPLAIN QUERY PLAN" if explain else ""
     cur.execute(f"""
@@ -137,8 +497,8 @@ def get_pair_marginal_win_rates_conditional(
         WITH pairs AS (
             WITH player_appearances AS (
                 WITH filtered_appearances AS (
-                    SELECT * FROM {appearances_table_name}
-                    WHERE id IN (SELECT id FROM {replay_table_name} {where})
+                    SELECT * FROM {pairs_table_name or appearances_table_name}
+                    WHERE id IN ({replay_ids_sql})
                 )
                 SELECT a1.pokemon as p1, a2.pokemon as p2, a1.player, a1.won as won
                 FROM filtered_appearances as a1, filtered_appearances as a2
@@ -151,5 +511,1696 @@ def get_pair_marginal_win_rates_conditional(
           GROUP BY p1, p2
     ) SELECT *, 1.0 * wins / appearances FROM marginal
       ORDER BY appearances DESC
+    """, params)
+    return cur.fetchall()
+
+
+def migrate_to_normalized_schema(
+    database_con: sqlite3.Connection,
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+):
+    """
+    Migrates the replays and appearances tables into a normalized schema
+    for analytics, creating or updating the appearances table first. The
+    source tables are left untouched. Once the normalized tables exist,
+    the get_pair_marginal_win_rates* functions query them instead of the
+    appearances table, as long as they are asked about the same source
+    tables and those haven't changed since; normalized_sources records
+    the source table names and their get_data_version.
+    
+    The migration is incremental: replays whose players or appearances
+    were already migrated are skipped, so it can be rerun after new
+    replays have been downloaded. Until it is, queries fall back to the
+    source tables rather than leave the new replays out.
+    
+    The normalized schema is defined by the following SQLite statements:
+    
+        CREATE TABLE replay_facts (
+        replay_key INTEGER PRIMARY KEY,
+        id TEXT NOT NULL UNIQUE,
+        format TEXT NOT NULL,
+        uploadtime INTEGER NOT NULL,
+        rating INTEGER)
+        
+        CREATE TABLE species (
+        species_key INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE)
+        
+        CREATE TABLE players (
+        player_key INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE)
+        
+        CREATE TABLE replay_players (
+        replay_key INTEGER NOT NULL,
+        player_key INTEGER NOT NULL,
+        side INTEGER NOT NULL,
+        won INTEGER NOT NULL,
+        PRIMARY KEY(replay_key, player_key)) WITHOUT ROWID
+        
+        CREATE TABLE team_appearances (
+        replay_key INTEGER NOT NULL,
+        player_key INTEGER NOT NULL,
+        species_key INTEGER NOT NULL,
+        won INTEGER NOT NULL,
+        PRIMARY KEY(replay_key, player_key, species_key)) WITHOUT ROWID
+        
+        CREATE TABLE normalized_sources (
+        appearances_table_name TEXT NOT NULL,
+        replay_table_name TEXT NOT NULL,
+        data_version TEXT)
+    
+    team_appearances has a covering index on (species_key, replay_key,
+    player_key, won) and replay_players one on (player_key, replay_key, won).
+    Raises ValueError if the database was migrated from other source tables.
+    """
+    cur = database_con.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS normalized_sources (
+        appearances_table_name TEXT NOT NULL,
+        replay_table_name TEXT NOT NULL,
+        data_version TEXT)
+    """)
+    sources = cur.execute("SELECT appearances_table_name, replay_table_name FROM normalized_sources").fetchone()
+    if sources is None:
+        cur.execute("INSERT INTO normalized_sources VALUES(?, ?, NULL)", (appearances_table_name, replay_table_name))
+    elif sources != (appearances_table_name, replay_table_name):
+        raise ValueError(f"The database was migrated from the tables {sources}")
+    create_appearances_table(database_con, appearances_table_name, replay_table_name)
+    
+    cur.executescript("""
+        CREATE TABLE IF NOT EXISTS replay_facts (
+        replay_key INTEGER PRIMARY KEY,
+        id TEXT NOT NULL UNIQUE,
+        format TEXT NOT NULL,
+        uploadtime INTEGER NOT NULL,
+        rating INTEGER);
+        CREATE INDEX IF NOT EXISTS replay_facts_format_uploadtime_rating_idx
+        ON replay_facts(format, uploadtime, rating);
+        CREATE INDEX IF NOT EXISTS replay_facts_uploadtime_rating_idx
+        ON replay_facts(uploadtime, rating);
+        
+        CREATE TABLE IF NOT EXISTS species (
+        species_key INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE);
+        
+        CREATE TABLE IF NOT EXISTS players (
+        player_key INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE);
+        
+        CREATE TABLE IF NOT EXISTS replay_players (
+        replay_key INTEGER NOT NULL,
+        player_key INTEGER NOT NULL,
+        side INTEGER NOT NULL,
+        won INTEGER NOT NULL,
+        PRIMARY KEY(replay_key, player_key)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS replay_players_player_idx
+        ON replay_players(player_key, replay_key, won);
+        
+        CREATE TABLE IF NOT EXISTS team_appearances (
+        replay_key INTEGER NOT NULL,
+        player_key INTEGER NOT NULL,
+        species_key INTEGER NOT NULL,
+        won INTEGER NOT NULL,
+        PRIMARY KEY(replay_key, player_key, species_key)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS team_appearances_species_idx
+        ON team_appearances(species_key, replay_key, player_key, won);
+    """)
+    
+    cur.execute(f"""
+        INSERT INTO replay_facts (id, format, uploadtime, rating)
+        SELECT id, format, uploadtime, rating FROM {replay_table_name}
+        WHERE id NOT IN (SELECT id FROM replay_facts)
+        ORDER BY uploadtime
+    """)
+    cur.execute(f"""
+        INSERT OR IGNORE INTO species (name)
+        SELECT DISTINCT pokemon FROM {appearances_table_name} ORDER BY pokemon
+    """)
+    
+    # replays.players is a comma-joined list in side order, so it is split here
+    batch_cur = database_con.cursor()
+    batch_cur.execute(f"""
+        SELECT f.replay_key, r.players
+        FROM replay_facts AS f JOIN {replay_table_name} AS r ON r.id = f.id
+        WHERE f.replay_key NOT IN (SELECT replay_key FROM replay_players)
+    """)
+    BATCH_SIZE = 10_000
+    batch = batch_cur.fetchmany(BATCH_SIZE)
+    while batch:
+        data = []
+        for replay_key, players in batch:
+            for side, player in enumerate(players.split(","), start=1):
+                data.append((replay_key, player, side))
+        cur.executemany("INSERT OR IGNORE INTO players (name) VALUES(?)", [(d[1],) for d in data])
+        cur.executemany("""
+            INSERT OR IGNORE INTO replay_players (replay_key, player_key, side, won)
+            SELECT ?, player_key, ?, 0 FROM players WHERE name = ?
+        """, [(replay_key, side, player) for (replay_key, player, side) in data])
+        batch = batch_cur.fetchmany(BATCH_SIZE)
+    
+    # Replays without team appearances, whether new or migrated before
+    # create_appearances_table parsed them
+    cur.execute("DROP TABLE IF EXISTS temp.unmigrated_replays")
+    cur.execute(f"""
+        CREATE TEMP TABLE unmigrated_replays AS
+        SELECT f.replay_key, f.id FROM replay_facts AS f
+        WHERE f.replay_key NOT IN (SELECT replay_key FROM team_appearances)
+          AND f.id IN (SELECT id FROM {appearances_table_name})
+    """)
+    cur.execute(f"""
+        INSERT OR IGNORE INTO players (name)
+        SELECT DISTINCT a.player
+        FROM {appearances_table_name} AS a JOIN temp.unmigrated_replays AS u ON u.id = a.id
+    """)
+    cur.execute(f"""
+        INSERT OR IGNORE INTO team_appearances (replay_key, player_key, species_key, won)
+        SELECT u.replay_key, p.player_key, s.species_key, a.won
+        FROM {appearances_table_name} AS a
+        JOIN temp.unmigrated_replays AS u ON u.id = a.id
+        JOIN players AS p ON p.name = a.player
+        JOIN species AS s ON s.name = a.pokemon
+    """)
+    cur.execute("""
+        UPDATE replay_players SET won = 1
+        WHERE replay_key IN (SELECT replay_key FROM temp.unmigrated_replays)
+          AND (replay_key, player_key) IN (
+            SELECT replay_key, player_key FROM team_appearances
+            WHERE replay_key IN (SELECT replay_key FROM temp.unmigrated_replays) AND won = 1)
+    """)
+    cur.execute("DROP TABLE temp.unmigrated_replays")
+    data_version = get_data_version(database_con, (replay_table_name, appearances_table_name))
+    cur.execute("UPDATE normalized_sources SET data_version = ?", (repr(data_version),))
+    database_con.commit()
+    cur.execute("ANALYZE")
+
+
+def has_normalized_schema(
+    database_con: sqlite3.Connection,
+    appearances_table_name: str = "appearances",
+    replay_table_name: Optional[str] = None,
+) -> bool:
+    """
+    Returns True if migrate_to_normalized_schema has been run on the database
+    with the given source tables, and they haven't changed since, so the
+    normalized tables hold the same data. replay_table_name=None matches any.
+    """
+    cur = database_con.cursor()
+    try:
+        sources = cur.execute(
+            "SELECT appearances_table_name, replay_table_name, data_version FROM normalized_sources"
+        ).fetchone()
+    except sqlite3.OperationalError:
+        return False
+    if sources is None or sources[0] != appearances_table_name or replay_table_name not in (None, sources[1]):
+        return False
+    return sources[2] == repr(get_data_version(database_con, (sources[1], sources[0])))
+
+
+def _get_pair_marginal_win_rates_normalized(
+    database_con: sqlite3.Connection,
+    replay_keys_sql: str = '',
+    params: Sequence = (),
+    explain: bool = False,
+):
+    """
+    The normalized-schema counterpart of get_pair_marginal_win_rates_conditional.
+    replay_keys_sql optionally selects the replay keys to consider, see
+    _get_replay_keys_sql. Rows have the same shape as the other pair queries.
+    """
+    cur = database_con.cursor()
+    explain = "EXPLAIN QUERY PLAN" if explain else ""
+    where = f"WHERE a1.replay_key IN ({replay_keys_sql})" if replay_keys_sql else ""
+    cur.execute(f"""
+    {explain} WITH pairs AS (
+        SELECT a1.species_key AS s1, a2.species_key AS s2, a1.player_key,
+               COUNT(*) AS appearances, SUM(a1.won) AS won
+        FROM team_appearances AS a1
+        JOIN team_appearances AS a2
+          ON a1.replay_key = a2.replay_key AND a1.player_key = a2.player_key
+         AND a1.species_key < a2.species_key
+        {where}
+        GROUP BY s1, s2, a1.player_key
+    ), marginal AS (
+        SELECT s1, s2, COUNT(*) AS players, SUM(appearances) AS appearances, SUM(won) AS wins
+        FROM pairs
+        GROUP BY s1, s2
+    ) SELECT MIN(sp1.name, sp2.name) AS p1, MAX(sp1.name, sp2.name) AS p2,
+             players, appearances, wins, 1.0 * wins / appearances
+      FROM marginal
+      JOIN species AS sp1 ON sp1.species_key = marginal.s1
+      JOIN species AS sp2 ON sp2.species_key = marginal.s2
+      ORDER BY appearances DESC
+    """, params)
+    return cur.fetchall()
+
+
+def get_data_version(
+    database_con: sqlite3.Connection,
+    table_names: Sequence[str] = ("replays", "appearances", "replay_facts"),
+) -> tuple:
+    """
+    Returns a value that changes whenever rows are appended to any of the
+    given tables, namely the largest rowid of each table (None for tables
+    that don't exist). WITHOUT ROWID tables have no rowid, so their rows
+    are counted instead, and views have no version of their own, so pass
+    the tables they select from. Rowids are stable across connections and
+    processes, unlike PRAGMA data_version, so the value can key on-disk
+    caches too. Rows that are updated or deleted in place are not detected.
+    """
+    cur = database_con.cursor()
+    version = []
+    for table_name in table_names:
+        try:
+            max_rowid = cur.execute(f"SELECT MAX(rowid) FROM {table_name}").fetchone()[0]
+        except sqlite3.OperationalError:
+            try:
+                max_rowid = ("count", cur.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0])
+            except sqlite3.OperationalError:
+                max_rowid = None
+        version.append(max_rowid)
+    return tuple(version)
+
+
+def _get_database_path(database_con: sqlite3.Connection) -> str:
+    """
+    Returns the file backing the main database, or an empty string for
+    in-memory and temporary databases.
+    """
+    for _, name, path in database_con.execute("PRAGMA database_list"):
+        if name == "main":
+            return path or ""
+    return ""
+
+
+class QueryCache:
+    """
+    Caches the results of query functions such as get_pair_marginal_win_rates.
+    Entries are keyed by the query function, its parameters and the database
+    file, and are only returned while get_data_version is unchanged, so new
+    replays or appearances invalidate them automatically.
+    
+    Recent results are kept in memory, up to max_entries of them. If a
+    directory is given, results are also pickled there so that they survive
+    process restarts (e.g. notebook kernels or Streamlit servers).
+    Queries on in-memory databases are never cached, since their contents
+    can't be identified across connections.
+    """
+
+    def __init__(self, max_entries: int = 128, directory: Optional[str] = None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get_or_compute(
+        self,
+        database_con: sqlite3.Connection,
+        func: Callable,
+        table_names: Sequence[str] = ("replays", "appearances", "replay_facts"),
+        **kwargs,
+    ):
+        """
+        Returns func(database_con, **kwargs), computing it only if there is
+        no cached result for the current version of the database, i.e. the
+        get_data_version of table_names, the tables func reads.
+        """
+        path = _get_database_path(database_con)
+        if not path:
+            return func(database_con, **kwargs)
+        # Parameters are keyed exactly: normalizing e.g. whitespace in a WHERE
+        # string would also change string literals inside it
+        params = tuple(sorted(kwargs.items()))
+        key = (func.__module__, func.__qualname__, params, os.path.abspath(path))
+        version = get_data_version(database_con, table_names)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+        entry = self._read_from_disk(key)
+        if entry is None or entry[0] != version:
+            entry = (version, func(database_con, **kwargs))
+            self._write_to_disk(key, entry)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.directory is not None:
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".pickle"):
+                    os.remove(os.path.join(self.directory, filename))
+
+    def _disk_path(self, key: tuple) -> str:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.pickle")
+
+    def _read_from_disk(self, key: tuple):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                stored_key, version, result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if stored_key != key:
+            return None
+        return version, result
+
+    def _write_to_disk(self, key: tuple, entry: tuple):
+        if self.directory is None:
+            return
+        # Write then rename, so that concurrent readers never see partial files
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((key, entry[0], entry[1]), f)
+        os.replace(tmp_path, path)
+
+
+class ReadOnlyConnectionPool:
+    """
+    A thread-safe pool of read-only connections to an SQLite database, so
+    that dashboards and notebooks can query a large replays database from
+    many threads (e.g. concurrent Streamlit sessions) without each copying
+    data into memory of its own.
+    
+    Connections are opened with mode=ro and PRAGMA query_only, so nothing
+    can be written through them, not even temporary tables. The database
+    file is memory-mapped (mmap_size bytes of it), so all connections, in
+    this and other processes, read through the operating system's page
+    cache, which stays warm between queries; cache_size is the size of each
+    connection's own page cache, in KiB. Connections are reused, so their
+    caches stay warm too.
+    
+    At most max_connections connections are handed out at once, and
+    connection() waits up to timeout seconds (forever if None) for one to
+    be returned:
+    
+        pool = get_read_only_pool("replays.db")
+        with pool.connection() as con:
+            get_pair_marginal_win_rates_conditional(con, ReplayFilter(rating_min=1500))
+    
+    A connection must only be used by the thread that checked it out.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_connections: int = 8,
+        mmap_size: int = 2**30,
+        cache_size: int = 64 * 1024,
+        timeout: Optional[float] = None,
+    ):
+        self.path = os.path.abspath(path)
+        self.max_connections = max_connections
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(max_connections)
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        uri = f"file:{urllib.parse.quote(self.path)}?mode=ro"
+        con = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        con.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        # A negative cache_size is in KiB rather than pages
+        con.execute(f"PRAGMA cache_size = {-int(self.cache_size)}")
+        con.execute("PRAGMA query_only = ON")
+        return con
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of a with block.
+        """
+        if not self._available.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No connection to {self.path} became available in {self.timeout}s")
+        try:
+            with self._lock:
+                if self._closed:
+                    raise ValueError("The connection pool is closed")
+                con = self._idle.pop() if self._idle else None
+            if con is None:
+                con = self._connect()
+            try:
+                yield con
+            finally:
+                if con.in_transaction:
+                    con.rollback()
+                with self._lock:
+                    if self._closed:
+                        con.close()
+                    else:
+                        self._idle.append(con)
+        finally:
+            self._available.release()
+
+    def close(self):
+        """
+        Closes the idle connections, and the others as they are returned.
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for con in idle:
+            con.close()
+
+
+_read_only_pools = {}
+_read_only_pools_lock = threading.Lock()
+
+
+def get_read_only_pool(path: str, **kwargs) -> ReadOnlyConnectionPool:
+    """
+    Returns the process-wide ReadOnlyConnectionPool for the database at
+    path, creating it with kwargs (see ReadOnlyConnectionPool) on first
+    use, so that all callers in a process share one pool per database.
+    """
+    key = os.path.abspath(path)
+    with _read_only_pools_lock:
+        pool = _read_only_pools.get(key)
+        if pool is None or pool._closed:
+            pool = ReadOnlyConnectionPool(path, **kwargs)
+            _read_only_pools[key] = pool
+        return pool
+
+
+def get_core_win_rates(
+    database_con: sqlite3.Connection,
+    k: int = 3,
+    min_support: int = 100,
+    where: Union[str, ReplayFilter] = '',
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+):
+    """
+    Computes the marginal win rates of cores of k pokemon, generalizing
+    get_pair_marginal_win_rates to triples, quads and so on. As with pairs,
+    a core appeared (and won) if all of its pokemon appeared for the same
+    player in a battle (and that player won).
+    
+    Only cores that appeared at least min_support times are returned. They
+    are found level by level, Apriori style: a core of size j is only
+    counted if all of its cores of size j - 1 are frequent, since it can't
+    appear more often than any of them. Each level streams the teams from
+    the appearances table once, so memory is bounded by the number of
+    candidate cores rather than the number of appearances.
+    
+    The where argument filters replays, as in
+    get_pair_marginal_win_rates_conditional.
+    
+    Returns a list of (core, appearances, wins, win_rate) tuples ordered by
+    appearances, where core is a sorted tuple of k pokemon names.
+    """
+    replay_ids_sql, params = _get_replay_ids_sql(
+        database_con,
+        where,
+        appearances_table_name,
+        replay_table_name,
+    )
+    cur = database_con.cursor()
+    cur.execute(f"""
+        SELECT pokemon, COUNT(*), SUM(won) FROM {appearances_table_name}
+        WHERE id IN ({replay_ids_sql})
+        GROUP BY pokemon HAVING COUNT(*) >= ?
+    """, params + [min_support])
+    frequent = {(pokemon,): [appearances, wins] for (pokemon, appearances, wins) in cur.fetchall()}
+    frequent_pokemon = {core[0] for core in frequent}
+    
+    for level in range(2, k + 1):
+        if not frequent:
+            break
+        counts = {}
+        for team, won in _iter_teams(database_con, replay_ids_sql, params, appearances_table_name):
+            team = sorted(p for p in team if p in frequent_pokemon)
+            for core in itertools.combinations(team, level):
+                if core not in counts:
+                    subsets = itertools.combinations(core, level - 1)
+                    if not all(subset in frequent for subset in subsets):
+                        continue
+                    counts[core] = [0, 0]
+                counts[core][0] += 1
+                counts[core][1] += won
+        frequent = {core: c for core, c in counts.items() if c[0] >= min_support}
+        frequent_pokemon = {p for core in frequent for p in core}
+    
+    results = [
+        (core, appearances, wins, 1.0 * wins / appearances)
+        for core, (appearances, wins) in frequent.items()
+        if len(core) == k
+    ]
+    results.sort(key=lambda r: r[1], reverse=True)
+    return results
+
+
+def _iter_teams(
+    database_con: sqlite3.Connection,
+    replay_ids_sql: str,
+    params: Sequence = (),
+    appearances_table_name: str = "appearances",
+):
+    """
+    Yields (pokemon, won) for each player in each replay selected by
+    replay_ids_sql (with params), where pokemon is the list of pokemon
+    they brought out.
+    """
+    cur = database_con.cursor()
+    cur.execute(f"""
+        SELECT id, player, pokemon, won FROM {appearances_table_name}
+        WHERE id IN ({replay_ids_sql})
+        ORDER BY id, player
+    """, params)
+    BATCH_SIZE = 10_000
+    team_key = None
+    team = []
+    team_won = 0
+    batch = cur.fetchmany(BATCH_SIZE)
+    while batch:
+        for replay_id, player, pokemon, won in batch:
+            if (replay_id, player) != team_key:
+                if team:
+                    yield team, team_won
+                team_key = (replay_id, player)
+                team = []
+                team_won = won
+            team.append(pokemon)
+        batch = cur.fetchmany(BATCH_SIZE)
+    if team:
+        yield team, team_won
+
+
+def get_matchup_matrix(
+    database_con: sqlite3.Connection,
+    where: Union[str, ReplayFilter] = '',
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+    batch_size: int = 10_000,
+):
+    """
+    Computes how each pokemon fared against each pokemon on the opposing
+    side. Returns (pokemon, games, wins) where pokemon is a sorted list of
+    names and games[i, j] counts the times pokemon[i] appeared against a
+    team on which pokemon[j] appeared, of which wins[i, j] were won by
+    pokemon[i]'s side. Both sides of every battle are counted, so a battle
+    in which both teams brought pokemon[i] adds two games and one win to
+    games[i, i] and wins[i, i].
+    
+    Replays are processed in batches of batch_size: each side's appearances
+    become a replay x pokemon incidence matrix and the batch's contribution
+    is a pair of matrix products. The where argument filters replays, as in
+    get_pair_marginal_win_rates_conditional.
+    """
+    replay_ids_sql, params = _get_replay_ids_sql(
+        database_con,
+        where,
+        appearances_table_name,
+        replay_table_name,
+    )
+    cur = database_con.cursor()
+    cur.execute(f"""
+        SELECT DISTINCT pokemon FROM {appearances_table_name}
+        WHERE id IN ({replay_ids_sql})
+        ORDER BY pokemon
+    """, params)
+    pokemon = [row[0] for row in cur.fetchall()]
+    pokemon_idx = {name: i for i, name in enumerate(pokemon)}
+    num_pokemon = len(pokemon)
+    games = np.zeros((num_pokemon, num_pokemon), dtype=np.int64)
+    wins = np.zeros((num_pokemon, num_pokemon), dtype=np.int64)
+    
+    def add_batch(rows):
+        # rows holds (replay number within the batch, side, pokemon index, won)
+        rows = np.array(rows, dtype=np.int64).reshape(-1, 4)
+        num_replays = rows[:, 0].max() + 1 if rows.size else 0
+        incidence = np.zeros((2, num_replays, num_pokemon), dtype=np.float32)
+        won = np.zeros((2, num_replays), dtype=np.float32)
+        incidence[rows[:, 1], rows[:, 0], rows[:, 2]] = 1
+        won[rows[:, 1], rows[:, 0]] = rows[:, 3]
+        for side in (0, 1):
+            team, opponent = incidence[side], incidence[1 - side]
+            games[:] += (team.T @ opponent).astype(np.int64)
+            wins[:] += ((team * won[side][:, None]).T @ opponent).astype(np.int64)
+    
+    cur.execute(f"""
+        SELECT id, player, pokemon, won FROM {appearances_table_name}
+        WHERE id IN ({replay_ids_sql})
+        ORDER BY id, player
+    """, params)
+    rows = []
+    replay_num = -1
+    last_id = last_player = None
+    side = 0
+    batch = cur.fetchmany(batch_size)
+    while batch:
+        for replay_id, player, name, won in batch:
+            if replay_id != last_id:
+                if replay_num + 1 == batch_size:
+                    add_batch(rows)
+                    rows = []
+                    replay_num = -1
+                replay_num += 1
+                last_id, last_player, side = replay_id, player, 0
+            elif player != last_player:
+                last_player, side = player, 1
+            rows.append((replay_num, side, pokemon_idx[name], won))
+        batch = cur.fetchmany(batch_size)
+    if rows:
+        add_batch(rows)
+    return pokemon, games, wins
+
+
+def create_matchups_table(
+    database_con: sqlite3.Connection,
+    where: Union[str, ReplayFilter] = '',
+    matchups_table_name: str = "matchups",
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+):
+    """
+    Persists get_matchup_matrix in a table, replacing it if it exists,
+    so that the matchups of a pokemon can be read with get_matchups.
+    Use a different matchups_table_name for each filter you want to keep.
+    Only pairs of pokemon that met at least once are stored.
+    
+    The table is defined by the following SQLite statement:
+    
+        CREATE TABLE matchups (
+        pokemon TEXT NOT NULL,
+        opponent TEXT NOT NULL,
+        games INTEGER NOT NULL,
+        wins INTEGER NOT NULL,
+        PRIMARY KEY(pokemon, opponent)) WITHOUT ROWID
+    
+    """
+    pokemon, games, wins = get_matchup_matrix(
+        database_con,
+        where,
+        appearances_table_name,
+        replay_table_name,
+    )
+    cur = database_con.cursor()
+    cur.execute(f"DROP TABLE IF EXISTS {matchups_table_name}")
+    cur.execute(f"""
+        CREATE TABLE {matchups_table_name} (
+        pokemon TEXT NOT NULL,
+        opponent TEXT NOT NULL,
+        games INTEGER NOT NULL,
+        wins INTEGER NOT NULL,
+        PRIMARY KEY(pokemon, opponent)) WITHOUT ROWID
     """)
-    return cur.fetchall()
\ No newline at end of file
+    rows, cols = np.nonzero(games)
+    cur.executemany(
+        f"INSERT INTO {matchups_table_name} VALUES(?, ?, ?, ?)",
+        (
+            (pokemon[i], pokemon[j], int(games[i, j]), int(wins[i, j]))
+            for i, j in zip(rows, cols)
+        ),
+    )
+    database_con.commit()
+
+
+def get_matchups(
+    database_con: sqlite3.Connection,
+    pokemon: str,
+    matchups_table_name: str = "matchups",
+):
+    """
+    Returns (opponent, games, wins, win_rate) rows for the given pokemon
+    from a table made by create_matchups_table, ordered by games.
+    """
+    cur = database_con.cursor()
+    cur.execute(f"""
+        SELECT opponent, games, wins, 1.0 * wins / games FROM {matchups_table_name}
+        WHERE pokemon = ?
+        ORDER BY games DESC
+    """, (pokemon,))
+    return cur.fetchall()
+
+
+def create_events_table(
+    database_con: sqlite3.Connection,
+    events_table_name: str = "events",
+    replay_table_name: str = "replays",
+):
+    """
+    Creates (if necessary) and updates an inverted index of replay events,
+    so that replays can be found by what happened in them without parsing
+    any logs, see find_replays. Only replays that haven't been indexed yet
+    are parsed, so this can be rerun after new replays are downloaded;
+    index_replay_events indexes replays as they are ingested instead.
+    Events are extracted with analysis.parse_events.
+    
+    The index is defined by the following SQLite statements:
+    
+        CREATE TABLE events (
+        event TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        turn INTEGER NOT NULL,
+        player TEXT NOT NULL,
+        id TEXT NOT NULL,
+        PRIMARY KEY(event, subject, turn, player, id)) WITHOUT ROWID
+        
+        CREATE TABLE events_indexed (
+        id TEXT PRIMARY KEY) WITHOUT ROWID
+    
+    """
+    _create_events_tables(database_con, events_table_name)
+    where = f"WHERE id NOT IN (SELECT id FROM {events_table_name}_indexed)"
+    for batch in iter_replay_logs(database_con, replay_table_name, where=where):
+        index_replay_events(database_con, batch, events_table_name)
+
+
+def _create_events_tables(database_con: sqlite3.Connection, events_table_name: str = "events"):
+    cur = database_con.cursor()
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {events_table_name} (
+        event TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        turn INTEGER NOT NULL,
+        player TEXT NOT NULL,
+        id TEXT NOT NULL,
+        PRIMARY KEY(event, subject, turn, player, id)) WITHOUT ROWID
+    """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS {events_table_name}_player_idx
+        ON {events_table_name}(player, event, subject, turn)
+    """)
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {events_table_name}_indexed (
+        id TEXT PRIMARY KEY) WITHOUT ROWID
+    """)
+
+
+def index_replay_events(
+    database_con: sqlite3.Connection,
+    replays: Sequence[Tuple[str, str]],
+    events_table_name: str = "events",
+):
+    """
+    Adds the events of the given (id, log) pairs to the event index.
+    Logs that can't be parsed are marked as indexed without any events.
+    """
+    _create_events_tables(database_con, events_table_name)
+    data = []
+    for replay_id, log in replays:
+        try:
+            events = parse_events(log)
+        except (KeyError, IndexError, ValueError):
+            events = []
+        for e in events:
+            data.append((e['event'], e['subject'], e['turn'], e['player'], replay_id))
+    cur = database_con.cursor()
+    cur.executemany(f"INSERT OR IGNORE INTO {events_table_name} VALUES(?, ?, ?, ?, ?)", data)
+    cur.executemany(
+        f"INSERT OR IGNORE INTO {events_table_name}_indexed VALUES(?)",
+        [(replay_id,) for replay_id, _ in replays],
+    )
+    database_con.commit()
+
+
+def find_replays(
+    database_con: sqlite3.Connection,
+    event: str,
+    subject: Optional[str] = None,
+    player: Optional[str] = None,
+    turn: Optional[int] = None,
+    max_turn: Optional[int] = None,
+    events_table_name: str = "events",
+) -> list:
+    """
+    Returns the ids of the replays containing an event, using only the
+    event index. For example, replays where Trick Room was used on turn 1:
+    
+        find_replays(con, "move", "Trick Room", turn=1)
+    
+    or replays where a player terastallized:
+    
+        find_replays(con, "terastallize", player="zqrubl")
+    
+    turn selects a single turn and max_turn all turns up to it.
+    """
+    clauses = ["event = ?"]
+    params = [event]
+    if subject is not None:
+        clauses.append("subject = ?")
+        params.append(subject)
+    if player is not None:
+        clauses.append("player = ?")
+        params.append(player)
+    if turn is not None:
+        clauses.append("turn = ?")
+        params.append(turn)
+    if max_turn is not None:
+        clauses.append("turn <= ?")
+        params.append(max_turn)
+    cur = database_con.cursor()
+    cur.execute(f"""
+        SELECT DISTINCT id FROM {events_table_name}
+        WHERE {" AND ".join(clauses)}
+        ORDER BY id
+    """, params)
+    return [row[0] for row in cur.fetchall()]
+
+
+def create_leads_table(
+    database_con: sqlite3.Connection,
+    leads_table_name: str = "leads",
+    replay_table_name: str = "replays",
+):
+    """
+    Creates (if necessary) and updates a table of the pokemon each side
+    led with, and of the first pokemon switched into each position on
+    every later turn, which the appearances table doesn't record. Only
+    replays that haven't been indexed yet are parsed, so this can be rerun
+    after new replays are downloaded; index_replay_leads indexes replays as
+    they are ingested instead.
+    
+    The table is defined by the following SQLite statements:
+    
+        CREATE TABLE leads (
+        id TEXT NOT NULL,
+        player TEXT NOT NULL,
+        turn INTEGER NOT NULL,
+        position TEXT NOT NULL,
+        pokemon TEXT NOT NULL,
+        won INTEGER NOT NULL,
+        PRIMARY KEY(id, player, turn, position)) WITHOUT ROWID
+        
+        CREATE VIEW leads_turn0 AS
+        SELECT id, player, pokemon, won FROM leads WHERE turn = 0
+        
+        CREATE TABLE leads_indexed (
+        id TEXT PRIMARY KEY) WITHOUT ROWID
+    
+    turn is 0 for the leads sent out before the first turn, and position
+    is the slot switched into ("a" or "b" in doubles). A pokemon revealed
+    by a |replace| (Illusion) takes the place of the pokemon it disguised
+    itself as, on the turn that one switched in.
+    """
+    _create_leads_tables(database_con, leads_table_name)
+    where = f"WHERE id NOT IN (SELECT id FROM {leads_table_name}_indexed)"
+    for batch in iter_replay_logs(database_con, replay_table_name, where=where):
+        index_replay_leads(database_con, batch, leads_table_name)
+
+
+def _create_leads_tables(database_con: sqlite3.Connection, leads_table_name: str = "leads"):
+    cur = database_con.cursor()
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {leads_table_name} (
+        id TEXT NOT NULL,
+        player TEXT NOT NULL,
+        turn INTEGER NOT NULL,
+        position TEXT NOT NULL,
+        pokemon TEXT NOT NULL,
+        won INTEGER NOT NULL,
+        PRIMARY KEY(id, player, turn, position)) WITHOUT ROWID
+    """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS {leads_table_name}_pokemon_idx
+        ON {leads_table_name}(turn, pokemon, id)
+    """)
+    cur.execute(f"""
+        CREATE VIEW IF NOT EXISTS {leads_table_name}_turn0 AS
+        SELECT id, player, pokemon, won FROM {leads_table_name} WHERE turn = 0
+    """)
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {leads_table_name}_indexed (
+        id TEXT PRIMARY KEY) WITHOUT ROWID
+    """)
+
+
+def index_replay_leads(
+    database_con: sqlite3.Connection,
+    replays: Sequence[Tuple[str, str]],
+    leads_table_name: str = "leads",
+):
+    """
+    Adds the leads and switch-ins of the given (id, log) pairs to the leads
+    table. Logs that can't be parsed are marked as indexed without any rows.
+    """
+    _create_leads_tables(database_con, leads_table_name)
+    data = []
+    for replay_id, log in replays:
+        try:
+            parsed_replay = parse_replay(log)
+        except KeyError:
+            continue
+        # Keeps the first pokemon switched into each position on each turn
+        rows = {}
+        # The row of the pokemon now in each position, None if it wasn't kept
+        current = {}
+        for p in parsed_replay['pokemon']:
+            won = 1 if p['player'] == parsed_replay['winner'] else 0
+            slot = (p['player'], p['position'])
+            if p['replace'] and slot in current:
+                # The pokemon in this position was disguised, so correct its row
+                if current[slot] is not None:
+                    rows[current[slot]] = current[slot] + (p['name'], won)
+                continue
+            key = (replay_id, p['player'], p['turn'], p['position'])
+            current[slot] = None
+            if key not in rows:
+                rows[key] = key + (p['name'], won)
+                current[slot] = key
+        data.extend(rows.values())
+    cur = database_con.cursor()
+    cur.executemany(f"INSERT OR IGNORE INTO {leads_table_name} VALUES(?, ?, ?, ?, ?, ?)", data)
+    cur.executemany(
+        f"INSERT OR IGNORE INTO {leads_table_name}_indexed VALUES(?)",
+        [(replay_id,) for replay_id, _ in replays],
+    )
+    database_con.commit()
+
+
+def get_lead_pair_win_rates(
+    database_con: sqlite3.Connection,
+    where: Union[str, ReplayFilter] = '',
+    leads_table_name: str = "leads",
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+    cache: Optional["QueryCache"] = None,
+):
+    """
+    Computes the marginal win rates of lead pairs, the pairs of pokemon a
+    side led with, with the same rollup, filters and result rows as
+    get_pair_marginal_win_rates_conditional, from the leads table (see
+    create_leads_table).
+    """
+    if cache is not None:
+        return cache.get_or_compute(
+            database_con,
+            get_lead_pair_win_rates,
+            table_names=(replay_table_name, appearances_table_name, leads_table_name),
+            where=where,
+            leads_table_name=leads_table_name,
+            appearances_table_name=appearances_table_name,
+            replay_table_name=replay_table_name,
+        )
+    return get_pair_marginal_win_rates_conditional(
+        database_con,
+        where,
+        appearances_table_name=appearances_table_name,
+        replay_table_name=replay_table_name,
+        pairs_table_name=f"{leads_table_name}_turn0",
+    )
+
+
+def to_user_id(name: str) -> str:
+    """
+    Converts a Pokemon Showdown username into its user id, the form used to
+    identify accounts: lowercase letters and digits only.
+    """
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+
+def create_player_games_table(
+    database_con: sqlite3.Connection,
+    player_games_table_name: str = "player_games",
+    replay_table_name: str = "replays",
+):
+    """
+    Creates (if necessary) and updates a table with one row per player per
+    replay, so that a player's games can be fetched with an index lookup
+    instead of a LIKE scan over replays.players. Only replays that aren't
+    in the table yet are added, so this can be rerun after new replays are
+    downloaded; index_player_games adds replays as they are ingested.
+    
+    The table is defined by the following SQLite statement:
+    
+        CREATE TABLE player_games (
+        userid TEXT NOT NULL,
+        uploadtime INTEGER NOT NULL,
+        id TEXT NOT NULL,
+        player TEXT NOT NULL,
+        side INTEGER NOT NULL,
+        won INTEGER NOT NULL,
+        rating INTEGER,
+        format TEXT NOT NULL,
+        PRIMARY KEY(userid, uploadtime, id)) WITHOUT ROWID
+    
+    userid is the player's name normalized by to_user_id, side is 1 or 2
+    and rating is the replay's rating.
+    """
+    _create_player_games_table(database_con, player_games_table_name)
+    decompressor = LogDecompressor(database_con)
+    batch_cur = database_con.cursor()
+    batch_cur.execute(f"""
+        SELECT id, format, players, log, uploadtime, rating FROM {replay_table_name}
+        WHERE id NOT IN (SELECT id FROM {player_games_table_name})
+    """)
+    BATCH_SIZE = 10_000
+    batch = batch_cur.fetchmany(BATCH_SIZE)
+    while batch:
+        batch = [row[:3] + (decompressor.decompress(row[3]),) + row[4:] for row in batch]
+        index_player_games(database_con, batch, player_games_table_name)
+        batch = batch_cur.fetchmany(BATCH_SIZE)
+
+
+def _create_player_games_table(database_con: sqlite3.Connection, player_games_table_name: str = "player_games"):
+    cur = database_con.cursor()
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {player_games_table_name} (
+        userid TEXT NOT NULL,
+        uploadtime INTEGER NOT NULL,
+        id TEXT NOT NULL,
+        player TEXT NOT NULL,
+        side INTEGER NOT NULL,
+        won INTEGER NOT NULL,
+        rating INTEGER,
+        format TEXT NOT NULL,
+        PRIMARY KEY(userid, uploadtime, id)) WITHOUT ROWID
+    """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS {player_games_table_name}_id_idx
+        ON {player_games_table_name}(id)
+    """)
+
+
+def index_player_games(
+    database_con: sqlite3.Connection,
+    replays: Sequence[tuple],
+    player_games_table_name: str = "player_games",
+):
+    """
+    Adds replays, given as (id, format, players, log, uploadtime, rating)
+    tuples with uncompressed logs, to the player_games table.
+    """
+    _create_player_games_table(database_con, player_games_table_name)
+    win_stmt = re.compile(r'^\|win\|(?P<user>[^|\r\n]+)', re.MULTILINE)
+    data = []
+    for replay_id, format, players, log, uploadtime, rating in replays:
+        mo = win_stmt.search(log)
+        winner = to_user_id(mo.group('user')) if mo else None
+        rating = to_rating(rating)
+        for side, player in enumerate(players.split(","), start=1):
+            userid = to_user_id(player)
+            data.append((userid, uploadtime, replay_id, player, side, int(userid == winner), rating, format))
+    cur = database_con.cursor()
+    cur.executemany(f"INSERT OR IGNORE INTO {player_games_table_name} VALUES(?, ?, ?, ?, ?, ?, ?, ?)", data)
+    database_con.commit()
+
+
+def get_player_games(
+    database_con: sqlite3.Connection,
+    username: str,
+    uploadtime_start: Optional[int] = None,
+    uploadtime_end: Optional[int] = None,
+    formats: Sequence[str] = (),
+    player_games_table_name: str = "player_games",
+):
+    """
+    Returns a player's games in order of uploadtime, as
+    (uploadtime, id, format, side, won, rating) tuples, optionally within
+    the half-open range [uploadtime_start, uploadtime_end) and formats.
+    The rating column traces the player's rating trajectory.
+    """
+    clauses = ["userid = ?"]
+    params = [to_user_id(username)]
+    if uploadtime_start is not None:
+        clauses.append("uploadtime >= ?")
+        params.append(uploadtime_start)
+    if uploadtime_end is not None:
+        clauses.append("uploadtime < ?")
+        params.append(uploadtime_end)
+    if formats:
+        clauses.append(f"format IN ({', '.join('?' for _ in formats)})")
+        params.extend(formats)
+    cur = database_con.cursor()
+    cur.execute(f"""
+        SELECT uploadtime, id, format, side, won, rating FROM {player_games_table_name}
+        WHERE {" AND ".join(clauses)}
+        ORDER BY uploadtime
+    """, params)
+    return cur.fetchall()
+
+
+def get_player_win_rates(
+    database_con: sqlite3.Connection,
+    username: str,
+    player_games_table_name: str = "player_games",
+):
+    """
+    Returns a player's (format, games, wins, win_rate, first uploadtime,
+    last uploadtime) per format, ordered by games.
+    """
+    cur = database_con.cursor()
+    cur.execute(f"""
+        SELECT format, COUNT(*) AS games, SUM(won), 1.0 * SUM(won) / COUNT(*),
+               MIN(uploadtime), MAX(uploadtime)
+        FROM {player_games_table_name}
+        WHERE userid = ?
+        GROUP BY format
+        ORDER BY games DESC
+    """, (to_user_id(username),))
+    return cur.fetchall()
+
+
+def get_team_signature(team: Sequence[str]) -> Tuple[int, str]:
+    """
+    Returns the signature of a team, given as a list of species, and its
+    canonical form (the sorted species joined by ", "). The signature is a
+    signed 64-bit hash of the canonical form, so it fits an SQLite INTEGER.
+    Teams with the same species in any order have the same signature.
+    """
+    canonical = ", ".join(sorted(set(team)))
+    digest = hashlib.blake2b(canonical.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True), canonical
+
+
+def create_teams_table(
+    database_con: sqlite3.Connection,
+    teams_table_name: str = "teams",
+    replay_table_name: str = "replays",
+):
+    """
+    Creates (if necessary) and updates tables of the full teams players
+    brought, as shown in team preview, so that games with identical or
+    near-identical teams can be grouped with an indexed GROUP BY.
+    Only replays that haven't been processed yet are parsed.
+    
+    The tables are defined by the following SQLite statements:
+    
+        CREATE TABLE teams (
+        signature INTEGER NOT NULL,
+        id TEXT NOT NULL,
+        player TEXT NOT NULL,
+        won INTEGER NOT NULL,
+        team TEXT NOT NULL,
+        PRIMARY KEY(signature, id, player)) WITHOUT ROWID
+        
+        CREATE TABLE teams_near (
+        signature INTEGER NOT NULL,
+        id TEXT NOT NULL,
+        player TEXT NOT NULL,
+        won INTEGER NOT NULL,
+        team TEXT NOT NULL,
+        PRIMARY KEY(signature, id, player)) WITHOUT ROWID
+    
+    teams holds the signature (see get_team_signature) and canonical form
+    of each team. teams_near holds, for each team, the signatures of the
+    teams left after dropping any one member, so two teams that differ in
+    a single pokemon share a row signature there.
+    """
+    cur = database_con.cursor()
+    for table_name in (teams_table_name, f"{teams_table_name}_near"):
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+            signature INTEGER NOT NULL,
+            id TEXT NOT NULL,
+            player TEXT NOT NULL,
+            won INTEGER NOT NULL,
+            team TEXT NOT NULL,
+            PRIMARY KEY(signature, id, player)) WITHOUT ROWID
+        """)
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {teams_table_name}_indexed (
+        id TEXT PRIMARY KEY) WITHOUT ROWID
+    """)
+    where = f"WHERE id NOT IN (SELECT id FROM {teams_table_name}_indexed)"
+    for batch in iter_replay_logs(database_con, replay_table_name, where=where):
+        teams = []
+        near_teams = []
+        for replay_id, log in batch:
+            try:
+                parsed_replay = parse_replay(log)
+            except KeyError:
+                continue
+            by_player = {}
+            for p in parsed_replay['team']:
+                by_player.setdefault(p['player'], []).append(p['name'])
+            for player, team in by_player.items():
+                won = 1 if player == parsed_replay['winner'] else 0
+                teams.append(get_team_signature(team) + (replay_id, player, won))
+                team = sorted(set(team))
+                if len(team) < 2:
+                    continue
+                for i in range(len(team)):
+                    near_teams.append(get_team_signature(team[:i] + team[i+1:]) + (replay_id, player, won))
+        cur.executemany(
+            f"INSERT OR IGNORE INTO {teams_table_name} (signature, team, id, player, won) VALUES(?, ?, ?, ?, ?)",
+            teams,
+        )
+        cur.executemany(
+            f"INSERT OR IGNORE INTO {teams_table_name}_near (signature, team, id, player, won) VALUES(?, ?, ?, ?, ?)",
+            near_teams,
+        )
+        cur.executemany(
+            f"INSERT OR IGNORE INTO {teams_table_name}_indexed VALUES(?)",
+            [(replay_id,) for replay_id, _ in batch],
+        )
+        database_con.commit()
+
+
+def get_team_win_rates(
+    database_con: sqlite3.Connection,
+    min_games: int = 1,
+    near: bool = False,
+    where: Union[str, ReplayFilter] = '',
+    teams_table_name: str = "teams",
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+):
+    """
+    Returns (team, games, players, wins, win_rate) for every team used in
+    at least min_games games, ordered by games. With near=True, teams that
+    differ in at most one pokemon are grouped together, and team lists the
+    pokemon they share. The where argument filters replays, as in
+    get_pair_marginal_win_rates_conditional.
+    """
+    table_name = f"{teams_table_name}_near" if near else teams_table_name
+    filtered = ""
+    params = []
+    if where:
+        replay_ids_sql, params = _get_replay_ids_sql(
+            database_con,
+            where,
+            appearances_table_name,
+            replay_table_name,
+        )
+        filtered = f"WHERE id IN ({replay_ids_sql})"
+    cur = database_con.cursor()
+    cur.execute(f"""
+        SELECT MIN(team), COUNT(*) AS games, COUNT(DISTINCT player), SUM(won), 1.0 * SUM(won) / COUNT(*)
+        FROM {table_name}
+        {filtered}
+        GROUP BY signature
+        HAVING games >= ?
+        ORDER BY games DESC
+    """, params + [min_games])
+    return cur.fetchall()
+
+
+WEEK = 60 * 60 * 24 * 7
+
+
+def create_replay_sample_table(
+    database_con: sqlite3.Connection,
+    rating_bands: Sequence[int] = (1100, 1300, 1500, 1700),
+    seed: str = "",
+    sample_table_name: str = "replay_sample",
+    replay_table_name: str = "replays",
+):
+    """
+    (Re)creates the tables behind approximate pair statistics (see
+    get_pair_marginal_win_rates_approximate). Replays are divided into
+    strata by format, week (uploadtime // WEEK) and rating band, where
+    rating_bands are the lower bounds of the bands above the lowest one
+    and unrated replays form their own band. Within each stratum, replays
+    are ranked by a hash of seed and their id, so a sample of any size is
+    the prefix of the ranking: the same for everyone, and larger samples
+    contain the smaller ones.
+    
+    The tables are defined by the following SQLite statements:
+    
+        CREATE TABLE replay_sample_strata (
+        stratum INTEGER PRIMARY KEY,
+        format TEXT NOT NULL,
+        week INTEGER NOT NULL,
+        rating_band INTEGER,
+        num_replays INTEGER NOT NULL)
+        
+        CREATE TABLE replay_sample (
+        stratum INTEGER NOT NULL,
+        rank INTEGER NOT NULL,
+        id TEXT NOT NULL,
+        PRIMARY KEY(stratum, rank)) WITHOUT ROWID
+    
+    rating_band is the lower bound of the band, 0 for the lowest band and
+    NULL for unrated replays. Rerun after downloading new replays.
+    """
+    rating_bands = sorted(rating_bands)
+    strata = {}
+    BATCH_SIZE = 10_000
+    cur = database_con.cursor()
+    cur.execute(f"SELECT id, format, uploadtime, rating FROM {replay_table_name}")
+    batch = cur.fetchmany(BATCH_SIZE)
+    while batch:
+        for replay_id, format, uploadtime, rating in batch:
+            rating = to_rating(rating)
+            if rating is not None:
+                band = bisect.bisect_right(rating_bands, rating)
+                rating_band = rating_bands[band - 1] if band else 0
+            else:
+                rating_band = None
+            digest = hashlib.blake2b(f"{seed}{replay_id}".encode(), digest_size=8).digest()
+            key = (format, uploadtime // WEEK, rating_band)
+            strata.setdefault(key, []).append((digest, replay_id))
+        batch = cur.fetchmany(BATCH_SIZE)
+    
+    cur.execute(f"DROP TABLE IF EXISTS {sample_table_name}_strata")
+    cur.execute(f"DROP TABLE IF EXISTS {sample_table_name}")
+    cur.execute(f"""
+        CREATE TABLE {sample_table_name}_strata (
+        stratum INTEGER PRIMARY KEY,
+        format TEXT NOT NULL,
+        week INTEGER NOT NULL,
+        rating_band INTEGER,
+        num_replays INTEGER NOT NULL)
+    """)
+    cur.execute(f"""
+        CREATE TABLE {sample_table_name} (
+        stratum INTEGER NOT NULL,
+        rank INTEGER NOT NULL,
+        id TEXT NOT NULL,
+        PRIMARY KEY(stratum, rank)) WITHOUT ROWID
+    """)
+    for stratum, (key, replays) in enumerate(sorted(strata.items(), key=lambda item: str(item[0]))):
+        replays.sort()
+        cur.execute(
+            f"INSERT INTO {sample_table_name}_strata VALUES(?, ?, ?, ?, ?)",
+            (stratum,) + key + (len(replays),),
+        )
+        cur.executemany(
+            f"INSERT INTO {sample_table_name} VALUES(?, ?, ?)",
+            [(stratum, rank, replay_id) for rank, (_, replay_id) in enumerate(replays)],
+        )
+    database_con.commit()
+
+
+def get_pair_marginal_win_rates_approximate(
+    database_con: sqlite3.Connection,
+    where: Union[str, ReplayFilter] = '',
+    fraction: float = 0.05,
+    min_per_stratum: int = 20,
+    sample_table_name: str = "replay_sample",
+    appearances_table_name: str = "appearances",
+    replay_table_name: str = "replays",
+):
+    """
+    Estimates marginal pair win rates from a stratified sample of replays,
+    built by create_replay_sample_table. Each stratum contributes the first
+    ceil(fraction * size) replays of its ranking, but at least
+    min_per_stratum (or the whole stratum, if it is smaller). Sampled
+    replays are weighted by the size of their stratum over the size of its
+    sample, so appearances and wins estimate the exact counts. fraction=1
+    gives the exact result. The where argument filters replays, as in
+    get_pair_marginal_win_rates_conditional.
+    
+    Returns (p1, p2, appearances, wins, win_rate, appearances_se,
+    win_rate_se, sampled_appearances) tuples ordered by appearances, where
+    the _se columns are approximate standard errors: appearances_se treats
+    each sampled appearance as independent, and win_rate_se is the binomial
+    standard error of the sampled games with a finite population correction.
+    """
+    filtered = ""
+    params = []
+    if where:
+        replay_ids_sql, params = _get_replay_ids_sql(
+            database_con,
+            where,
+            appearances_table_name,
+            replay_table_name,
+        )
+        filtered = f"WHERE s.id IN ({replay_ids_sql})"
+    cur = database_con.cursor()
+    # -CAST(-x AS INTEGER) is the ceiling of a positive x
+    cur.execute(f"""
+        WITH strata AS (
+            SELECT stratum, num_replays,
+                   MIN(num_replays, MAX(?, -CAST(-? * num_replays AS INTEGER))) AS sample_size
+            FROM {sample_table_name}_strata
+        ), sample AS (
+            SELECT s.id, 1.0 * st.num_replays / st.sample_size AS weight
+            FROM strata AS st
+            JOIN {sample_table_name} AS s ON s.stratum = st.stratum AND s.rank < st.sample_size
+            {filtered}
+        ), pairs AS (
+            SELECT a1.pokemon AS p1, a2.pokemon AS p2, a1.won AS won, sample.weight AS weight
+            FROM sample
+            JOIN {appearances_table_name} AS a1 ON a1.id = sample.id
+            JOIN {appearances_table_name} AS a2
+            ON a2.id = a1.id AND a2.player = a1.player AND a1.pokemon < a2.pokemon
+        ) SELECT p1, p2, SUM(weight) AS appearances, SUM(weight * won), SUM(weight * (weight - 1)), COUNT(*)
+          FROM pairs
+          GROUP BY p1, p2
+          ORDER BY appearances DESC
+    """, [min_per_stratum, fraction] + params)
+    results = []
+    for p1, p2, appearances, wins, variance, sampled in cur.fetchall():
+        win_rate = wins / appearances
+        correction = max(0.0, 1 - sampled / appearances)
+        results.append((
+            p1,
+            p2,
+            appearances,
+            wins,
+            win_rate,
+            math.sqrt(variance),
+            math.sqrt(win_rate * (1 - win_rate) / sampled * correction),
+            sampled,
+        ))
+    return results
+
+
+def iter_pair_marginal_win_rates_approximate(
+    database_con: sqlite3.Connection,
+    where: Union[str, ReplayFilter] = '',
+    fractions: Sequence[float] = (0.01, 0.1, 1.0),
+    **kwargs,
+):
+    """
+    Yields (fraction, results) for each of fractions in turn, refining
+    get_pair_marginal_win_rates_approximate from a fast first answer
+    towards the exact one (fraction=1). Other keyword arguments are passed
+    on to get_pair_marginal_win_rates_approximate.
+    """
+    for fraction in fractions:
+        yield fraction, get_pair_marginal_win_rates_approximate(database_con, where, fraction, **kwargs)
+
+
+DAY = 60 * 60 * 24
+
+
+def create_moves_table(
+    database_con: sqlite3.Connection,
+    moves_table_name: str = "moves",
+    move_usage_table_name: str = "move_usage",
+    replay_table_name: str = "replays",
+):
+    """
+    Creates (if necessary) and updates a table of the moves used in each
+    replay, and a cube of move usage counts by format, day, species, move
+    and result, so that move usage can be broken down with indexed lookups
+    instead of parsing logs, see get_move_usage. Only replays that haven't
+    been indexed yet are parsed, so this can be rerun after new replays are
+    downloaded; index_replay_moves indexes replays as they are ingested.
+    
+    The tables are defined by the following SQLite statements:
+    
+        CREATE TABLE moves (
+        id TEXT NOT NULL,
+        "order" INTEGER NOT NULL,
+        player TEXT NOT NULL,
+        pokemon TEXT NOT NULL,
+        move TEXT NOT NULL,
+        won INTEGER NOT NULL,
+        PRIMARY KEY(id, "order")) WITHOUT ROWID
+        
+        CREATE TABLE move_usage (
+        format TEXT NOT NULL,
+        day INTEGER NOT NULL,
+        pokemon TEXT NOT NULL,
+        move TEXT NOT NULL,
+        won INTEGER NOT NULL,
+        uses INTEGER NOT NULL,
+        games INTEGER NOT NULL,
+        PRIMARY KEY(format, day, pokemon, move, won)) WITHOUT ROWID
+        
+        CREATE TABLE moves_indexed (
+        id TEXT PRIMARY KEY) WITHOUT ROWID
+    
+    pokemon is the species that used the move and order the index of the
+    move in the battle, as in parse_replay. day is uploadtime // DAY, the
+    number of days since the epoch (UTC). uses counts the times a move was
+    used, and games the games in which a player's pokemon used it at least
+    once, split by whether that player won.
+    """
+    _create_moves_tables(database_con, moves_table_name, move_usage_table_name)
+    decompressor = LogDecompressor(database_con)
+    batch_cur = database_con.cursor()
+    batch_cur.execute(f"""
+        SELECT id, format, log, uploadtime FROM {replay_table_name}
+        WHERE id NOT IN (SELECT id FROM {moves_table_name}_indexed)
+    """)
+    BATCH_SIZE = 10_000
+    batch = batch_cur.fetchmany(BATCH_SIZE)
+    while batch:
+        batch = [(replay_id, format, decompressor.decompress(log), uploadtime) for replay_id, format, log, uploadtime in batch]
+        index_replay_moves(database_con, batch, moves_table_name, move_usage_table_name)
+        batch = batch_cur.fetchmany(BATCH_SIZE)
+
+
+def _create_moves_tables(
+    database_con: sqlite3.Connection,
+    moves_table_name: str = "moves",
+    move_usage_table_name: str = "move_usage",
+):
+    cur = database_con.cursor()
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {moves_table_name} (
+        id TEXT NOT NULL,
+        "order" INTEGER NOT NULL,
+        player TEXT NOT NULL,
+        pokemon TEXT NOT NULL,
+        move TEXT NOT NULL,
+        won INTEGER NOT NULL,
+        PRIMARY KEY(id, "order")) WITHOUT ROWID
+    """)
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {move_usage_table_name} (
+        format TEXT NOT NULL,
+        day INTEGER NOT NULL,
+        pokemon TEXT NOT NULL,
+        move TEXT NOT NULL,
+        won INTEGER NOT NULL,
+        uses INTEGER NOT NULL,
+        games INTEGER NOT NULL,
+        PRIMARY KEY(format, day, pokemon, move, won)) WITHOUT ROWID
+    """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS {move_usage_table_name}_pokemon_idx
+        ON {move_usage_table_name}(pokemon, format, day)
+    """)
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {moves_table_name}_indexed (
+        id TEXT PRIMARY KEY) WITHOUT ROWID
+    """)
+
+
+def index_replay_moves(
+    database_con: sqlite3.Connection,
+    replays: Sequence[tuple],
+    moves_table_name: str = "moves",
+    move_usage_table_name: str = "move_usage",
+):
+    """
+    Adds replays, given as (id, format, log, uploadtime) tuples with
+    uncompressed logs, to the moves table and their counts to the move
+    usage cube. Replays that were already indexed are skipped, so their
+    moves are never counted twice. Logs that can't be parsed are marked as
+    indexed without any moves.
+    """
+    _create_moves_tables(database_con, moves_table_name, move_usage_table_name)
+    cur = database_con.cursor()
+    moves = []
+    usage = {}
+    for replay_id, format, log, uploadtime in replays:
+        cur.execute(f"INSERT OR IGNORE INTO {moves_table_name}_indexed VALUES(?)", (replay_id,))
+        if cur.rowcount == 0:
+            continue
+        try:
+            parsed_replay = parse_replay(log)
+        except KeyError:
+            continue
+        day = int(uploadtime) // DAY
+        used = set()
+        for move in parsed_replay['moves']:
+            won = 1 if move['player'] == parsed_replay['winner'] else 0
+            moves.append((replay_id, move['order'], move['player'], move['species'], move['move'], won))
+            key = (format, day, move['species'], move['move'], won)
+            counts = usage.setdefault(key, [0, 0])
+            counts[0] += 1
+            if (key, move['player']) not in used:
+                used.add((key, move['player']))
+                counts[1] += 1
+    cur.executemany(f"INSERT OR IGNORE INTO {moves_table_name} VALUES(?, ?, ?, ?, ?, ?)", moves)
+    cur.executemany(f"""
+        INSERT INTO {move_usage_table_name} VALUES(?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(format, day, pokemon, move, won)
+        DO UPDATE SET uses = uses + excluded.uses, games = games + excluded.games
+    """, [key + tuple(counts) for key, counts in usage.items()])
+    database_con.commit()
+
+
+def _get_move_usage_clauses(
+    pokemon: Optional[str],
+    formats: Sequence[str],
+    day_start: Optional[int],
+    day_end: Optional[int],
+) -> Tuple[list, list]:
+    clauses = ["1"]
+    params = []
+    if pokemon is not None:
+        clauses.append("pokemon = ?")
+        params.append(pokemon)
+    if formats:
+        clauses.append(f"format IN ({', '.join('?' for _ in formats)})")
+        params.extend(formats)
+    if day_start is not None:
+        clauses.append("day >= ?")
+        params.append(day_start)
+    if day_end is not None:
+        clauses.append("day < ?")
+        params.append(day_end)
+    return clauses, params
+
+
+def get_move_usage(
+    database_con: sqlite3.Connection,
+    pokemon: Optional[str] = None,
+    formats: Sequence[str] = (),
+    day_start: Optional[int] = None,
+    day_end: Optional[int] = None,
+    move_usage_table_name: str = "move_usage",
+):
+    """
+    Returns (pokemon, move, uses, games, wins, percent_used) for the moves
+    of one species, or of every species if pokemon is None, read from the
+    move usage cube (see create_moves_table). Results can be restricted to
+    formats and to the half-open range of days [day_start, day_end), see
+    DAY. wins counts the games won by the player whose pokemon used the
+    move, and percent_used is the share of the species' move uses, in
+    percent. Rows are ordered by pokemon, then by uses.
+    """
+    clauses, params = _get_move_usage_clauses(pokemon, formats, day_start, day_end)
+    cur = database_con.cursor()
+    cur.execute(f"""
+        SELECT pokemon, move, SUM(uses) AS total_uses, SUM(games), SUM(won * games),
+               100.0 * SUM(uses) / SUM(SUM(uses)) OVER (PARTITION BY pokemon)
+        FROM {move_usage_table_name}
+        WHERE {" AND ".join(clauses)}
+        GROUP BY pokemon, move
+        ORDER BY pokemon, total_uses DESC
+    """, params)
+    return cur.fetchall()
+
+
+def get_daily_move_usage(
+    database_con: sqlite3.Connection,
+    pokemon: str,
+    move: Optional[str] = None,
+    formats: Sequence[str] = (),
+    day_start: Optional[int] = None,
+    day_end: Optional[int] = None,
+    move_usage_table_name: str = "move_usage",
+):
+    """
+    Returns (day, move, uses, games, wins) for each day a species used a
+    move, or only the given move, ordered by day, to follow how usage
+    changes over time. Arguments are as in get_move_usage.
+    """
+    clauses, params = _get_move_usage_clauses(pokemon, formats, day_start, day_end)
+    if move is not None:
+        clauses.append("move = ?")
+        params.append(move)
+    cur = database_con.cursor()
+    cur.execute(f"""
+        SELECT day, move, SUM(uses), SUM(games), SUM(won * games)
+        FROM {move_usage_table_name}
+        WHERE {" AND ".join(clauses)}
+        GROUP BY day, move
+        ORDER BY day, move
+    """, params)
+    return cur.fetchall()
@@ -0,0 +1,292 @@
+"""
+Functions for a local store of one user's public replays, so that the
+report card only searches and downloads what it hasn't seen before.
+
+Each user gets an SQLite database, {directory}/{userid}.db, with the
+following tables:
+
+    CREATE TABLE replays (
+        id TEXT PRIMARY KEY,
+        format TEXT NOT NULL,
+        players TEXT NOT NULL,
+        log TEXT,
+        uploadtime INTEGER NOT NULL,
+        rating INTEGER)
+
+    CREATE TABLE appearances (
+        id TEXT NOT NULL,
+        appearance_order INTEGER NOT NULL,
+        player TEXT NOT NULL,
+        pokemon TEXT NOT NULL,
+        won INTEGER NOT NULL,
+        PRIMARY KEY(id, appearance_order)) WITHOUT ROWID
+
+    CREATE TABLE moves (
+        id TEXT NOT NULL,
+        "order" INTEGER NOT NULL,
+        player TEXT NOT NULL,
+        pokemon TEXT NOT NULL,
+        move TEXT NOT NULL,
+        PRIMARY KEY(id, "order")) WITHOUT ROWID
+
+    CREATE TABLE searched (
+        start INTEGER NOT NULL,
+        end INTEGER NOT NULL)
+
+replays holds search results, with a NULL log until the replay has been
+downloaded. appearances and moves are derived from each log as it is
+stored, for both players: appearance_order is the index of the switch-in
+in the battle and order the index of the move, as in parse_replay.
+searched holds the single uploadtime range that has already been
+searched, so a refresh only searches outside of it.
+"""
+import os
+import sqlite3
+import time
+import pandas as pd
+
+from requests import Session
+from typing import Callable, Optional
+
+from pokemon_showdown_replay_tools import download
+from pokemon_showdown_replay_tools.analysis import APPEARANCE_DTYPES, MOVE_DTYPES, parse_replays
+from pokemon_showdown_replay_tools.sqlite import to_user_id
+
+
+def open_user_store(directory: str, username: str) -> sqlite3.Connection:
+    """
+    Opens (creating it if necessary) the store of username in directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    con = sqlite3.connect(os.path.join(directory, f"{to_user_id(username)}.db"), timeout=30)
+    cur = con.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS replays (
+        id TEXT PRIMARY KEY,
+        format TEXT NOT NULL,
+        players TEXT NOT NULL,
+        log TEXT,
+        uploadtime INTEGER NOT NULL,
+        rating INTEGER)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS replays_uploadtime_idx ON replays(uploadtime)
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS appearances (
+        id TEXT NOT NULL,
+        appearance_order INTEGER NOT NULL,
+        player TEXT NOT NULL,
+        pokemon TEXT NOT NULL,
+        won INTEGER NOT NULL,
+        PRIMARY KEY(id, appearance_order)) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS moves (
+        id TEXT NOT NULL,
+        "order" INTEGER NOT NULL,
+        player TEXT NOT NULL,
+        pokemon TEXT NOT NULL,
+        move TEXT NOT NULL,
+        PRIMARY KEY(id, "order")) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS searched (
+        start INTEGER NOT NULL,
+        end INTEGER NOT NULL)
+    """)
+    con.commit()
+    return con
+
+
+def _search_user_replays(
+    username: str,
+    start: int,
+    end: int,
+    session: Optional[Session] = None,
+) -> list:
+    """
+    Returns the search results for username's replays uploaded before end,
+    paging back until start. The last page may reach further back.
+    """
+    results = []
+    before = end
+    while True:
+        search_result = download.search(before=before, format=None, username=username, session=session)
+        results.extend(search_result)
+        if not search_result:
+            break
+        next_before = int(search_result[-1]['uploadtime'])
+        if next_before < start or next_before >= before:
+            break
+        before = next_before
+    return results
+
+
+def add_search_results(database_con: sqlite3.Connection, search_results: list):
+    """
+    Adds search results to the replays table. Replays already in the store
+    are left untouched.
+    """
+    database_con.executemany(
+        "INSERT OR IGNORE INTO replays VALUES(?, ?, ?, NULL, ?, ?)",
+        [
+            (r['id'], r['format'], ','.join(r['players']), int(r['uploadtime']), r.get('rating'))
+            for r in search_results
+        ],
+    )
+    database_con.commit()
+
+
+def add_replays(database_con: sqlite3.Connection, replays: list):
+    """
+    Stores downloaded replays (as returned by download.get_replay) and
+    derives their appearances and moves. Logs that can't be parsed are
+    stored without derived rows.
+    """
+    cur = database_con.cursor()
+    cur.executemany(
+        "INSERT OR IGNORE INTO replays VALUES(?, ?, ?, NULL, ?, ?)",
+        [
+            (r['id'], r['format'], ','.join(r['players']), int(r['uploadtime']), r.get('rating'))
+            for r in replays
+        ],
+    )
+    cur.executemany("UPDATE replays SET log = ? WHERE id = ?", [(r['log'], r['id']) for r in replays])
+    parsed = parse_replays((r['id'], r['log']) for r in replays)
+    cur.executemany(
+        "INSERT OR REPLACE INTO appearances VALUES(?, ?, ?, ?, ?)",
+        parsed["appearances"].loc[:, ["id", "appearance_order", "player", "pokemon", "won"]]
+        .astype(object).itertuples(index=False, name=None),
+    )
+    cur.executemany(
+        "INSERT OR REPLACE INTO moves VALUES(?, ?, ?, ?, ?)",
+        parsed["moves"].loc[:, ["id", "order", "player", "pokemon", "move"]]
+        .astype(object).itertuples(index=False, name=None),
+    )
+    database_con.commit()
+
+
+def refresh_user_store(
+    database_con: sqlite3.Connection,
+    username: str,
+    start: int,
+    end: int,
+    session: Optional[Session] = None,
+    max_workers: int = 10,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    chunk_size: int = 50,
+    stored_callback: Optional[Callable[[int], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+):
+    """
+    Brings the store up to date for replays uploaded between start and end
+    (Unix timestamps). Only the parts of that range outside the searched
+    range are searched, typically just the replays newer than the last
+    refresh, and only replays without a stored log are downloaded.
+    
+    Replays are downloaded newest first, chunk_size at a time, and each
+    chunk is stored as soon as it arrives, so readers can use the store
+    while the refresh runs. progress_callback(completed, total) is called
+    after each download, and stored_callback(stored) after each chunk with
+    the number of replays stored so far. If should_stop() returns True
+    before a chunk, the refresh stops there, and the search is redone by
+    the next refresh.
+    
+    One pooled session (see download.create_session) is used for the
+    search and every chunk, unless session is given.
+    """
+    cur = database_con.cursor()
+    end = min(end, int(time.time()))
+    row = cur.execute("SELECT start, end FROM searched").fetchone()
+    if row is None:
+        ranges = [(start, end)]
+        searched = (start, end)
+    else:
+        searched_start, searched_end = row
+        ranges = []
+        if end > searched_end:
+            ranges.append((searched_end, end))
+        if start < searched_start:
+            ranges.append((start, searched_start))
+        searched = (min(start, searched_start), max(end, searched_end))
+    owns_session = session is None
+    session = session or download.create_session(pool_size=max_workers)
+    try:
+        for range_start, range_end in ranges:
+            add_search_results(database_con, _search_user_replays(username, range_start, range_end, session))
+
+        missing_ids = [row[0] for row in cur.execute(
+            "SELECT id FROM replays WHERE log IS NULL AND uploadtime BETWEEN ? AND ? ORDER BY uploadtime DESC",
+            (start, end),
+        )]
+        for chunk_start in range(0, len(missing_ids), chunk_size):
+            if should_stop is not None and should_stop():
+                return
+            chunk_ids = missing_ids[chunk_start:chunk_start + chunk_size]
+            def chunk_progress(completed: int, total: int):
+                if progress_callback is not None:
+                    progress_callback(chunk_start + completed, len(missing_ids))
+            replays = download.get_replays(
+                chunk_ids,
+                session=session,
+                max_workers=max_workers,
+                progress_callback=chunk_progress,
+            )
+            add_replays(database_con, [replay for replay in replays if replay is not None])
+            if stored_callback is not None:
+                stored_callback(chunk_start + len(chunk_ids))
+    finally:
+        if owns_session:
+            session.close()
+    # Only record the search once the replays are stored, so an interrupted refresh is redone
+    cur.execute("DELETE FROM searched")
+    cur.execute("INSERT INTO searched VALUES(?, ?)", searched)
+    database_con.commit()
+
+
+def load_user_replays(database_con: sqlite3.Connection, start: int, end: int) -> pd.DataFrame:
+    """
+    Returns the stored replays uploaded between start and end, without
+    their logs, ordered by uploadtime. The downloaded and parsed columns
+    tell whether the replay was downloaded, and parsed.
+    """
+    return pd.read_sql("""
+        SELECT id, format, players, uploadtime, rating, log IS NOT NULL AS downloaded,
+               EXISTS (SELECT 1 FROM appearances AS a WHERE a.id = r.id) AS parsed
+        FROM replays AS r
+        WHERE uploadtime BETWEEN ? AND ?
+        ORDER BY uploadtime
+    """, database_con, params=(start, end))
+
+
+def load_user_appearances(database_con: sqlite3.Connection, username: str, start: int, end: int) -> pd.DataFrame:
+    """
+    Returns the appearances of username's pokemon in the replays uploaded
+    between start and end, with the columns id, player, pokemon, won and
+    appearance_order, typed as in analysis.APPEARANCE_DTYPES.
+    """
+    return pd.read_sql("""
+        SELECT a.id, a.player, a.pokemon, a.won, a.appearance_order
+        FROM appearances AS a
+        JOIN replays AS r ON r.id = a.id
+        WHERE lower(a.player) = ? AND r.uploadtime BETWEEN ? AND ?
+        ORDER BY r.uploadtime, a.id, a.appearance_order
+    """, database_con, params=(username.lower(), start, end)).astype(APPEARANCE_DTYPES)
+
+
+def load_user_moves(database_con: sqlite3.Connection, username: str, start: int, end: int) -> pd.DataFrame:
+    """
+    Returns the moves used by username's pokemon in the replays uploaded
+    between start and end, with the columns id, pokemon, move and order,
+    typed as in analysis.MOVE_DTYPES.
+    """
+    return pd.read_sql("""
+        SELECT m.id, m.pokemon, m.move, m."order"
+        FROM moves AS m
+        JOIN replays AS r ON r.id = m.id
+        WHERE lower(m.player) = ? AND r.uploadtime BETWEEN ? AND ?
+        ORDER BY r.uploadtime, m.id, m."order"
+    """, database_con, params=(username.lower(), start, end)).astype({
+        name: dtype for name, dtype in MOVE_DTYPES.items() if name != "player"
+    })
@@ -0,0 +1,62 @@
+import argparse
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+
+from pokemon_showdown_replay_tools.analysis import get_pair_win_rate_intervals
+
+
+parser = argparse.ArgumentParser(
+    prog='benchmark_bootstrap',
+    description='Compare vectorized and per-pair bootstrap confidence intervals for pair win rates',
+)
+
+parser.add_argument('-n', '--database', help="SQLite database name")
+parser.add_argument('-r', '--resamples', default=1000)
+parser.add_argument('-p', '--naive_pairs', default=100, help="Number of pairs to time the per-pair loop on")
+parser.add_argument('-m', '--memory_budget', default=256, help="Memory budget in MiB")
+
+
+def naive_pair_win_rate_intervals(pairs: pd.DataFrame, num_resamples: int, confidence: float = 0.95):
+    """
+    Resamples the games of each pair separately, one pair at a time.
+    """
+    rng = np.random.default_rng()
+    alpha = (1 - confidence) / 2
+    results = []
+    for (p1, p2), group_df in pairs.groupby(by=["pokemon1", "pokemon2"]):
+        won = group_df.won1.to_numpy()
+        rates = [rng.choice(won, size=len(won)).mean() for _ in range(num_resamples)]
+        ci_low, ci_high = np.percentile(rates, [100 * alpha, 100 * (1 - alpha)])
+        results.append((p1, p2, ci_low, ci_high))
+    return results
+
+
+def main(db_name: str, num_resamples: int, naive_pairs: int, memory_budget: int):
+    con = sqlite3.connect(db_name)
+    try:
+        df = pd.read_sql("SELECT id, player, pokemon, won FROM appearances", con)
+    finally:
+        con.close()
+
+    start = time.perf_counter()
+    result = get_pair_win_rate_intervals(df, num_resamples, memory_budget=memory_budget * 2**20)
+    vectorized = time.perf_counter() - start
+    print(f"Vectorized: {len(result)} pairs, {num_resamples} resamples in {vectorized:.2f}s")
+
+    pairs = df.merge(df, on=["id", "player"], suffixes=("1", "2"))
+    pairs = pairs[pairs.pokemon1 < pairs.pokemon2]
+    sample = result.loc[:naive_pairs - 1, ["p1", "p2"]]
+    pairs = pairs.merge(sample, left_on=["pokemon1", "pokemon2"], right_on=["p1", "p2"])
+    start = time.perf_counter()
+    naive_pair_win_rate_intervals(pairs, num_resamples)
+    naive = time.perf_counter() - start
+    estimate = naive / len(sample) * len(result)
+    print(f"Per-pair loop: {len(sample)} pairs in {naive:.2f}s, about {estimate:.1f}s for all pairs")
+    print(f"Speedup: {estimate / vectorized:.1f}x")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args.database, int(args.resamples), int(args.naive_pairs), int(args.memory_budget))
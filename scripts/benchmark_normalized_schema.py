@@ -0,0 +1,121 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from pokemon_showdown_replay_tools.sqlite import (
+    ReplayFilter,
+    create_appearances_table,
+    get_pair_marginal_win_rates,
+    get_pair_marginal_win_rates_conditional,
+    migrate_to_normalized_schema,
+)
+
+
+parser = argparse.ArgumentParser(
+    prog='benchmark_normalized_schema',
+    description='Compare size and query speed of the appearances table and the normalized schema',
+)
+
+parser.add_argument('-n', '--database', help="SQLite database name")
+parser.add_argument('-r', '--repeat', default=3)
+
+LEGACY_TABLES = ("appearances", "sqlite_autoindex_appearances_1", "marginal_idx")
+NORMALIZED_TABLES = (
+    "replay_facts", "sqlite_autoindex_replay_facts_1",
+    "replay_facts_format_uploadtime_rating_idx", "replay_facts_uploadtime_rating_idx",
+    "species", "sqlite_autoindex_species_1",
+    "players", "sqlite_autoindex_players_1",
+    "replay_players", "replay_players_player_idx",
+    "team_appearances", "team_appearances_species_idx",
+)
+
+
+def copy_database(db_name: str, copy_name: str):
+    src = sqlite3.connect(db_name)
+    dst = sqlite3.connect(copy_name)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
+
+
+def table_sizes(con: sqlite3.Connection, names: tuple):
+    """
+    Returns the number of bytes used by the given tables and indexes.
+    Requires SQLite to be compiled with the dbstat virtual table.
+    """
+    placeholders = ", ".join("?" for _ in names)
+    try:
+        result = con.execute(
+            f"SELECT SUM(pgsize) FROM dbstat WHERE name IN ({placeholders})",
+            names,
+        ).fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+    return result or 0
+
+
+def time_queries(con: sqlite3.Connection, repeat: int):
+    min_time, max_time = con.execute("SELECT MIN(uploadtime), MAX(uploadtime) FROM replays").fetchone()
+    one_week = 60 * 60 * 24 * 7
+    queries = {
+        "all pairs": lambda: get_pair_marginal_win_rates(con),
+        "last week": lambda: get_pair_marginal_win_rates_conditional(
+            con, ReplayFilter(uploadtime_start=max_time - one_week)),
+        "rating >= 1300": lambda: get_pair_marginal_win_rates_conditional(
+            con, ReplayFilter(rating_min=1300)),
+    }
+    timings = {}
+    for name, query in queries.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query()
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        timings[name] = best
+    return timings
+
+
+def main(db_name: str, repeat: int):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        legacy_name = os.path.join(tmpdir, "legacy.db")
+        normalized_name = os.path.join(tmpdir, "normalized.db")
+        print(f"Copying {db_name}")
+        copy_database(db_name, legacy_name)
+
+        con = sqlite3.connect(legacy_name)
+        try:
+            create_appearances_table(con)
+            legacy_size = table_sizes(con, LEGACY_TABLES)
+            legacy_timings = time_queries(con, repeat)
+        finally:
+            con.close()
+
+        copy_database(legacy_name, normalized_name)
+        con = sqlite3.connect(normalized_name)
+        try:
+            start = time.perf_counter()
+            migrate_to_normalized_schema(con)
+            print(f"Migration took {time.perf_counter() - start:.2f}s")
+            normalized_size = table_sizes(con, NORMALIZED_TABLES)
+            normalized_timings = time_queries(con, repeat)
+        finally:
+            con.close()
+
+    if legacy_size is None:
+        print("dbstat is unavailable, skipping size comparison")
+    else:
+        print(f"appearances tables: {legacy_size / 2**20:.1f} MiB")
+        print(f"normalized tables: {normalized_size / 2**20:.1f} MiB")
+    for name in legacy_timings:
+        legacy, normalized = legacy_timings[name], normalized_timings[name]
+        print(f"{name}: appearances {legacy:.3f}s, normalized {normalized:.3f}s ({legacy / normalized:.1f}x)")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args.database, int(args.repeat))
@@ -0,0 +1,47 @@
+import argparse
+import os
+import sqlite3
+import time
+
+from pokemon_showdown_replay_tools.compression import (
+    compress_replay_logs,
+    get_log_compressor,
+    train_log_dictionary,
+)
+
+
+parser = argparse.ArgumentParser(
+    prog='compress_logs',
+    description='Convert the replay logs in a database to zstd-compressed BLOBs',
+)
+
+parser.add_argument('-n', '--database', help="SQLite database name")
+parser.add_argument('-t', '--train', action='store_true', help="train a new dictionary even if one exists")
+parser.add_argument('-s', '--sample_size', default=2000, help="number of logs to train the dictionary on")
+parser.add_argument('-l', '--level', default=3, help="zstd compression level")
+parser.add_argument('--vacuum', action='store_true', help="VACUUM the database afterwards to shrink the file")
+
+
+def main(db_name: str, train: bool, sample_size: int, level: int, vacuum: bool):
+    size_before = os.path.getsize(db_name)
+    con = sqlite3.connect(db_name)
+    try:
+        if train:
+            dict_id = train_log_dictionary(con, sample_size)
+            print(f"Trained dictionary {dict_id} on {sample_size} logs")
+        compressor = get_log_compressor(con, level)
+        start = time.time()
+        num_converted = compress_replay_logs(con, compressor=compressor)
+        print(f"Compressed {num_converted} logs in {time.time() - start:.2f}s")
+        if vacuum:
+            print("Running VACUUM")
+            con.execute("VACUUM")
+    finally:
+        con.close()
+    size_after = os.path.getsize(db_name)
+    print(f"Database size went from {size_before / 2**20:.1f} MiB to {size_after / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args.database, args.train, int(args.sample_size), int(args.level), args.vacuum)
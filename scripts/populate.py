@@ -13,6 +13,7 @@ from prefect.tasks import task_input_hash
 from typing import Optional
 
 from pokemon_showdown_replay_tools import download
+from pokemon_showdown_replay_tools.compression import compress_log, get_log_compressor
 
 search = task(download.search, cache_policy=INPUTS + TASK_SOURCE)
 get_replay = task(download.get_replay, cache_policy=INPUTS + TASK_SOURCE)
@@ -27,9 +28,10 @@ parser.add_argument('-s', '--start', help="timestamp in format %%Y-%%m-%%d_%%H:%
 parser.add_argument('-e', '--end', help="timestamp in format %%Y-%%m-%%d_%%H:%%M:%%S", default="2024-11-01_14:00:00")
 parser.add_argument('-f', '--format', help="meta format", default="gen9vgc2024regh")
 parser.add_argument('-b', '--batch_size', default=50)
+parser.add_argument('-z', '--compress', action='store_true', help="store logs zstd-compressed")
 
 @flow(retries=3, retry_delay_seconds=1, log_prints=True)
-def download_date_range(db_name: str, format: str, start: datetime, end: datetime, batch_size: int = 50):
+def download_date_range(db_name: str, format: str, start: datetime, end: datetime, batch_size: int = 50, compress: bool = False):
     create_replay_table(db_name)
     
     remaining_searches: list[datetime] = [end]
@@ -96,7 +98,7 @@ def download_date_range(db_name: str, format: str, start: datetime, end: datetim
                 if not future.state.is_cancelled()
             ]
             print(f"Persisting {len(ready_replays)} replays")
-            persist_replays(db_name, ready_replays)
+            persist_replays(db_name, ready_replays, compress=compress)
             replay_futures = []
 
 
@@ -118,13 +120,22 @@ def create_replay_table(db_name: str, table_name: str = "replays"):
 
 
 @task(retries=3, retry_delay_seconds=1, log_prints=True)
-def persist_replays(db_name: str, replay_data: list[dict], table_name: str = "replays"):
+def persist_replays(db_name: str, replay_data: list[dict], table_name: str = "replays", compress: bool = False):
     con = sqlite3.connect(db_name)
     cur = con.cursor()
     try:
+        compressor = get_log_compressor(con, replay_table_name=table_name) if compress else None
         for replay in replay_data:
             log = replay['log'].replace('"', '""')
             players = ",".join(replay['players'])
+            if compressor is not None:
+                # BLOBs can't be spliced into the statement, so bind parameters instead
+                cur.execute(
+                    f"INSERT INTO {table_name} (id, format, players, log, uploadtime, rating) VALUES(?, ?, ?, ?, ?, ?)",
+                    (replay['id'], replay['formatid'], players, compress_log(compressor, replay['log']),
+                     replay['uploadtime'], replay['rating'] or None),
+                )
+                continue
             rating = replay['rating'] or "null"
             cmd = f"""INSERT INTO {table_name}
             (id, format, players, log, uploadtime, rating)
@@ -143,13 +154,13 @@ def concurrency_limited_get_replay(replay_id: str):
     return download.get_replay(replay_id)
 
 
-def main(db_name: str, format: str, start: str, end: str, batch_size: int):
+def main(db_name: str, format: str, start: str, end: str, batch_size: int, compress: bool):
     start = datetime.strptime(start, "%Y-%m-%d_%H:%M:%S")
     end = datetime.strptime(end, "%Y-%m-%d_%H:%M:%S")
-    download_date_range(db_name, format, start, end, batch_size)
+    download_date_range(db_name, format, start, end, batch_size, compress)
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    main(args.database, args.format, args.start, args.end, int(args.batch_size))
+    main(args.database, args.format, args.start, args.end, int(args.batch_size), args.compress)
 
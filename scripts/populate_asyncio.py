@@ -12,6 +12,8 @@ from typing import Optional
 from urllib3.util import Retry
 
 from pokemon_showdown_replay_tools import download
+from pokemon_showdown_replay_tools.compression import compress_log, get_log_compressor
+from pokemon_showdown_replay_tools.sqlite import index_player_games, index_replay_events, index_replay_leads, index_replay_moves
 
 
 parser = argparse.ArgumentParser(
@@ -26,9 +28,14 @@ parser.add_argument('-e', '--end', help="timestamp in format %%Y-%%m-%%d_%%H:%%M
 parser.add_argument('-f', '--format', help="meta format", default="gen9vgc2024regh")
 parser.add_argument('-b', '--batch_size', default=51)
 parser.add_argument('-p', '--pool_size', default=500)
+parser.add_argument('-z', '--compress', action='store_true', help="store logs zstd-compressed")
+parser.add_argument('-i', '--index_events', action='store_true', help="add replays to the event index as they are stored")
+parser.add_argument('--index_players', action='store_true', help="add replays to the player_games table as they are stored")
+parser.add_argument('--index_moves', action='store_true', help="add replays to the moves table and move usage cube as they are stored")
+parser.add_argument('--index_leads', action='store_true', help="add replays to the leads table as they are stored")
 
 
-async def download_date_range(db_name: str, format: str, start: datetime, end: datetime, batch_size: int, pool_size: int):
+async def download_date_range(db_name: str, format: str, start: datetime, end: datetime, batch_size: int, pool_size: int, compress: bool = False, index_events: bool = False, index_players: bool = False, index_moves: bool = False, index_leads: bool = False):
     create_replay_table(db_name)
     existing_replays = set(get_existing_replays(db_name))
     print(f"Found {len(existing_replays)} existing replays")
@@ -71,7 +78,7 @@ async def download_date_range(db_name: str, format: str, start: datetime, end: d
                 get_replay_tasks = get_replay_tasks[batch_size:]
                 print(f"Persisting {len(ready_replays)} replays")
                 num_replays += len(ready_replays)
-                persist_replays(db_name, ready_replays)
+                persist_replays(db_name, ready_replays, compress=compress, index_events=index_events, index_players=index_players, index_moves=index_moves, index_leads=index_leads)
             
             cur_time = time.time()
             if cur_time - last_print > print_delay:
@@ -89,7 +96,7 @@ async def download_date_range(db_name: str, format: str, start: datetime, end: d
             ]
             print(f"Persisting {len(ready_replays)} replays")
             num_replays += len(ready_replays)
-            persist_replays(db_name, ready_replays)
+            persist_replays(db_name, ready_replays, compress=compress, index_events=index_events, index_players=index_players, index_moves=index_moves, index_leads=index_leads)
         
         cur_time = time.time()
         total_duration = cur_time - loop_start
@@ -138,13 +145,16 @@ def get_min_uploadtime(db_name: str, format: str, table_name: str = "replays"):
     return uploadtime
 
 
-def persist_replays(db_name: str, replay_data: list[dict], table_name: str = "replays"):
+def persist_replays(db_name: str, replay_data: list[dict], table_name: str = "replays", compress: bool = False, index_events: bool = False, index_players: bool = False, index_moves: bool = False, index_leads: bool = False):
     con = sqlite3.connect(db_name)
     cur = con.cursor()
     try:
+        compressor = get_log_compressor(con, replay_table_name=table_name) if compress else None
         data = []
         for replay in replay_data:
             log = replay['log'].replace('"', '""')
+            if compressor is not None:
+                log = compress_log(compressor, log)
             try:
                 players = ",".join(replay['players'])
                 rating = replay['rating'] or "null"
@@ -165,6 +175,22 @@ def persist_replays(db_name: str, replay_data: list[dict], table_name: str = "re
         cmd = f"INSERT INTO {table_name} (id, format, players, log, uploadtime, rating) VALUES(?, ?, ?, ?, ?, ?)"
         cur.executemany(cmd, data)
         con.commit()
+        if index_events:
+            index_replay_events(con, [(replay['id'], replay['log']) for replay in replay_data])
+        if index_players:
+            index_player_games(con, [
+                (replay_id, format, players, replay['log'], uploadtime, rating)
+                for (replay_id, format, players, _, uploadtime, rating), replay in zip(data, replay_data)
+                if format != "error"
+            ])
+        if index_moves:
+            index_replay_moves(con, [
+                (replay_id, format, replay['log'], uploadtime)
+                for (replay_id, format, _, _, uploadtime, _), replay in zip(data, replay_data)
+                if format != "error"
+            ])
+        if index_leads:
+            index_replay_leads(con, [(replay['id'], replay['log']) for replay in replay_data])
     finally:
         con.close()
 
@@ -209,10 +235,10 @@ def get_replay(replay_id: str, session: Session):
         return {"id": replay_id, "log": "error"}
 
 
-async def main(db_name: str, format: str, start: str, end: str, batch_size: int, pool_size: int):
+async def main(db_name: str, format: str, start: str, end: str, batch_size: int, pool_size: int, compress: bool, index_events: bool, index_players: bool, index_moves: bool, index_leads: bool):
     start = datetime.strptime(start, "%Y-%m-%d_%H:%M:%S")
     end = datetime.strptime(end, "%Y-%m-%d_%H:%M:%S")
-    await download_date_range(db_name, format, start, end, batch_size, pool_size)
+    await download_date_range(db_name, format, start, end, batch_size, pool_size, compress, index_events, index_players, index_moves, index_leads)
 
 
 if __name__ == "__main__":
@@ -226,5 +252,10 @@ if __name__ == "__main__":
             args.end,
             int(args.batch_size),
             int(args.pool_size),
+            args.compress,
+            args.index_events,
+            args.index_players,
+            args.index_moves,
+            args.index_leads,
         )
     )
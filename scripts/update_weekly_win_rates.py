@@ -0,0 +1,44 @@
+import argparse
+import sqlite3
+import time
+
+from datetime import datetime, timezone
+
+from pokemon_showdown_replay_tools.parquet import WEEK, update_weekly_pair_win_rates
+from pokemon_showdown_replay_tools.sqlite import create_appearances_table
+
+
+parser = argparse.ArgumentParser(
+    prog='update_weekly_win_rates',
+    description='Append newly completed weeks to the weekly pair win rate dataset read by win_rate_plotter',
+)
+
+parser.add_argument('-n', '--database', help="SQLite database name")
+parser.add_argument('-o', '--output', help="dataset directory", default="streamlit_apps/win_rates")
+parser.add_argument('-f', '--format', action='append', default=[], help="meta format, may be given more than once (default: all)")
+parser.add_argument('-r', '--rating_min', default=1300, help="minimum replay rating")
+parser.add_argument('--interval', default=None, help="keep running, checking for new weeks every this many seconds")
+
+
+def main(db_name: str, root: str, formats: list, rating_min: int):
+    con = sqlite3.connect(db_name)
+    try:
+        start = time.time()
+        # Parse the replays downloaded since the last run, so their weeks are complete
+        create_appearances_table(con)
+        added_weeks = update_weekly_pair_win_rates(con, root, formats, rating_min)
+    finally:
+        con.close()
+    for week in added_weeks:
+        print(f"Wrote the week starting {datetime.fromtimestamp(week * WEEK, timezone.utc):%Y-%m-%d}")
+    print(f"Wrote {len(added_weeks)} weeks in {time.time() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print(f"run with args {args}")
+    while True:
+        main(args.database, args.output, args.format, int(args.rating_min))
+        if args.interval is None:
+            break
+        time.sleep(float(args.interval))
@@ -4,14 +4,12 @@ import streamlit as st
 
 from matplotlib import pyplot as plt
 
-st.header("Format Ratings")
+from pokemon_showdown_replay_tools.report_card import rerun_while_loading, wait_for_report_data
 
-search_df = st.session_state.get('search_df', None)
-if search_df is None:
-    st.warning("Load some data first")
-    st.stop()
+st.header("Format Ratings")
 
-search_df = search_df.copy()
+loading = wait_for_report_data(st.session_state)
+search_df = st.session_state['search_df'].copy()
 
 selection_mask = st.session_state['selection_mask']
 search_df = search_df[selection_mask]
@@ -27,4 +25,6 @@ for label, group_df in search_df.groupby(by='format'):
 sns.lineplot(search_df, x='game_num', y='rating', hue='format', ax=ax)
 sns.move_legend(ax, "upper left", bbox_to_anchor=(1, 1))
 ax.set_title(f"Rating for {st.session_state['report_username']}")
-st.write(fig)
\ No newline at end of file
+st.write(fig)
+
+rerun_while_loading(loading)
\ No newline at end of file
@@ -1,38 +1,50 @@
+import os
 import pandas as pd
 import seaborn as sns
 import streamlit as st
 
 from matplotlib import pyplot as plt
 
+from pokemon_showdown_replay_tools.parquet import get_pair_summary, read_pair_summary, read_weekly_pair_win_rates
+
+
+# Kept up to date by scripts/update_weekly_win_rates.py
+WIN_RATES_DIRECTORY = os.environ.get("WIN_RATES_DIRECTORY", "streamlit_apps/win_rates")
+
 sns.set_style('darkgrid')
 
-@st.cache_resource
-def get_data():
-    df = pd.read_parquet('streamlit_apps/win_rates.1732576965.parquet')
+def get_data_version():
+    try:
+        return os.path.getmtime(os.path.join(WIN_RATES_DIRECTORY, "summary.parquet"))
+    except FileNotFoundError:
+        return None
+
+@st.cache_resource(max_entries=1)
+def get_data(version):
+    if version is None:
+        # The dataset built by hand before the update script existed
+        df = pd.read_parquet('streamlit_apps/win_rates.1732576965.parquet')
+        summary_df = get_pair_summary(df)
+    else:
+        df = read_weekly_pair_win_rates(WIN_RATES_DIRECTORY)
+        summary_df = read_pair_summary(WIN_RATES_DIRECTORY)
     df.win_rate = df.win_rate * 100
-    return df
+    summary_df.win_rate = summary_df.win_rate * 100
+    summary_df.sq_error_mean = summary_df.sq_error_mean * 100**2
+    summary_df.sq_error_std = summary_df.sq_error_std * 100**2
+    return df, summary_df
 
-df = get_data()
+df, summary_df = get_data(get_data_version())
 
 
 with st.sidebar:
-    mean_win_rate = df.groupby(by=["pair"]).win_rate.mean()
-    mse_df = df.set_index('pair')
-    mse_df['mean_win_rate'] = mean_win_rate
-    mse_df['sq_error'] = (mse_df.mean_win_rate - mse_df.win_rate)**2
-    mse_df = mse_df.groupby(by='pair').agg({
-        "sq_error": ["mean", "std", "size"],
-        "appearances": "sum",
-        "week": "count",
-        "win_rate": "mean",
-    })
-    mse_df = mse_df[mse_df.loc[:, ('sq_error', 'size')] >= 2]
+    mse_df = summary_df[summary_df.weeks >= 2]
     st.markdown("Pick random pairs\nbased on certain criteria")
     num_pairs = st.number_input("Num pairs", 0, None, value=3)
     num_criteria = st.number_input("Num criteria", 0, 100, value=1)
     criteria = []
     operators = []
-    low, mid = mse_df.loc[:, ('appearances', 'sum')].quantile([0.99, 0.999])
+    low, mid = mse_df.appearances.quantile([0.99, 0.999])
     mse_cutoff = 50
     win_rate_cutoff = None
     for i in range(num_criteria):
@@ -71,19 +83,19 @@ with st.sidebar:
         overall_mask = None
         for criterion_num, criterion in enumerate(criteria):
             if criterion == high_usage:
-                mask = mse_df.loc[:, ('appearances', 'sum')] >= mid
+                mask = mse_df.appearances >= mid
             elif criterion == med_usage:
-                mask = mse_df.loc[:, ('appearances', 'sum')] < mid
-                mask &= mse_df.loc[:, ('appearances', 'sum')] >= low
+                mask = mse_df.appearances < mid
+                mask &= mse_df.appearances >= low
             elif criterion == low_usage:
-                mask = mse_df.loc[:, ('appearances', 'sum')] < low
+                mask = mse_df.appearances < low
             elif criterion == high_consistency:
-                mask = mse_df.loc[:, ('sq_error', 'mean')] < mse_cutoff
-                mask &= mse_df.loc[:, ('week', 'count')] >= 16
+                mask = mse_df.sq_error_mean < mse_cutoff
+                mask &= mse_df.weeks >= 16
             elif criterion == low_consistency:
-                mask = mse_df.loc[:, ('sq_error', 'mean')] >= mse_cutoff
+                mask = mse_df.sq_error_mean >= mse_cutoff
             elif criterion == win_rate_gt:
-                mask = mse_df.loc[:, ('win_rate', 'mean')] > win_rate_cutoff
+                mask = mse_df.win_rate > win_rate_cutoff
 
             if overall_mask is None:
                 overall_mask = mask
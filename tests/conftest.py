@@ -0,0 +1,60 @@
+import sqlite3
+
+import pytest
+
+SPECIES = ["Amoonguss", "Incineroar", "Rillaboom", "Flutter Mane", "Urshifu"]
+MOVES = ["Protect", "Fake Out", "Spore", "Moonblast"]
+# Urshifu is nicknamed, so moves must be mapped from nickname to species
+NICKNAMES = {"Urshifu": "Fluffy"}
+
+
+def make_log(i):
+    """
+    Returns a small synthetic log for the i-th replay between Alice and Bob,
+    with two switch-ins and one move per side.
+    """
+    lines = ["|player|p1|Alice|1|", "|player|p2|Bob|2|"]
+    for player in (1, 2):
+        for position, pokemon in zip("ab", (SPECIES[(i + player) % 5], SPECIES[(i + player + 1) % 5])):
+            lines.append(f"|switch|p{player}{position}: {NICKNAMES.get(pokemon, pokemon)}|{pokemon}, L50|100/100")
+    lines.append("|turn|1")
+    for player in (1, 2):
+        pokemon = SPECIES[(i + player) % 5]
+        target = SPECIES[(i + 3 - player) % 5]
+        lines.append(f"|move|p{player}a: {NICKNAMES.get(pokemon, pokemon)}|{MOVES[(i + player) % 4]}"
+                     f"|p{3 - player}a: {NICKNAMES.get(target, target)}")
+    lines.append(f"|win|{'Alice' if i % 3 else 'Bob'}")
+    return "\n".join(lines)
+
+
+@pytest.fixture
+def database_con(tmp_path):
+    con = sqlite3.connect(tmp_path / "replays.db")
+    con.execute("""
+        CREATE TABLE replays (
+        id TEXT PRIMARY KEY,
+        format TEXT NOT NULL,
+        players TEXT NOT NULL,
+        log TEXT NOT NULL,
+        uploadtime INTEGER NOT NULL,
+        rating INTEGER)
+    """)
+    yield con
+    con.close()
+
+
+@pytest.fixture
+def insert_replays(database_con):
+    """
+    Inserts the replays numbered by replay_range, uploaded interval seconds
+    apart from uploadtime_start. Every fourth replay is unrated, with the
+    rating stored as the string "null".
+    """
+    def insert(replay_range, uploadtime_start=1_700_000_000, interval=60, format="gen9vgc"):
+        database_con.executemany("INSERT INTO replays VALUES(?, ?, ?, ?, ?, ?)", [
+            (f"{format}-{i}", format, "Alice,Bob", make_log(i), uploadtime_start + interval * k,
+             "null" if i % 4 == 0 else 1000 + 5 * i)
+            for k, i in enumerate(replay_range)
+        ])
+        database_con.commit()
+    return insert
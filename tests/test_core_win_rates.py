@@ -0,0 +1,32 @@
+import pytest
+
+from pokemon_showdown_replay_tools.sqlite import (
+    ReplayFilter,
+    create_appearances_table,
+    get_core_win_rates,
+    get_pair_marginal_win_rates_conditional,
+)
+
+
+@pytest.mark.parametrize("where", ["", ReplayFilter(rating_min=1020)])
+def test_pair_cores_match_pair_win_rates(database_con, insert_replays, where):
+    insert_replays(range(40))
+    create_appearances_table(database_con)
+    pairs = get_pair_marginal_win_rates_conditional(database_con, where)
+    cores = get_core_win_rates(database_con, k=2, min_support=1, where=where)
+    assert sorted(cores) == sorted(
+        ((p1, p2), appearances, wins, win_rate)
+        for p1, p2, _, appearances, wins, win_rate in pairs
+    )
+
+
+def test_cores_below_min_support_are_left_out(database_con, insert_replays):
+    insert_replays(range(40))
+    # A few more replays, so that some pairs are more frequent than others
+    insert_replays(range(2), format="gen9ou")
+    create_appearances_table(database_con)
+    pairs = get_pair_marginal_win_rates_conditional(database_con)
+    frequent = {(p1, p2) for p1, p2, _, appearances, _, _ in pairs if appearances >= 17}
+    assert 0 < len(frequent) < len(pairs)
+    cores = get_core_win_rates(database_con, k=2, min_support=17)
+    assert {core for core, *_ in cores} == frequent
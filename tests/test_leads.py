@@ -0,0 +1,32 @@
+from pokemon_showdown_replay_tools.sqlite import index_replay_leads
+
+# Zoroark leads disguised as Incineroar and is revealed on turn 2, after
+# p2 switched Rillaboom in and out of position b on turn 1
+LOG = "\n".join([
+    "|player|p1|Alice|1|",
+    "|player|p2|Bob|2|",
+    "|switch|p1a: Incineroar|Incineroar, L50|100/100",
+    "|switch|p1b: Amoonguss|Amoonguss, L50|100/100",
+    "|switch|p2a: Urshifu|Urshifu, L50|100/100",
+    "|switch|p2b: Rillaboom|Rillaboom, L50|100/100",
+    "|turn|1",
+    "|switch|p2b: Flutter Mane|Flutter Mane, L50|100/100",
+    "|switch|p2b: Incineroar|Incineroar, L50|100/100",
+    "|turn|2",
+    "|replace|p1a: Zoroark|Zoroark-Hisui, L50|100/100",
+    "|replace|p2b: Zoroark|Zoroark, L50|100/100",
+    "|win|Alice",
+])
+
+
+def test_illusion_replaces_the_disguised_switch_in(database_con):
+    index_replay_leads(database_con, [("gen9vgc-0", LOG)])
+    rows = database_con.execute("SELECT * FROM leads ORDER BY turn, player, position").fetchall()
+    assert rows == [
+        ("gen9vgc-0", "Alice", 0, "a", "Zoroark-Hisui", 1),
+        ("gen9vgc-0", "Alice", 0, "b", "Amoonguss", 1),
+        ("gen9vgc-0", "Bob", 0, "a", "Urshifu", 0),
+        ("gen9vgc-0", "Bob", 0, "b", "Rillaboom", 0),
+        # The disguised Incineroar wasn't the first switch-in, so it isn't recorded
+        ("gen9vgc-0", "Bob", 1, "b", "Flutter Mane", 0),
+    ]
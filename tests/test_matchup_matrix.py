@@ -0,0 +1,46 @@
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+from pokemon_showdown_replay_tools.sqlite import ReplayFilter, create_appearances_table, get_matchup_matrix
+
+
+def brute_force_matchups(database_con, replay_ids):
+    teams = defaultdict(lambda: defaultdict(set))
+    results = {}
+    for replay_id, player, pokemon, won in database_con.execute("SELECT id, player, pokemon, won FROM appearances"):
+        if replay_id in replay_ids:
+            teams[replay_id][player].add(pokemon)
+            results[replay_id, player] = won
+    games, wins = defaultdict(int), defaultdict(int)
+    for replay_id, sides in teams.items():
+        for player, team in sides.items():
+            for opponent, opposing_team in sides.items():
+                if opponent == player:
+                    continue
+                for a in team:
+                    for b in opposing_team:
+                        games[a, b] += 1
+                        wins[a, b] += results[replay_id, player]
+    return games, wins
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 10_000])
+@pytest.mark.parametrize("where", ["", ReplayFilter(rating_min=1020)])
+def test_matchup_matrix_matches_brute_force(database_con, insert_replays, batch_size, where):
+    insert_replays(range(20))
+    create_appearances_table(database_con)
+    pokemon, games, wins = get_matchup_matrix(database_con, where, batch_size=batch_size)
+    replay_ids = {
+        replay_id for replay_id, rating in database_con.execute("SELECT id, rating FROM replays")
+        if where == "" or (rating != "null" and rating >= 1020)
+    }
+    expected_games, expected_wins = brute_force_matchups(database_con, replay_ids)
+    assert pokemon == sorted({a for a, _ in expected_games})
+    expected = np.array([[expected_games[a, b] for b in pokemon] for a in pokemon])
+    np.testing.assert_array_equal(games, expected)
+    np.testing.assert_array_equal(wins, [[expected_wins[a, b] for b in pokemon] for a in pokemon])
+    # every fixture battle is a mirror of one pokemon, counted once per side
+    assert np.diagonal(games).sum() == 2 * len(replay_ids)
+    assert np.diagonal(wins).sum() == len(replay_ids)
@@ -0,0 +1,40 @@
+from pokemon_showdown_replay_tools.sqlite import DAY, create_moves_table, index_replay_moves
+
+INTERVAL = 3 * 60 * 60
+
+
+def read_move_usage(database_con):
+    return database_con.execute("SELECT * FROM move_usage ORDER BY format, day, pokemon, move, won").fetchall()
+
+
+def count_move_usage(database_con):
+    # The cube recomputed from the moves table
+    return database_con.execute(f"""
+        SELECT r.format, r.uploadtime / {DAY} AS day, m.pokemon, m.move, m.won,
+               COUNT(*), COUNT(DISTINCT m.id || ',' || m.player)
+        FROM moves AS m JOIN replays AS r ON r.id = m.id
+        GROUP BY r.format, day, m.pokemon, m.move, m.won
+        ORDER BY r.format, day, m.pokemon, m.move, m.won
+    """).fetchall()
+
+
+def test_rerunning_the_move_cube_upsert_changes_nothing(database_con, insert_replays):
+    insert_replays(range(20), interval=INTERVAL)
+    create_moves_table(database_con)
+    usage = read_move_usage(database_con)
+    assert usage == count_move_usage(database_con)
+
+    create_moves_table(database_con)
+    replays = database_con.execute("SELECT id, format, log, uploadtime FROM replays").fetchall()
+    index_replay_moves(database_con, replays)
+    index_replay_moves(database_con, replays[:5] + replays[:5])
+    assert read_move_usage(database_con) == usage
+
+
+def test_incremental_move_cube_matches_a_single_build(database_con, insert_replays):
+    insert_replays(range(10), interval=INTERVAL)
+    create_moves_table(database_con)
+    # New replays on a day the first batch already counted
+    insert_replays(range(10, 20), uploadtime_start=1_700_000_000 + 9 * INTERVAL, interval=INTERVAL)
+    create_moves_table(database_con)
+    assert read_move_usage(database_con) == count_move_usage(database_con)
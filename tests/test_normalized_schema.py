@@ -0,0 +1,57 @@
+import pytest
+
+from pokemon_showdown_replay_tools.sqlite import (
+    ReplayFilter,
+    create_appearances_table,
+    get_pair_marginal_win_rates,
+    get_pair_marginal_win_rates_conditional,
+    has_normalized_schema,
+    migrate_to_normalized_schema,
+)
+
+
+def pair_win_rates(database_con, where, **kwargs):
+    rows = get_pair_marginal_win_rates_conditional(database_con, where, **kwargs)
+    return sorted(tuple(row[:5]) for row in rows)
+
+
+@pytest.mark.parametrize("where", [
+    "",
+    ReplayFilter(rating_min=1300),
+    ReplayFilter(player="alice", species=("Incineroar",)),
+])
+def test_rerun_migration_matches_appearances(database_con, insert_replays, where):
+    insert_replays(range(0, 60))
+    migrate_to_normalized_schema(database_con)
+    insert_replays(range(60, 100))
+    migrate_to_normalized_schema(database_con)
+    
+    create_appearances_table(database_con, "legacy_appearances")
+    assert pair_win_rates(database_con, where) == pair_win_rates(
+        database_con, where, appearances_table_name="legacy_appearances")
+
+
+def test_replays_added_after_migrating_are_not_left_out(database_con, insert_replays):
+    insert_replays(range(0, 60))
+    migrate_to_normalized_schema(database_con)
+    insert_replays(range(60, 100))
+    create_appearances_table(database_con)
+    assert not has_normalized_schema(database_con)
+    
+    create_appearances_table(database_con, "legacy_appearances")
+    expected = pair_win_rates(database_con, "", appearances_table_name="legacy_appearances")
+    assert pair_win_rates(database_con, "") == expected
+    assert sorted(tuple(row[:5]) for row in get_pair_marginal_win_rates(database_con)) == expected
+    
+    migrate_to_normalized_schema(database_con)
+    assert has_normalized_schema(database_con)
+    assert pair_win_rates(database_con, "") == expected
+
+
+def test_normalized_schema_is_only_used_for_migrated_tables(database_con, insert_replays):
+    insert_replays(range(0, 20))
+    migrate_to_normalized_schema(database_con)
+    assert has_normalized_schema(database_con)
+    assert not has_normalized_schema(database_con, "other_appearances")
+    with pytest.raises(ValueError):
+        migrate_to_normalized_schema(database_con, "other_appearances")
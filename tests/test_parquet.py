@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+
+from pokemon_showdown_replay_tools.parquet import export_parquet_dataset, open_dataset, read_appearances
+from pokemon_showdown_replay_tools.sqlite import ReplayFilter, create_appearances_table, create_moves_table
+
+
+@pytest.fixture
+def dataset(database_con, insert_replays, tmp_path):
+    insert_replays(range(40))
+    root = tmp_path / "dataset"
+    export_parquet_dataset(database_con, str(root))
+    return str(root)
+
+
+@pytest.mark.parametrize("player", ["Alice", "alice", "BOB"])
+def test_player_filter_matches_sqlite(database_con, dataset, player):
+    replay_filter = ReplayFilter(player=player)
+    create_appearances_table(database_con)
+    where, params = replay_filter.compile()
+    expected = database_con.execute(
+        f"SELECT COUNT(*) FROM appearances WHERE id IN (SELECT id FROM replays {where})", params,
+    ).fetchone()[0]
+    assert expected > 0
+    assert len(read_appearances(dataset, replay_filter)) == expected
+
+
+def test_moves_match_sqlite(database_con, dataset):
+    create_moves_table(database_con)
+    expected = pd.read_sql('SELECT id, "order", pokemon, move FROM moves', database_con)
+    moves_df = open_dataset(dataset, "moves").to_table(columns=["id", "order", "pokemon", "move"]).to_pandas()
+    pd.testing.assert_frame_equal(
+        moves_df.sort_values(by=["id", "order"], ignore_index=True),
+        expected.sort_values(by=["id", "order"], ignore_index=True),
+        check_dtype=False,
+    )
+    assert "Urshifu" in set(moves_df.pokemon)
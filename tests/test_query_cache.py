@@ -0,0 +1,49 @@
+import sqlite3
+
+from pokemon_showdown_replay_tools.sqlite import (
+    QueryCache,
+    ReplayFilter,
+    create_appearances_table,
+    get_pair_marginal_win_rates_conditional,
+)
+
+
+def count_replays(database_con, where=''):
+    return database_con.execute(f"SELECT COUNT(*) FROM replays {where}").fetchone()[0]
+
+
+def test_cached_results_are_invalidated_by_new_replays(tmp_path, database_con, insert_replays):
+    insert_replays(range(10))
+    create_appearances_table(database_con)
+    cache = QueryCache(directory=str(tmp_path / "cache"))
+    where = ReplayFilter(formats=["gen9vgc"])
+    before = get_pair_marginal_win_rates_conditional(database_con, where, cache=cache)
+    assert get_pair_marginal_win_rates_conditional(database_con, where, cache=cache) == before
+
+    insert_replays(range(10, 30))
+    create_appearances_table(database_con)
+    expected = get_pair_marginal_win_rates_conditional(database_con, where)
+    assert expected != before
+    assert get_pair_marginal_win_rates_conditional(database_con, where, cache=cache) == expected
+    # A fresh cache on the same directory must not return the stale pickle either
+    fresh_cache = QueryCache(directory=str(tmp_path / "cache"))
+    assert get_pair_marginal_win_rates_conditional(database_con, where, cache=fresh_cache) == expected
+
+
+def test_where_strings_are_keyed_exactly(tmp_path, database_con, insert_replays):
+    insert_replays(range(3), format="gen9 vgc")
+    insert_replays(range(5), format="gen9  vgc")
+    cache = QueryCache(directory=str(tmp_path / "cache"))
+    assert cache.get_or_compute(database_con, count_replays, table_names=("replays",),
+                                where="WHERE format = 'gen9 vgc'") == 3
+    assert cache.get_or_compute(database_con, count_replays, table_names=("replays",),
+                                where="WHERE format = 'gen9  vgc'") == 5
+
+
+def test_in_memory_databases_are_not_cached():
+    database_con = sqlite3.connect(":memory:")
+    database_con.execute("CREATE TABLE replays (id TEXT PRIMARY KEY)")
+    cache = QueryCache()
+    assert cache.get_or_compute(database_con, count_replays, table_names=("replays",)) == 0
+    database_con.execute("INSERT INTO replays VALUES ('a')")
+    assert cache.get_or_compute(database_con, count_replays, table_names=("replays",)) == 1
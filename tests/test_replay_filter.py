@@ -0,0 +1,114 @@
+import sqlite3
+
+import pytest
+
+from pokemon_showdown_replay_tools.sqlite import (
+    ReplayFilter,
+    create_filtered_replays_table,
+    create_replay_indexes,
+    get_pair_marginal_win_rates_conditional,
+)
+
+
+@pytest.fixture
+def database_con(tmp_path):
+    con = sqlite3.connect(tmp_path / "replays.db")
+    con.executescript("""
+        CREATE TABLE replays (
+        id TEXT PRIMARY KEY,
+        format TEXT NOT NULL,
+        players TEXT NOT NULL,
+        log TEXT NOT NULL,
+        uploadtime INTEGER NOT NULL,
+        rating INTEGER);
+        
+        CREATE TABLE appearances (
+        id TEXT NOT NULL,
+        player TEXT NOT NULL,
+        pokemon TEXT NOT NULL,
+        won INTEGER NOT NULL,
+        CONSTRAINT one_poke_per_player_per_game UNIQUE(id, player, pokemon) ON CONFLICT IGNORE);
+    """)
+    replays = []
+    appearances = []
+    for i in range(200):
+        rating = "null" if i % 4 == 0 else 1000 + 5 * i
+        replays.append((f"gen9vgc-{i}", "gen9vgc", "Alice,Bob", "", 1_700_000_000 + 60 * i, rating))
+        for player, won in (("p1", i % 2), ("p2", 1 - i % 2)):
+            for pokemon in ("Amoonguss", "Incineroar", "Rillaboom"):
+                appearances.append((f"gen9vgc-{i}", player, pokemon, won))
+    con.executemany("INSERT INTO replays VALUES(?, ?, ?, ?, ?, ?)", replays)
+    con.executemany("INSERT INTO appearances VALUES(?, ?, ?, ?)", appearances)
+    con.commit()
+    yield con
+    con.close()
+
+
+def _query_plan(database_con, sql, params=()):
+    rows = database_con.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return "\n".join(detail for (_, _, _, detail) in rows)
+
+
+def test_compiled_filter_uses_format_uploadtime_rating_index(database_con):
+    create_replay_indexes(database_con)
+    replay_filter = ReplayFilter(
+        formats=("gen9vgc",),
+        uploadtime_start=1_700_000_000,
+        uploadtime_end=1_700_006_000,
+        rating_min=1300,
+    )
+    where, params = replay_filter.compile()
+    plan = _query_plan(database_con, f"SELECT id FROM replays {where}", params)
+    assert "replays_format_uploadtime_rating_idx" in plan
+
+
+def test_species_filter_uses_appearances_index(database_con):
+    create_replay_indexes(database_con)
+    where, params = ReplayFilter(species=("Amoonguss",)).compile()
+    plan = _query_plan(database_con, f"SELECT id FROM replays {where}", params)
+    assert "appearances_pokemon_idx" in plan
+
+
+def test_pair_query_uses_filtered_replays_table(database_con):
+    replay_filter = ReplayFilter(formats=("gen9vgc",), rating_min=1300)
+    table_name = create_filtered_replays_table(database_con, replay_filter)
+    rows = get_pair_marginal_win_rates_conditional(database_con, replay_filter, explain=True)
+    plan = "\n".join(detail for (_, _, _, detail) in rows)
+    assert table_name in plan
+
+
+def test_rating_bounds_exclude_null_ratings(database_con):
+    for replay_filter in (ReplayFilter(rating_min=1300), ReplayFilter(rating_max=10_000)):
+        where, params = replay_filter.compile()
+        ratings = database_con.execute(f"SELECT rating FROM replays {where}", params).fetchall()
+        assert ratings
+        assert all(isinstance(rating, int) for (rating,) in ratings)
+
+
+def test_filtered_replays_tables_are_evicted(database_con):
+    def temp_tables():
+        rows = database_con.execute("SELECT name FROM sqlite_temp_master WHERE type = 'table'").fetchall()
+        return {name for (name,) in rows} - {"filtered_replays_versions"}
+    
+    first = create_filtered_replays_table(database_con, ReplayFilter(rating_min=1000), max_tables=3)
+    names = [create_filtered_replays_table(database_con, ReplayFilter(rating_min=1000 + i), max_tables=3)
+             for i in range(1, 3)]
+    # Using the first table again makes the second the least recently used
+    assert create_filtered_replays_table(database_con, ReplayFilter(rating_min=1000), max_tables=3) == first
+    last = create_filtered_replays_table(database_con, ReplayFilter(rating_min=2000), max_tables=3)
+    assert temp_tables() == {first, names[1], last}
+
+
+def test_reusing_a_filtered_replays_table_keeps_the_callers_transaction(database_con):
+    replay_filter = ReplayFilter(rating_min=1300)
+    name = create_filtered_replays_table(database_con, replay_filter)
+    assert not database_con.in_transaction
+    assert create_filtered_replays_table(database_con, replay_filter) == name
+    assert not database_con.in_transaction
+    
+    # Deletes don't change get_data_version, so the table is reused
+    database_con.execute("DELETE FROM replays WHERE id = 'gen9vgc-1'")
+    assert create_filtered_replays_table(database_con, replay_filter) == name
+    assert database_con.in_transaction
+    database_con.rollback()
+    assert database_con.execute("SELECT COUNT(*) FROM replays").fetchone()[0] == 200
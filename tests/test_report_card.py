@@ -0,0 +1,33 @@
+import pandas as pd
+
+from pokemon_showdown_replay_tools.report_card import ReportCardAnalytics
+
+DAILY_COLUMNS = ["p1", "p2", "players", "appearances", "wins", "Win %", "pair", "day", "format"]
+
+
+def make_analytics(replays):
+    replays_df = pd.DataFrame(replays, columns=["id", "format", "players", "uploadtime", "rating"])
+    replays_df.index = pd.Index(replays_df.id.values, name="id")
+    appearances_df = pd.DataFrame([
+        (replay_id, "Alice", pokemon, 1, order)
+        for replay_id, *_ in replays
+        for order, pokemon in enumerate(["Amoonguss", "Incineroar"])
+    ], columns=["id", "player", "pokemon", "won", "appearance_order"])
+    return ReportCardAnalytics(replays_df, appearances_df)
+
+
+def test_daily_pair_win_rates_without_replays():
+    df = make_analytics([]).get_daily_pair_win_rates()
+    assert df.empty
+    assert list(df.columns) == DAILY_COLUMNS
+
+
+def test_daily_pair_win_rates_are_split_by_format():
+    analytics = make_analytics([
+        ("a-1", "gen9vgc2024regg", "Alice,Bob", 1_700_000_000, 1200),
+        ("b-1", "gen9vgc2024regh", "Alice,Bob", 1_700_000_060, 1200),
+        ("b-2", "gen9vgc2024regh", "Alice,Bob", 1_700_000_120, 1200),
+    ])
+    df = analytics.get_daily_pair_win_rates()
+    assert list(df.columns) == DAILY_COLUMNS
+    assert dict(zip(df.format, df.appearances)) == {"gen9vgc2024regg": 1, "gen9vgc2024regh": 2}
@@ -0,0 +1,58 @@
+from collections import defaultdict
+
+import pandas as pd
+import pytest
+
+from pokemon_showdown_replay_tools.analysis import get_rolling_pair_win_rates
+from pokemon_showdown_replay_tools.sqlite import create_appearances_table
+
+
+def brute_force_rolling(appearances_df, window, stride, half_life, min_appearances):
+    teams = defaultdict(set)
+    results = {}
+    for row in appearances_df.itertuples():
+        teams[row.id, row.player].add(row.pokemon)
+        results[row.id, row.player] = (row.won, row.uploadtime)
+    start, end = appearances_df.uploadtime.min(), appearances_df.uploadtime.max() + 1
+    rows = []
+    for window_start in range(start, end, stride):
+        window_end = window_start + window
+        appearances, wins = defaultdict(float), defaultdict(float)
+        for key, team in teams.items():
+            won, uploadtime = results[key]
+            if not window_start <= uploadtime < window_end:
+                continue
+            weight = 1.0 if half_life is None else 0.5 ** ((window_end - uploadtime) / half_life)
+            for p1 in team:
+                for p2 in team:
+                    if p1 < p2:
+                        appearances[p1, p2] += weight
+                        wins[p1, p2] += weight * won
+        rows.extend(
+            (window_start, window_end, p1, p2, appearances[p1, p2], wins[p1, p2])
+            for p1, p2 in sorted(appearances)
+            if appearances[p1, p2] >= min_appearances
+        )
+    return pd.DataFrame(rows, columns=["window_start", "window_end", "p1", "p2", "appearances", "wins"])
+
+
+@pytest.mark.parametrize("half_life", [None, 1800])
+@pytest.mark.parametrize("window, stride", [(3600, 600), (600, 3600), (900, 900)])
+def test_rolling_pair_win_rates_match_brute_force(database_con, insert_replays, window, stride, half_life):
+    # Replays every minute, but with a gap of two hours in the middle
+    insert_replays(range(60))
+    insert_replays(range(60, 100), uploadtime_start=1_700_000_000 + 3 * 3600)
+    create_appearances_table(database_con)
+    appearances_df = pd.read_sql_query("""
+        SELECT a.id, a.player, a.pokemon, a.won, r.uploadtime
+        FROM appearances AS a JOIN replays AS r ON r.id = a.id
+    """, database_con)
+    min_appearances = 1 if half_life is None else 0.5
+    df = get_rolling_pair_win_rates(appearances_df, window, stride, half_life=half_life,
+                                    min_appearances=min_appearances)
+    expected = brute_force_rolling(appearances_df, window, stride, half_life, min_appearances)
+    df = df.sort_values(["window_start", "p1", "p2"], ignore_index=True)
+    assert len(df) == len(expected) > 0
+    pd.testing.assert_frame_equal(
+        df.loc[:, expected.columns], expected, check_dtype=False, check_exact=half_life is None)
+    assert (df.win_rate == df.wins / df.appearances).all()
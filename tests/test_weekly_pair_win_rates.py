@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+
+from pokemon_showdown_replay_tools.parquet import (
+    WEEK,
+    read_weekly_pair_win_rates,
+    update_weekly_pair_win_rates,
+)
+from pokemon_showdown_replay_tools.sqlite import create_appearances_table
+
+HOUR = 60 * 60
+FIRST_WEEK = 1_700_000_000 // WEEK + 1
+
+
+@pytest.fixture
+def replays(database_con, insert_replays):
+    # Three weeks of hourly replays, starting and ending in the middle of a week
+    insert_replays(range(3 * 7 * 24), uploadtime_start=FIRST_WEEK * WEEK + WEEK // 2, interval=HOUR)
+    create_appearances_table(database_con)
+    return database_con
+
+
+def read_weeks(root):
+    df = read_weekly_pair_win_rates(root)
+    return df.drop(columns="week").sort_values(by=["week_start", "pair"], ignore_index=True)
+
+
+def test_partial_first_and_last_weeks_are_excluded(replays, tmp_path):
+    assert update_weekly_pair_win_rates(replays, tmp_path / "weekly") == [FIRST_WEEK + 1, FIRST_WEEK + 2]
+
+
+def test_unchanged_weeks_are_skipped(replays, tmp_path):
+    update_weekly_pair_win_rates(replays, tmp_path / "weekly")
+    assert update_weekly_pair_win_rates(replays, tmp_path / "weekly") == []
+
+
+def test_weeks_with_new_replays_are_recomputed(replays, insert_replays, tmp_path):
+    update_weekly_pair_win_rates(replays, tmp_path / "weekly")
+    insert_replays(range(1000, 1010), uploadtime_start=(FIRST_WEEK + 1) * WEEK, interval=HOUR)
+    # The new replays only count once they have appearances
+    assert update_weekly_pair_win_rates(replays, tmp_path / "weekly") == []
+    create_appearances_table(replays)
+    assert update_weekly_pair_win_rates(replays, tmp_path / "weekly") == [FIRST_WEEK + 1]
+    
+    update_weekly_pair_win_rates(replays, tmp_path / "rebuilt")
+    pd.testing.assert_frame_equal(read_weeks(tmp_path / "weekly"), read_weeks(tmp_path / "rebuilt"))